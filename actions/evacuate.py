@@ -0,0 +1,79 @@
+#!/usr/bin/python
+import os
+import sys
+import traceback
+
+sys.path.append('hooks/')
+
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+)
+
+from neutron_utils import (
+    EvacuationError,
+    evacuate_agents,
+    rebalance_agents,
+    restore_agents,
+)
+
+
+def evacuate():
+    """Move all routers and DHCP networks off this unit's agents.
+
+    The local agents are disabled so nothing is scheduled back to them
+    until the restore action is run."""
+    _run(evacuate_agents, 'evacuate')
+
+
+def restore():
+    """Re-enable this unit's agents and move evacuated resources back."""
+    _run(restore_agents, 'restore')
+
+
+def rebalance():
+    """Spread routers and DHCP networks evenly over all gateways.
+
+    With dry-run set only the planned moves and resulting per-agent counts
+    are reported."""
+    _run(rebalance_agents, 'rebalance',
+         dry_run=action_get('dry-run'),
+         max_imbalance=action_get('max-imbalance'))
+
+
+def _run(func, name, **kwargs):
+    try:
+        results = func(concurrency=action_get('concurrency'),
+                       timeout=action_get('timeout'), **kwargs)
+    except EvacuationError as e:
+        action_fail('%s failed: %s' % (name, e))
+        return
+    except:
+        action_set({'traceback': traceback.format_exc()})
+        action_fail('%s resulted in an unexpected error' % name)
+        return
+    action_set(results)
+    if results.get('failed'):
+        action_fail('%s failed to move %s resources' %
+                    (name, results['failed']))
+
+
+ACTIONS = {
+    'evacuate': evacuate,
+    'rebalance': rebalance,
+    'restore': restore,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return 'Action %s undefined' % action_name
+    action()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
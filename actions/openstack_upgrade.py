@@ -3,6 +3,10 @@ import sys
 
 sys.path.append('hooks/')
 
+from collections import OrderedDict
+
+from charmhelpers.core.hookenv import action_set
+
 from charmhelpers.contrib.openstack.utils import (
     do_action_openstack_upgrade,
 )
@@ -24,12 +28,24 @@ def openstack_upgrade():
     If the charm was installed from source we cannot upgrade it.
     For backwards compatibility a config flag must be set for this
     code to run, otherwise a full service level upgrade will fire
-    on config-changed."""
+    on config-changed.
+
+    The time taken by each phase of the upgrade is reported in the
+    action results under timings."""
+
+    timings = OrderedDict()
+
+    def upgrade(configs):
+        do_openstack_upgrade(configs, timings=timings)
 
-    if do_action_openstack_upgrade(NEUTRON_COMMON,
-                                   do_openstack_upgrade,
-                                   CONFIGS):
-        config_changed()
+    upgraded = do_action_openstack_upgrade(NEUTRON_COMMON, upgrade, CONFIGS)
+    if timings:
+        action_set({'timings.{}'.format(phase): seconds
+                    for phase, seconds in timings.items()})
+    if upgraded:
+        # The upgrade changes no config options, so force every stage to
+        # re-render for the new release
+        config_changed(force=True)
 
 
 if __name__ == '__main__':
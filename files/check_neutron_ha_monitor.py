@@ -0,0 +1,50 @@
+#!/usr/bin/python
+#
+# Nagios check for the neutron-ha-monitor daemon, reading the status file it
+# rewrites at the end of every cycle.
+
+import json
+import optparse
+import os
+import sys
+import time
+
+OK, WARNING, CRITICAL, UNKNOWN = range(4)
+
+
+def check(status_file, warn, crit):
+    try:
+        age = time.time() - os.stat(status_file).st_mtime
+        with open(status_file) as f:
+            status = json.loads(f.read() or '{}')
+    except (IOError, OSError, ValueError) as e:
+        return CRITICAL, 'CRITICAL: unable to read %s: %s' % (status_file, e)
+
+    perfdata = 'age=%ds;%d;%d cycle=%.2fs api_calls=%dc failovers=%dc' % (
+        age, warn, crit, status.get('cycle_duration', 0),
+        sum(status.get('api_calls', {}).values()),
+        status.get('failovers', 0))
+    message = 'last cycle %ds ago, took %.2fs, %d agents down' % (
+        age, status.get('cycle_duration', 0),
+        len(status.get('down_agents', [])))
+    if age > crit:
+        return CRITICAL, 'CRITICAL: %s | %s' % (message, perfdata)
+    if age > warn:
+        return WARNING, 'WARNING: %s | %s' % (message, perfdata)
+    return OK, 'OK: %s | %s' % (message, perfdata)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-f', '--file', dest='status_file',
+                      default='/var/lib/juju-neutron-ha/monitor-status.json')
+    parser.add_option('-w', '--warning', type='int', default=60)
+    parser.add_option('-c', '--critical', type='int', default=120)
+    opts, _ = parser.parse_args()
+    code, message = check(opts.status_file, opts.warning, opts.critical)
+    print(message)
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
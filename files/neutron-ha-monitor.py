@@ -10,21 +10,142 @@ Helpers for monitoring Neutron agents, reschedule failed agents,
 cleaned resources on failed nodes.
 """
 
+import json
 import os
 import re
 import sys
 import signal
 import socket
 import subprocess
+import threading
 import time
 
+from multiprocessing import TimeoutError
+from xml.etree import ElementTree
+from multiprocessing.pool import ThreadPool
 from oslo.config import cfg
 from neutron.agent.linux import ovs_lib
 from neutron.agent.linux import ip_lib
 from neutron.common import exceptions
 from neutron.openstack.common import log as logging
+# Installed alongside this script by the charm
+from neutron_discovery import AgentDiscovery
 
 LOG = logging.getLogger(__name__)
+# Number of recent failover events kept in the status file
+STATUS_EVENTS = 10
+# Local services supervised by the monitor and the processes each runs
+SUPERVISED_SERVICES = [
+    ('openvswitch-switch', ['ovsdb-server', 'ovs-vswitchd']),
+    ('neutron-dhcp-agent', ['neutron-dhcp-agent']),
+    ('neutron-metadata-agent', ['neutron-metadata-agent']),
+    ('neutron-vpn-agent', ['neutron-vpn-agent']),
+]
+# Tunnel types the OVS agent creates ports for, named <type>-<remote ip>
+TUNNEL_TYPES = ('gre', 'vxlan', 'geneve')
+# Seconds to give a restarted OVS agent to build its tunnels
+TUNNEL_RESTART_GRACE = 60
+# Upper bound on the backoff between restarts of a service that stays hung
+HANG_RESTART_BACKOFF_MAX = 3600
+# Services whose agent heartbeat shows whether they are hung
+AGENT_SERVICES = {
+    'DHCP agent': 'neutron-dhcp-agent',
+    'L3 agent': 'neutron-vpn-agent',
+}
+
+
+class CountingClient(object):
+    """Proxy to a neutron client counting the API calls made through it."""
+
+    def __init__(self, client, counts, lock):
+        self._client = client
+        self._counts = counts
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._lock:
+                self._counts[name] = self._counts.get(name, 0) + 1
+            return attr(*args, **kwargs)
+        return call
+
+
+class TunnelWatcher(object):
+    """In-memory view of the local OVS tunnel interfaces.
+
+    Fed by a long-lived 'ovsdb-client monitor' of the Interface table, so
+    reading it costs nothing while the switch is stable."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process = None
+        self.synced = False
+        # interface uuid -> tunnel type
+        self.interfaces = {}
+        # tunnel type -> time its first port last appeared
+        self.appeared = {}
+
+    def start(self):
+        if self.process and self.process.poll() is None:
+            return True
+        with self.lock:
+            self.synced = False
+            self.interfaces = {}
+        try:
+            self.process = subprocess.Popen(
+                ['ovsdb-client', '--format=json', 'monitor', 'Open_vSwitch',
+                 'Interface', 'name', 'type'],
+                stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        except OSError as e:
+            LOG.error('Failed to monitor ovsdb, (%s)' % e)
+            self.process = None
+            return False
+        reader = threading.Thread(target=self.read, args=(self.process,))
+        reader.daemon = True
+        reader.start()
+        return True
+
+    def read(self, process):
+        for line in iter(process.stdout.readline, ''):
+            try:
+                self.apply(json.loads(line))
+            except ValueError:
+                continue
+        LOG.warn('ovsdb-client monitor exited')
+
+    def apply(self, update):
+        headings = update.get('headings', [])
+        now = time.time()
+        with self.lock:
+            for data in update.get('data', []):
+                row = dict(zip(headings, data))
+                uuid = str(row.get('row'))
+                if row.get('action') in ('delete', 'old'):
+                    if row.get('action') == 'delete':
+                        self.interfaces.pop(uuid, None)
+                    continue
+                tunnel_type = row.get('type')
+                if tunnel_type not in TUNNEL_TYPES:
+                    self.interfaces.pop(uuid, None)
+                    continue
+                if tunnel_type not in self.interfaces.values():
+                    self.appeared[tunnel_type] = now
+                self.interfaces[uuid] = tunnel_type
+            self.synced = True
+
+    def counts(self):
+        """Return tunnel type -> number of ports, or None until synced."""
+        with self.lock:
+            if not self.synced:
+                return None
+            counts = {}
+            for tunnel_type in self.interfaces.values():
+                counts[tunnel_type] = counts.get(tunnel_type, 0) + 1
+            return counts
 
 
 class Daemon(object):
@@ -95,6 +216,43 @@ class MonitorNeutronAgentsDaemon(Daemon):
         LOG.info('Monitor Neutron Agent Loop Init')
         self.hostname = None
         self.env = {}
+        # agent id -> (heartbeat_timestamp, local time it was first seen)
+        self.heartbeats = {}
+        # agent id -> local time its heartbeat went stale
+        self.suspected = {}
+        # agent id -> (local time it was declared down, reason)
+        self.detected = {}
+        self.cluster = None
+        self.pool = None
+        # Each inventory worker thread keeps its own client
+        self.workers = threading.local()
+        # (kind, agent id) -> inventory lookup still running
+        self.inflight = {}
+        # API method -> calls since start, guarded for the inventory pool
+        self.api_calls = {}
+        self.api_lock = threading.Lock()
+        # API method -> calls, bytes and seconds of discovery queries, also
+        # guarded by api_lock
+        self.api_stats = {}
+        self.failovers = 0
+        self.failover_events = []
+        # process name -> last known pid
+        self.pids = {}
+        # state of the last cycle, published by write_status
+        self.status = {}
+        self.local_agents = []
+        # service -> (restarts in a row while hung, time of the last one)
+        self.hang_restarts = {}
+        self.tunnels = None
+        # (time the OVS agent was restarted, missing tunnel types)
+        self.tunnel_restart = None
+        self.tunnel_latency = None
+
+    def get_pool(self):
+        # Created lazily so the worker threads are started after daemonizing
+        if not self.pool:
+            self.pool = ThreadPool(int(cfg.CONF.inventory_workers))
+        return self.pool
 
     def get_env(self):
         envrc_f = '/etc/legacy_ha_envrc'
@@ -120,6 +278,21 @@ class MonitorNeutronAgentsDaemon(Daemon):
             self.hostname = socket.gethostname()
         return self.hostname
 
+    def get_heartbeat_threshold(self):
+        env = self.get_env()
+        try:
+            return float(env.get('heartbeat_threshold',
+                                 cfg.CONF.heartbeat_threshold))
+        except ValueError:
+            return float(cfg.CONF.heartbeat_threshold)
+
+    def get_hang_threshold(self):
+        env = self.get_env()
+        try:
+            return float(env.get('hang_threshold', cfg.CONF.hang_threshold))
+        except ValueError:
+            return float(cfg.CONF.hang_threshold)
+
     def get_root_helper(self):
         return 'sudo'
 
@@ -132,13 +305,154 @@ class MonitorNeutronAgentsDaemon(Daemon):
         nodes = pattern.findall(output)
         return nodes
 
-    def get_crm_res_lead_node(self):
-        nodes = self.list_monitor_res()
-        if nodes:
-            return nodes[0].strip()
-        else:
-            LOG.error('Failed to get crm resource.')
+    def list_lost_nodes(self):
+        """List cluster nodes pacemaker does not report as members."""
+        try:
+            output = subprocess.check_output(['crm_node', '-l'])
+        except (OSError, subprocess.CalledProcessError) as e:
+            LOG.error('Failed to list crm nodes, (%s)' % e)
             return None
+        lost = []
+        for line in output.strip().split('\n'):
+            fields = line.split()
+            if len(fields) >= 3 and fields[2] != 'member':
+                lost.append(fields[1].partition('.')[0])
+        return lost
+
+    def query_cluster(self):
+        """Read membership and the nodes running cl_monitor from pacemaker.
+
+        A single crm_mon call answers both; the crm CLI is only used if
+        that fails. Returns a dict with 'lost', the short names of nodes
+        that are not online (None if unknown), and 'monitor', the nodes
+        cl_monitor is started on in instance order."""
+        try:
+            output = subprocess.check_output(['crm_mon', '-1', '--as-xml'])
+            root = ElementTree.fromstring(output)
+        except (OSError, subprocess.CalledProcessError,
+                ElementTree.ParseError) as e:
+            LOG.error('Failed to query crm_mon, (%s)' % e)
+            return {'lost': self.list_lost_nodes(),
+                    'monitor': [n.strip() for n in self.list_monitor_res()]}
+
+        lost = [node.get('name').partition('.')[0]
+                for node in root.findall('nodes/node')
+                if node.get('online') != 'true']
+        monitor = []
+        for clone in root.findall('resources/clone'):
+            if clone.get('id') != 'cl_monitor':
+                continue
+            for resource in clone.findall('resource'):
+                node = resource.find('node')
+                if resource.get('role') == 'Started' and node is not None:
+                    monitor.append(node.get('name'))
+        return {'lost': lost, 'monitor': monitor}
+
+    def get_cluster(self):
+        # Queried on first use and cached for the rest of the cycle, so
+        # steady-state cycles with nothing to fail over never call out
+        if self.cluster is None:
+            self.cluster = self.query_cluster()
+        return self.cluster
+
+    def is_host_lost(self, host):
+        lost = self.get_cluster()['lost']
+        if lost is None:
+            return False
+        return str(host).strip().partition('.')[0] in lost
+
+    def is_lead_node(self):
+        """Whether this host is the first cl_monitor node, the only one
+        allowed to reschedule."""
+        nodes = self.get_cluster()['monitor']
+        if not nodes:
+            LOG.error('No crm first node could be found.')
+            return False
+
+        if not self.is_same_host(nodes[0]):
+            LOG.warn('Only the first crm node %s could reschedule. '
+                     % nodes[0])
+            return False
+        return True
+
+    def heartbeat_age(self, agent):
+        """Seconds since the agent heartbeat last changed.
+
+        Measured with the local clock between monitor cycles so clock skew
+        with neutron-server does not matter."""
+        now = time.time()
+        heartbeat = agent.get('heartbeat_timestamp')
+        last = self.heartbeats.get(agent['id'])
+        if not last or last[0] != heartbeat:
+            self.heartbeats[agent['id']] = (heartbeat, now)
+            return 0
+        return now - last[1]
+
+    def is_agent_down(self, agent):
+        """Check whether an agent has failed, recording when it was detected.
+
+        Agents neutron-server reports as not alive are down. Agents whose
+        heartbeat is older than heartbeat_threshold are suspected, and only
+        declared down once pacemaker confirms their host has left the
+        cluster, so failover can start before agent_down_time expires."""
+        agent_id = agent['id']
+        age = self.heartbeat_age(agent)
+        threshold = self.get_heartbeat_threshold()
+        if agent['alive'] and (not threshold or age <= threshold):
+            self.suspected.pop(agent_id, None)
+            self.detected.pop(agent_id, None)
+            return False
+
+        if agent['alive']:
+            if agent_id not in self.suspected:
+                LOG.warn('%s %s on %s suspected, no heartbeat for %.1fs' %
+                         (agent['agent_type'], agent_id, agent['host'], age))
+                self.suspected[agent_id] = time.time()
+            if not self.is_host_lost(agent['host']):
+                return False
+            reason = 'heartbeat'
+        else:
+            reason = 'agent_down_time'
+
+        if agent_id not in self.detected:
+            LOG.info('%s %s on %s down (%s)' % (agent['agent_type'], agent_id,
+                                                agent['host'], reason))
+            self.detected[agent_id] = (time.time(), reason)
+        return True
+
+    def record_failover_events(self, resources):
+        """Log and record detection to reschedule latency of failed agents.
+
+        resources maps each moved router or network to its failed agent."""
+        now = time.time()
+        moved = {}
+        for agent_id in resources.itervalues():
+            moved[agent_id] = moved.get(agent_id, 0) + 1
+        for agent_id, count in moved.iteritems():
+            detected_at, reason = self.detected.get(agent_id,
+                                                    (now, 'unknown'))
+            event = {
+                'agent': agent_id,
+                'reason': reason,
+                'resources': count,
+                'suspected_at': self.suspected.get(agent_id),
+                'detected_at': detected_at,
+                'rescheduled_at': now,
+                'latency': now - detected_at,
+            }
+            LOG.info('Rescheduled %d resources of agent %s %.1fs after '
+                     'detection (%s)' % (count, agent_id, event['latency'],
+                                         reason))
+            self.failovers += 1
+            self.failover_events = (self.failover_events +
+                                    [event])[-STATUS_EVENTS:]
+            if not cfg.CONF.failover_event_log:
+                continue
+            try:
+                with open(cfg.CONF.failover_event_log, 'a') as f:
+                    f.write(json.dumps(event) + '\n')
+            except IOError as e:
+                LOG.error('Failed to record failover event, (%s)' % e)
 
     def unplug_device(self, device):
         try:
@@ -202,21 +516,9 @@ class MonitorNeutronAgentsDaemon(Daemon):
     def is_same_host(self, host):
         return str(host).strip() == self.get_hostname()
 
-    def validate_reschedule(self):
-        crm_no_1_node = self.get_crm_res_lead_node()
-        if not crm_no_1_node:
-            LOG.error('No crm first node could be found.')
-            return False
-
-        if not self.is_same_host(crm_no_1_node):
-            LOG.warn('Only the first crm node %s could reschedule. '
-                     % crm_no_1_node)
-            return False
-        return True
-
     def l3_agents_reschedule(self, l3_agents, routers, quantum):
-        if not self.validate_reschedule():
-            return
+        if not self.is_lead_node():
+            return False
 
         index = 0
         for router_id in routers:
@@ -224,8 +526,8 @@ class MonitorNeutronAgentsDaemon(Daemon):
             LOG.info('Moving router %s from %s to %s' %
                      (router_id, routers[router_id], l3_agents[agent]))
             try:
-                quantum.remove_router_from_l3_agent(l3_agent=routers[router_id],
-                                                    router_id=router_id)
+                quantum.remove_router_from_l3_agent(
+                    l3_agent=routers[router_id], router_id=router_id)
             except exceptions.NeutronException as e:
                 LOG.error('Remove router raised exception: %s' % e)
             try:
@@ -234,10 +536,13 @@ class MonitorNeutronAgentsDaemon(Daemon):
             except exceptions.NeutronException as e:
                 LOG.error('Add router raised exception: %s' % e)
             index += 1
+            self.touch_status()
+        self.record_failover_events(routers)
+        return True
 
     def dhcp_agents_reschedule(self, dhcp_agents, networks, quantum):
-        if not self.validate_reschedule():
-            return
+        if not self.is_lead_node():
+            return False
 
         index = 0
         for network_id in networks:
@@ -256,13 +561,77 @@ class MonitorNeutronAgentsDaemon(Daemon):
             except exceptions.NeutronException as e:
                 LOG.error('Add network raised exception: %s' % e)
             index += 1
+            self.touch_status()
+        self.record_failover_events(networks)
+        return True
+
+    def list_hosted(self, kind, agent_id, env):
+        """List the resources hosted by an agent with the calling worker
+        thread's own client, neutron clients not being thread safe."""
+        worker = self.workers
+        if getattr(worker, 'env', None) is not env:
+            worker.discovery = AgentDiscovery(self.make_client(env),
+                                              stats=self.api_stats,
+                                              lock=self.api_lock)
+            worker.env = env
+        if kind == 'dhcp':
+            return worker.discovery.networks_on_dhcp_agent(agent_id)
+        return worker.discovery.routers_on_l3_agent(agent_id)
+
+    def collect_inventory(self, agents):
+        """Fetch the networks and routers hosted by agents concurrently.
+
+        agents is a list of (agent, down, kind) tuples, kind being 'dhcp'
+        or 'l3'. Only down agents and agents on this host are queried, as
+        nobody else's inventory is acted on, and down agents are queued
+        first. Lookups still running when inventory_deadline expires are
+        dropped from this cycle but not submitted again until they finish,
+        the client timeout bounding how long they hold a worker.
+
+        Returns a dict of (kind, agent id) to the hosted resources."""
+        start = time.time()
+        env = self.get_env()
+        wanted = [(agent, down, kind) for agent, down, kind in agents
+                  if down or self.is_same_host(agent['host'])]
+        wanted.sort(key=lambda a: not a[1])
+        pool = self.get_pool()
+        pending = []
+        for agent, down, kind in wanted:
+            resource = (kind, agent['id'])
+            result = self.inflight.get(resource)
+            if not result or result.ready():
+                result = pool.apply_async(self.list_hosted,
+                                          (kind, agent['id'], env))
+                self.inflight[resource] = result
+            pending.append((resource, result))
+
+        deadline = start + float(cfg.CONF.inventory_deadline)
+        inventory = {}
+        for resource, result in pending:
+            try:
+                inventory[resource] = result.get(
+                    max(0, deadline - time.time()))
+            except TimeoutError:
+                LOG.error('Inventory of %s agent %s not collected within '
+                          '%ss' % (resource[0], resource[1],
+                                   cfg.CONF.inventory_deadline))
+            except Exception as e:
+                LOG.error('Failed to list resources of %s agent %s, %s' %
+                          (resource[0], resource[1], e))
+        self.inflight = dict((resource, result) for resource, result
+                             in self.inflight.items() if not result.ready())
+        LOG.info('Collected inventory of %d/%d agents in %.2fs' %
+                 (len(inventory), len(pending), time.time() - start))
+        return inventory
 
     def get_quantum_client(self):
         env = self.get_env()
         if not env:
             LOG.info('Unable to re-assign resources at this time')
             return None
+        return self.make_client(env)
 
+    def make_client(self, env):
         try:
             from quantumclient.v2_0 import client
         except ImportError:
@@ -275,11 +644,54 @@ class MonitorNeutronAgentsDaemon(Daemon):
                                 password=env['service_password'],
                                 tenant_name=env['service_tenant'],
                                 auth_url=auth_url,
-                                region_name=env['region'])
-        return quantum
+                                region_name=env['region'],
+                                timeout=float(cfg.CONF.api_timeout))
+        return CountingClient(quantum, self.api_calls, self.api_lock)
+
+    def write_status(self, start, duration, api_calls):
+        """Publish the state of the last cycle to status_file, which nrpe
+        reports on."""
+        self.status = {
+            'last_cycle': start,
+            'cycle_duration': duration,
+            'check_interval': float(cfg.CONF.check_interval),
+            'cycle_api_calls': api_calls,
+            'api_calls': dict(self.api_calls),
+            'api_stats': self.api_stats,
+            'failovers': self.failovers,
+            'failover_events': self.failover_events,
+            'down_agents': sorted(self.detected),
+            'tunnel_latency': self.tunnel_latency,
+        }
+        self.touch_status()
+
+    def touch_status(self):
+        """Atomically rewrite status_file with the pid of the daemon and the
+        system uptime now, on one line.
+
+        This is done after each cycle and while a long reassignment is in
+        progress. The OCF agent checks the pid is alive and the uptime is
+        recent using only shell builtins."""
+        if not cfg.CONF.status_file:
+            return
+        tmp = '%s.tmp' % cfg.CONF.status_file
+        try:
+            with open('/proc/uptime') as f:
+                uptime = int(float(f.read().split()[0]))
+            self.status.update({'pid': os.getpid(), 'uptime': uptime})
+            # The daemon runs with a umask of 0
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(self.status) + '\n')
+            os.rename(tmp, cfg.CONF.status_file)
+        except (IOError, OSError) as e:
+            LOG.error('Failed to write status file, (%s)' % e)
 
     def reassign_agent_resources(self, quantum=None):
         """Use agent scheduler API to detect down agents and re-schedule"""
+        # Only agents seen this cycle have fresh heartbeats to supervise by
+        self.local_agents = []
         if not quantum:
             LOG.error('Failed to get quantum client.')
             return
@@ -287,44 +699,59 @@ class MonitorNeutronAgentsDaemon(Daemon):
         try:
             DHCP_AGENT = "DHCP Agent"
             L3_AGENT = "L3 Agent"
-            agents = quantum.list_agents(agent_type=DHCP_AGENT)
+            discovery = AgentDiscovery(quantum, stats=self.api_stats,
+                                       lock=self.api_lock)
+            dhcp_agent_list = discovery.agents(agent_type=DHCP_AGENT)
+            l3_agent_list = discovery.agents(agent_type=L3_AGENT)
         except exceptions.NeutronException as e:
             LOG.error('Failed to get quantum agents, %s' % e)
             return
 
+        # Query pacemaker at most once per cycle
+        self.cluster = None
+        self.local_agents = [
+            agent for agent in dhcp_agent_list + l3_agent_list
+            if self.is_same_host(agent['host'])]
+        dhcp_down = [self.is_agent_down(agent) for agent in dhcp_agent_list]
+        l3_down = [self.is_agent_down(agent) for agent in l3_agent_list]
+        inventory = self.collect_inventory(
+            [(agent, down, 'dhcp') for agent, down in
+             zip(dhcp_agent_list, dhcp_down)] +
+            [(agent, down, 'l3') for agent, down in
+             zip(l3_agent_list, l3_down)])
+
         dhcp_agents = []
         l3_agents = []
         networks = {}
-        for agent in agents['agents']:
-            hosted_networks = quantum.list_networks_on_dhcp_agent(
-                agent['id'])['networks']
-            if not agent['alive']:
+        for agent, down in zip(dhcp_agent_list, dhcp_down):
+            hosted_networks = inventory.get(('dhcp', agent['id']))
+            if down:
                 LOG.info('DHCP Agent %s down' % agent['id'])
-                for network in hosted_networks:
+                for network in hosted_networks or []:
                     networks[network['id']] = agent['id']
                 if self.is_same_host(agent['host']):
                     self.cleanup_dhcp(networks)
             else:
                 dhcp_agents.append(agent['id'])
                 LOG.info('Active dhcp agents: %s' % agent['id'])
-                if not hosted_networks and self.is_same_host(agent['host']):
+                if hosted_networks == [] and \
+                        self.is_same_host(agent['host']):
                     self.cleanup_dhcp(None)
 
-        agents = quantum.list_agents(agent_type=L3_AGENT)
         routers = {}
-        for agent in agents['agents']:
-            hosted_routers = quantum.list_routers_on_l3_agent(
-                agent['id'])['routers']
-            if not agent['alive']:
+        for agent, down in zip(l3_agent_list, l3_down):
+            hosted_routers = inventory.get(('l3', agent['id']))
+            if down:
                 LOG.info('L3 Agent %s down' % agent['id'])
-                for router in hosted_routers:
+                for router in hosted_routers or []:
                     routers[router['id']] = agent['id']
                 if self.is_same_host(agent['host']):
                     self.cleanup_router(routers)
             else:
                 l3_agents.append(agent['id'])
                 LOG.info('Active l3 agents: %s' % agent['id'])
-                if not hosted_routers and self.is_same_host(agent['host']):
+                if hosted_routers == [] and \
+                        self.is_same_host(agent['host']):
                     self.cleanup_router(None)
 
         if not networks and not routers:
@@ -344,6 +771,35 @@ class MonitorNeutronAgentsDaemon(Daemon):
         if len(dhcp_agents) > 0:
             self.dhcp_agents_reschedule(dhcp_agents, networks, quantum)
 
+    def poll_tunnel_counts(self):
+        ports = subprocess.check_output(['ovs-vsctl', 'list-ports', 'br-tun'])
+        counts = {}
+        for port in ports.split():
+            tunnel_type = port.partition('-')[0]
+            if tunnel_type in TUNNEL_TYPES:
+                counts[tunnel_type] = counts.get(tunnel_type, 0) + 1
+        return counts
+
+    def tunnel_counts(self):
+        '''Tunnel type -> local port count, None while still unknown'''
+        # Started lazily so the watcher thread runs in the daemon process
+        if not self.tunnels:
+            self.tunnels = TunnelWatcher()
+        if self.tunnels.start():
+            return self.tunnels.counts()
+        return self.poll_tunnel_counts()
+
+    def record_tunnel_latency(self, tunnel_types):
+        '''Log how long tunnels took to appear after an agent restart'''
+        restarted_at, missing = self.tunnel_restart
+        appeared = [at for tunnel_type, at in self.tunnels.appeared.items()
+                    if tunnel_type in tunnel_types and at >= restarted_at] \
+            if self.tunnels else []
+        self.tunnel_latency = (min(appeared) if appeared
+                               else time.time()) - restarted_at
+        LOG.info('%s tunnels appeared %.1fs after ovs agent restart' %
+                 ('/'.join(missing), self.tunnel_latency))
+        self.tunnel_restart = None
 
     def check_ovs_tunnel(self, quantum=None):
         '''
@@ -356,68 +812,161 @@ class MonitorNeutronAgentsDaemon(Daemon):
 
         try:
             OVS_AGENT = 'Open vSwitch agent'
-            agents = quantum.list_agents(agent_type=OVS_AGENT)
+            agents = AgentDiscovery(
+                quantum, stats=self.api_stats, lock=self.api_lock).agents(
+                agent_type=OVS_AGENT, host=self.get_hostname(), alive=True,
+                configurations=True)
         except exceptions.NeutronException as e:
             LOG.error('No ovs agent found on localhost, error:%s.' % e)
             return
 
-        for agent in agents['agents']:
-            if self.is_same_host(agent['host']) and agent['alive']:
-                conf = agent['configurations']
-                if 'gre' in conf['tunnel_types'] and conf['l2_population'] \
-                        and conf['devices']:
-                    LOG.debug('local ovs agent:%s' % agent)
-                    ovs_output = subprocess.check_output(['ovs-vsctl',
-                                                          'list-ports', 'br-tun'])
-                    ports = ovs_output.strip().split('\n')
-                    look_up_gre_port = False
-                    for port in ports:
-                        if port.startswith('gre-'):
-                            look_up_gre_port = True
-                            break
-                    if not look_up_gre_port:
-                        try:
-                            LOG.error('Local agent has devices, but no ovs tunnel is created,'
-                                      'restart ovs agent.')
-                            cmd = ['sudo', 'service', 'neutron-plugin-openvswitch-agent',
-                                   'restart']
-                            subprocess.call(cmd)
-                        except subprocess.CalledProcessError:
-                            LOG.error('Failed to restart neutron-plugin-openvswitch-agent.')
+        for agent in agents:
+            conf = agent['configurations']
+            tunnel_types = [t for t in conf.get('tunnel_types', [])
+                            if t in TUNNEL_TYPES]
+            if not (tunnel_types and conf.get('l2_population') and
+                    conf.get('devices')):
+                continue
+            counts = self.tunnel_counts()
+            if counts is None:
+                continue
+            if any(counts.get(t) for t in tunnel_types):
+                if self.tunnel_restart:
+                    self.record_tunnel_latency(tunnel_types)
+                continue
+            if self.tunnel_restart and \
+                    time.time() - self.tunnel_restart[0] < \
+                    TUNNEL_RESTART_GRACE:
+                continue
+            LOG.error('Local agent has devices, but no %s tunnel is '
+                      'created, restart ovs agent.' % '/'.join(tunnel_types))
+            self.restart_service('neutron-plugin-openvswitch-agent')
+            self.tunnel_restart = (time.time(), tunnel_types)
+
+    def process_names(self, pid):
+        """Names pid is running under, covering interpreted agents."""
+        try:
+            with open('/proc/%s/cmdline' % pid) as f:
+                argv = f.read().split('\0')[:2]
+        except IOError:
+            return set()
+        # ovs daemons started with --monitor rewrite argv[0]
+        return set(os.path.basename(arg).split(':')[0]
+                   for arg in argv if arg)
+
+    def find_processes(self, names):
+        """Return the pids of the named processes that are running.
+
+        Remembered pids are checked first, so /proc is only scanned when
+        a process has been restarted or not yet been seen."""
+        found = {}
+        for name in names:
+            pid = self.pids.get(name)
+            if pid and name in self.process_names(pid):
+                found[name] = pid
+        missing = set(names) - set(found)
+        if missing:
+            for pid in os.listdir('/proc'):
+                if not pid.isdigit():
+                    continue
+                for name in self.process_names(pid) & missing:
+                    found[name] = pid
+                    missing.discard(name)
+                if not missing:
+                    break
+        self.pids = found
+        return found
+
+    def list_hung_services(self, running):
+        """Services with a running process whose local agents neutron-server
+        reports as down and whose heartbeat is older than hang_threshold.
+
+        Relies on the agents and heartbeats recorded this cycle by
+        reassign_agent_resources."""
+        threshold = self.get_hang_threshold()
+        if not threshold:
+            return {}
+        hung = {}
+        now = time.time()
+        for agent in self.local_agents:
+            service = AGENT_SERVICES.get(agent['agent_type'])
+            if not service or agent['alive']:
+                continue
+            if not all(name in running for name in
+                       dict(SUPERVISED_SERVICES)[service]):
+                continue
+            last = self.heartbeats.get(agent['id'])
+            if last and now - last[1] > threshold:
+                hung.setdefault(service, []).append(agent['id'])
+        return hung
+
+    def may_restart_hung(self, service):
+        """Back off exponentially between restarts of a service that stays
+        hung, so an outage stopping all heartbeats cannot cause a restart
+        loop."""
+        count, last = self.hang_restarts.get(service, (0, None))
+        if not count:
+            return True
+        backoff = min(self.get_hang_threshold() * 2 ** (count - 1),
+                      HANG_RESTART_BACKOFF_MAX)
+        return time.time() - last >= backoff
+
+    def restart_service(self, service, action='restart'):
+        LOG.error('Restart service: %s' % service)
+        try:
+            subprocess.check_output(['sudo', 'service', service, action])
+        except subprocess.CalledProcessError as e:
+            LOG.error('Failed to %s %s, (%s)' % (action, service, e))
 
     def check_local_agents(self):
-        services = ['openvswitch-switch', 'neutron-dhcp-agent',
-                    'neutron-metadata-agent', 'neutron-vpn-agent']
-        for s in services:
-            status = ['sudo', 'service', s, 'status']
-            restart = ['sudo', 'service', s, 'restart']
-            start = ['sudo', 'service', s, 'start']
-            stop = '%s stop/waiting' % s
-            try:
-                output = subprocess.check_output(status)
-                if output.strip() == stop:
-                    subprocess.check_output(start)
-                    LOG.error('Restart service: %s' % s)
-                    if s == 'neutron-metadata-agent':
-                        subprocess.check_output(['sudo', 'service',
-                                                 'neutron-vpn-agent',
-                                                 'restart'])
-                        LOG.error('Restart neutron-vpn-agent')
-            except subprocess.CalledProcessError:
-                LOG.error('Restart service: %s' % s)
-                subprocess.check_output(restart)
-                if s == 'neutron-metadata-agent':
-                    subprocess.check_output(['sudo', 'service',
-                                             'neutron-vpn-agent',
-                                             'restart'])
+        """Restart local services that are not running or are hung.
+
+        Liveness comes from /proc rather than forking service status
+        probes; a service is hung when its agents are down and their
+        heartbeat is stale."""
+        running = self.find_processes(
+            [name for _, names in SUPERVISED_SERVICES for name in names])
+        hung = self.list_hung_services(running)
+        for service in AGENT_SERVICES.values():
+            if service not in hung and all(
+                    agent['alive'] for agent in self.local_agents
+                    if AGENT_SERVICES.get(agent['agent_type']) == service):
+                self.hang_restarts.pop(service, None)
+        for service, names in SUPERVISED_SERVICES:
+            if service in hung:
+                if not self.may_restart_hung(service):
+                    continue
+                LOG.error('%s running but agents %s report no heartbeat' %
+                          (service, ', '.join(hung[service])))
+                self.restart_service(service)
+                count, _ = self.hang_restarts.get(service, (0, None))
+                self.hang_restarts[service] = (count + 1, time.time())
+                # Time the fresh process from now rather than the hang
+                for agent_id in hung[service]:
+                    self.heartbeats.pop(agent_id, None)
+            elif not all(name in running for name in names):
+                self.restart_service(service, 'start' if not any(
+                    name in running for name in names) else 'restart')
+            else:
+                continue
+            if service == 'neutron-metadata-agent':
+                self.restart_service('neutron-vpn-agent')
 
     def run(self):
+        # Show the OCF agent the daemon is up before the first cycle ends
+        self.touch_status()
         while True:
             LOG.info('Monitor Neutron HA Agent Loop Start')
+            start = time.time()
+            api_calls = sum(self.api_calls.values())
             quantum = self.get_quantum_client()
             self.reassign_agent_resources(quantum=quantum)
             self.check_ovs_tunnel(quantum=quantum)
             self.check_local_agents()
+            duration = time.time() - start
+            LOG.info('Monitor cycle took %.2fs' % duration)
+            self.write_status(start, duration,
+                              sum(self.api_calls.values()) - api_calls)
             LOG.info('sleep %s' % cfg.CONF.check_interval)
             time.sleep(float(cfg.CONF.check_interval))
 
@@ -427,6 +976,31 @@ if __name__ == '__main__':
         cfg.StrOpt('check_interval',
                    default=8,
                    help='Check Neutron Agents interval.'),
+        cfg.StrOpt('heartbeat_threshold',
+                   default=60,
+                   help='Seconds without a new agent heartbeat before the '
+                        'agent is suspected, 0 to disable.'),
+        cfg.StrOpt('hang_threshold',
+                   default=300,
+                   help='Seconds a running local agent may be reported down '
+                        'without a new heartbeat before it is restarted as '
+                        'hung, 0 to disable.'),
+        cfg.StrOpt('failover_event_log',
+                   default='/var/log/neutron-ha/failover-events.log',
+                   help='File failover latency records are appended to.'),
+        cfg.StrOpt('inventory_workers',
+                   default=8,
+                   help='Number of agent inventory lookups run at once.'),
+        cfg.StrOpt('inventory_deadline',
+                   default=5,
+                   help='Seconds each cycle waits for agent inventory '
+                        'lookups.'),
+        cfg.StrOpt('api_timeout',
+                   default=30,
+                   help='Seconds before a neutron API request is abandoned.'),
+        cfg.StrOpt('status_file',
+                   default='/var/lib/juju-neutron-ha/monitor-status.json',
+                   help='File the state of the last cycle is published to.'),
     ]
 
     cfg.CONF.register_cli_opts(opts)
@@ -1,18 +1,20 @@
 # vim: set ts=4:et
 import os
 import uuid
-import socket
 from charmhelpers.core.hookenv import (
     config,
+    log,
     unit_get,
-    cached
-)
-from charmhelpers.fetch import (
-    apt_install,
+    cached,
+    relation_ids,
+    related_units,
+    relation_get,
+    WARNING,
 )
 from charmhelpers.contrib.openstack.context import (
     OSContextGenerator,
     NeutronAPIContext,
+    WorkerConfigContext,
     config_flags_parser,
     AppArmorContext,
 )
@@ -22,6 +24,10 @@ from charmhelpers.contrib.hahelpers.cluster import(
 from charmhelpers.contrib.network.ip import (
     get_address_in_network,
 )
+from charmhelpers.contrib.openstack.utils import (
+    get_os_codename_install_source,
+)
+from neutron_dns import resolve_host_ip
 
 NEUTRON_ML2_PLUGIN = "ml2"
 NEUTRON_N1KV_PLUGIN = \
@@ -43,6 +49,24 @@ CORE_PLUGIN = {
     OVS_ODL: NEUTRON_OVS_ODL_PLUGIN,
 }
 
+IPTABLES_HYBRID = 'iptables_hybrid'
+OPENVSWITCH = 'openvswitch'
+NOOP = 'noop'
+
+FIREWALL_DRIVERS = [IPTABLES_HYBRID, OPENVSWITCH, NOOP]
+
+VRRP_AUTH_TYPES = ['PASS', 'AH']
+
+VSCTL = 'vsctl'
+OVS_OFCTL = 'ovs-ofctl'
+NATIVE = 'native'
+# First release supporting the native interface of each OVS agent option
+OVSDB_INTERFACES = {VSCTL: None, NATIVE: 'liberty'}
+OF_INTERFACES = {OVS_OFCTL: None, NATIVE: 'mitaka'}
+# Local ovsdb-server manager the native OVSDB interface connects to
+OVSDB_MANAGER = 'ptcp:6640:127.0.0.1'
+OVSDB_CONNECTION = 'tcp:127.0.0.1:6640'
+
 NEUTRON_DHCP_AA_PROFILE = 'usr.bin.neutron-dhcp-agent'
 NEUTRON_L3_AA_PROFILE = 'usr.bin.neutron-l3-agent'
 NEUTRON_LBAAS_AA_PROFILE = 'usr.bin.neutron-lbaas-agent'
@@ -55,6 +79,57 @@ def core_plugin():
     return CORE_PLUGIN[config('plugin')]
 
 
+def firewall_driver():
+    '''Return the configured security group firewall driver shortname'''
+    driver = config('firewall-driver') or IPTABLES_HYBRID
+    if driver not in FIREWALL_DRIVERS:
+        log('Unsupported firewall-driver %s, using %s' %
+            (driver, IPTABLES_HYBRID), level=WARNING)
+        driver = IPTABLES_HYBRID
+    return driver
+
+
+def ovs_interface(option, interfaces, default, release):
+    '''Return the interface selected by option if release supports it,
+    otherwise default'''
+    interface = config(option) or default
+    if interface not in interfaces:
+        log('Unsupported %s %s, using %s' % (option, interface, default),
+            level=WARNING)
+        return default
+    min_release = interfaces[interface]
+    if min_release and release < min_release:
+        log('%s %s requires %s or later, using %s' %
+            (option, interface, min_release, default), level=WARNING)
+        return default
+    return interface
+
+
+def ovsdb_interface(release=None):
+    '''Return the OVSDB interface the OVS agent should use'''
+    release = release or get_os_codename_install_source(
+        config('openstack-origin'))
+    return ovs_interface('ovsdb-interface', OVSDB_INTERFACES, VSCTL, release)
+
+
+class OVSInterfaceContext(OSContextGenerator):
+    '''OVSDB and OpenFlow interfaces used by the OVS agent, falling back
+    to ovs-vsctl and ovs-ofctl on releases without native support'''
+
+    def __call__(self):
+        release = get_os_codename_install_source(config('openstack-origin'))
+        ctxt = {}
+        if release >= 'liberty':
+            ctxt['ovsdb_interface'] = ovsdb_interface(release)
+            if ctxt['ovsdb_interface'] == NATIVE:
+                ctxt['ovsdb_connection'] = OVSDB_CONNECTION
+        if release >= 'mitaka':
+            ctxt['of_interface'] = ovs_interface('of-interface',
+                                                 OF_INTERFACES, OVS_OFCTL,
+                                                 release)
+        return ctxt
+
+
 class L3AgentContext(OSContextGenerator):
 
     def __call__(self):
@@ -77,6 +152,20 @@ class L3AgentContext(OSContextGenerator):
             ctxt['agent_mode'] = 'dvr_snat'
         else:
             ctxt['agent_mode'] = 'legacy'
+
+        ctxt['send_arp_for_ha'] = config('send-arp-for-ha')
+        ctxt['periodic_fuzzy_delay'] = config('periodic-fuzzy-delay')
+        if api_settings.get('enable_l3ha'):
+            ctxt['ha_vrrp_advert_int'] = config('ha-vrrp-advert-int')
+            if config('ha-vrrp-auth-password'):
+                auth_type = config('ha-vrrp-auth-type')
+                if auth_type not in VRRP_AUTH_TYPES:
+                    log('Unsupported ha-vrrp-auth-type %s, using PASS' %
+                        auth_type, level=WARNING)
+                    auth_type = 'PASS'
+                ctxt['ha_vrrp_auth_type'] = auth_type
+                ctxt['ha_vrrp_auth_password'] = \
+                    config('ha-vrrp-auth-password')
         return ctxt
 
 
@@ -99,6 +188,8 @@ class NeutronGatewayContext(NeutronAPIContext):
             'enable_l3ha': api_settings['enable_l3ha'],
             'overlay_network_type':
             api_settings['overlay_network_type'],
+            'firewall_driver': firewall_driver(),
+            'rootwrap_daemon': config('rootwrap-daemon'),
         }
 
         mappings = config('bridge-mappings')
@@ -125,22 +216,104 @@ class NeutronGatewayContext(NeutronAPIContext):
         return ctxt
 
 
+class DHCPAgentContext(OSContextGenerator):
+    '''Scaling settings for the DHCP agent and dnsmasq'''
+
+    MIN_SYNC_THREADS = 4
+
+    def __call__(self):
+        ctxt = {
+            'num_sync_threads': (config('dhcp-num-sync-threads') or
+                                 max(self.MIN_SYNC_THREADS,
+                                     WorkerConfigContext().num_cpus)),
+        }
+
+        lease_duration = config('dhcp-lease-duration')
+        if not lease_duration:
+            lease_duration = 3600 if config('plugin') == N1KV else 86400
+        ctxt['dhcp_lease_duration'] = lease_duration
+
+        if config('dnsmasq-lease-max'):
+            ctxt['dnsmasq_lease_max'] = config('dnsmasq-lease-max')
+
+        dns_servers = config('dnsmasq-dns-servers')
+        if dns_servers:
+            ctxt['dnsmasq_dns_servers'] = ','.join(dns_servers.split())
+
+        return ctxt
+
+
+class MetadataAgentContext(OSContextGenerator):
+    '''Cache, worker and proxy settings for the metadata service path'''
+
+    MIN_BACKLOG = 4096
+
+    def __call__(self):
+        workers = config('metadata-workers') or WorkerConfigContext().num_cpus
+        ctxt = {
+            'metadata_cache_ttl': config('metadata-cache-ttl'),
+            'metadata_workers': workers,
+            'metadata_backlog': (config('metadata-backlog') or
+                                 max(self.MIN_BACKLOG, workers * 512)),
+            'metadata_keep_alive': config('metadata-keep-alive'),
+            'nova_metadata_insecure': config('nova-metadata-insecure'),
+        }
+
+        memcached_servers = []
+        for rid in relation_ids('memcache'):
+            for unit in related_units(rid):
+                host = relation_get('host', rid=rid, unit=unit)
+                port = relation_get('port', rid=rid, unit=unit)
+                if host and port:
+                    memcached_servers.append('%s:%s' % (host, port))
+        if memcached_servers:
+            ctxt['memcached_servers'] = ','.join(sorted(memcached_servers))
+
+        return ctxt
+
+
+def get_report_interval():
+    '''Seconds between agent state reports, derived from agent-down-time
+    unless report-interval is set'''
+    return (config('report-interval') or
+            max(int(config('agent-down-time') / 2.5), 1))
+
+
+class MessagingTuningContext(OSContextGenerator):
+    '''RPC and messaging settings for the gateway agents.
+
+    Pool sizes scale with the number of CPUs on the unit and the agent
+    report and heartbeat intervals are aligned with agent_down_time on
+    neutron-server unless explicitly configured.'''
+
+    MIN_CONN_POOL_SIZE = 30
+    MIN_THREAD_POOL_SIZE = 64
+
+    def __call__(self):
+        num_cpus = WorkerConfigContext().num_cpus
+        report_interval = get_report_interval()
+
+        heartbeat = config('rabbit-heartbeat-timeout-threshold')
+        if heartbeat is None:
+            heartbeat = report_interval * 2
+
+        ctxt = {
+            'rpc_response_timeout': config('rpc-response-timeout'),
+            'rpc_conn_pool_size': (config('rpc-conn-pool-size') or
+                                   max(self.MIN_CONN_POOL_SIZE,
+                                       num_cpus * 4)),
+            'rpc_thread_pool_size': (config('rpc-thread-pool-size') or
+                                     max(self.MIN_THREAD_POOL_SIZE,
+                                         num_cpus * 8)),
+            'report_interval': report_interval,
+            'rabbit_heartbeat_timeout_threshold': heartbeat,
+        }
+        return ctxt
+
+
 @cached
 def get_host_ip(hostname=None):
-    try:
-        import dns.resolver
-    except ImportError:
-        apt_install('python-dnspython', fatal=True)
-        import dns.resolver
-    hostname = hostname or unit_get('private-address')
-    try:
-        # Test to see if already an IPv4 address
-        socket.inet_aton(hostname)
-        return hostname
-    except socket.error:
-        answers = dns.resolver.query(hostname, 'A')
-        if answers:
-            return answers[0].address
+    return resolve_host_ip(hostname or unit_get('private-address'))
 
 
 SHARED_SECRET = "/etc/{}/secret.txt"
@@ -169,7 +342,10 @@ class NeutronDHCPAppArmorContext(AppArmorContext):
         super(NeutronDHCPAppArmorContext, self).__call__()
         if not self.ctxt:
             return self.ctxt
-        self._ctxt.update({'aa-profile': self.aa_profile})
+        # aa-enforce rewrites the complain flag out of the profile, so it is
+        # only left out in enforce mode to keep the file as applied
+        self._ctxt.update({'aa-profile': self.aa_profile,
+                           'aa_profile_mode': self._ctxt['aa-profile-mode']})
         return self.ctxt
 
 
@@ -183,7 +359,8 @@ class NeutronL3AppArmorContext(AppArmorContext):
         super(NeutronL3AppArmorContext, self).__call__()
         if not self.ctxt:
             return self.ctxt
-        self._ctxt.update({'aa-profile': self.aa_profile})
+        self._ctxt.update({'aa-profile': self.aa_profile,
+                           'aa_profile_mode': self._ctxt['aa-profile-mode']})
         return self.ctxt
 
 
@@ -197,7 +374,8 @@ class NeutronLBAASAppArmorContext(AppArmorContext):
         super(NeutronLBAASAppArmorContext, self).__call__()
         if not self.ctxt:
             return self.ctxt
-        self._ctxt.update({'aa-profile': self.aa_profile})
+        self._ctxt.update({'aa-profile': self.aa_profile,
+                           'aa_profile_mode': self._ctxt['aa-profile-mode']})
         return self.ctxt
 
 
@@ -211,7 +389,8 @@ class NeutronMetadataAppArmorContext(AppArmorContext):
         super(NeutronMetadataAppArmorContext, self).__call__()
         if not self.ctxt:
             return self.ctxt
-        self._ctxt.update({'aa-profile': self.aa_profile})
+        self._ctxt.update({'aa-profile': self.aa_profile,
+                           'aa_profile_mode': self._ctxt['aa-profile-mode']})
         return self.ctxt
 
 
@@ -225,7 +404,8 @@ class NeutronMeteringAppArmorContext(AppArmorContext):
         super(NeutronMeteringAppArmorContext, self).__call__()
         if not self.ctxt:
             return self.ctxt
-        self._ctxt.update({'aa-profile': self.aa_profile})
+        self._ctxt.update({'aa-profile': self.aa_profile,
+                           'aa_profile_mode': self._ctxt['aa-profile-mode']})
         return self.ctxt
 
 
@@ -239,5 +419,6 @@ class NovaAPIMetadataAppArmorContext(AppArmorContext):
         super(NovaAPIMetadataAppArmorContext, self).__call__()
         if not self.ctxt:
             return self.ctxt
-        self._ctxt.update({'aa-profile': self.aa_profile})
+        self._ctxt.update({'aa-profile': self.aa_profile,
+                           'aa_profile_mode': self._ctxt['aa-profile-mode']})
         return self.ctxt
@@ -0,0 +1,102 @@
+'''
+Lightweight agent and resource discovery against the neutron API.
+
+Shared by the charm hooks and neutron-ha-monitor, which is installed next
+to this module, so it must only depend on the standard library and the
+neutron client passed in.
+'''
+import json
+import threading
+import time
+
+# Agent attributes needed to place and fail over resources; the large
+# configurations blob is only fetched when asked for
+AGENT_FIELDS = ['id', 'host', 'agent_type', 'alive', 'admin_state_up',
+                'heartbeat_timestamp']
+ROUTER_FIELDS = ['id', 'ha']
+NETWORK_FIELDS = ['id']
+PAGE_SIZE = 500
+
+
+class AgentDiscovery(object):
+    '''
+    Field-projected, server-side filtered and paginated listings of agents
+    and the routers and networks they host, counting the calls, response
+    bytes and seconds spent per API method.
+
+    Filters the API cannot apply (alive is computed by neutron-server) are
+    applied locally. Servers without pagination or field selection ignore
+    those parameters and return everything, which is handled too. Clients
+    that follow pagination links themselves return everything at once.
+    '''
+
+    def __init__(self, client, page_size=PAGE_SIZE, stats=None, lock=None):
+        self.client = client
+        self.page_size = page_size
+        # method -> {'calls': n, 'bytes': n, 'seconds': n}, which may be
+        # shared between instances along with the lock guarding it
+        self.stats = {} if stats is None else stats
+        self.lock = threading.Lock() if lock is None else lock
+
+    def _call(self, method, *args, **params):
+        start = time.time()
+        result = getattr(self.client, method)(*args, **params)
+        elapsed = time.time() - start
+        size = len(json.dumps(result, default=str))
+        with self.lock:
+            stats = self.stats.setdefault(
+                method, {'calls': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += elapsed
+        return result
+
+    def _list(self, method, key, **params):
+        params['limit'] = self.page_size
+        items = []
+        seen = set()
+        while True:
+            result = self._call(method, **params)
+            page = result[key]
+            new = [item for item in page if item['id'] not in seen]
+            items.extend(new)
+            seen.update(item['id'] for item in new)
+            # Only a page with a next link is followed; one larger than the
+            # limit means the server ignored it and returned everything
+            links = result.get('%s_links' % key) or []
+            if (len(page) > self.page_size or not new or
+                    not any(link.get('rel') == 'next' for link in links)):
+                return items
+            params['marker'] = page[-1]['id']
+
+    def agents(self, agent_type=None, host=None, alive=None,
+               admin_state_up=None, configurations=False):
+        '''Return agents matching the filters with only AGENT_FIELDS, plus
+        configurations if asked for'''
+        params = {'fields': AGENT_FIELDS + (['configurations']
+                                            if configurations else [])}
+        if agent_type:
+            params['agent_type'] = agent_type
+        if host:
+            params['host'] = host
+        if admin_state_up is not None:
+            params['admin_state_up'] = admin_state_up
+        agents = self._list('list_agents', 'agents', **params)
+        if alive is not None:
+            agents = [a for a in agents if bool(a.get('alive')) == alive]
+        return agents
+
+    def routers_on_l3_agent(self, agent_id):
+        return self._call('list_routers_on_l3_agent', agent_id,
+                          fields=ROUTER_FIELDS)['routers']
+
+    def networks_on_dhcp_agent(self, agent_id):
+        return self._call('list_networks_on_dhcp_agent', agent_id,
+                          fields=NETWORK_FIELDS)['networks']
+
+    def summary(self):
+        '''One line per API method of calls, bytes and seconds'''
+        with self.lock:
+            return ['%s: %d calls, %d bytes, %.2fs' %
+                    (method, s['calls'], s['bytes'], s['seconds'])
+                    for method, s in sorted(self.stats.items())]
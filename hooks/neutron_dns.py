@@ -0,0 +1,126 @@
+import socket
+import time
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+)
+from charmhelpers.core.unitdata import kv
+from charmhelpers.fetch import apt_install
+from charmhelpers.contrib.network.ip import is_ip
+
+DNS_CACHE_KEY = 'neutron-gateway.dns-cache'
+# TTL used when the answer does not carry one, and the bounds applied to
+# every positive answer so a bad record cannot pin the cache forever
+DEFAULT_TTL = 300
+MIN_TTL = 30
+MAX_TTL = 3600
+# How long a failed lookup is remembered before DNS is queried again
+NEGATIVE_TTL = 60
+
+
+class DNSLookupError(Exception):
+    '''Raised when a name cannot be resolved, including cached failures'''
+    pass
+
+
+def _dns():
+    try:
+        import dns.resolver
+        import dns.reversename
+    except ImportError:
+        apt_install('python-dnspython', fatal=True)
+        import dns.resolver
+        import dns.reversename
+    return dns
+
+
+def _answer_ttl(answers):
+    ttl = getattr(getattr(answers, 'rrset', None), 'ttl', None)
+    if not isinstance(ttl, int):
+        return DEFAULT_TTL
+    return max(MIN_TTL, min(ttl, MAX_TTL))
+
+
+def cache_get(rtype, name):
+    '''Return (True, value) for an unexpired cache entry, value being None
+    for a cached failure, else (False, None)'''
+    entry = (kv().get(DNS_CACHE_KEY) or {}).get('%s:%s' % (rtype, name))
+    if entry and entry[1] > time.time():
+        return True, entry[0]
+    return False, None
+
+
+def cache_set(rtype, name, value, ttl):
+    '''Record value, or a failure if None, for ttl seconds'''
+    db = kv()
+    now = time.time()
+    cache = dict((k, v) for k, v in (db.get(DNS_CACHE_KEY) or {}).items()
+                 if v[1] > now)
+    cache['%s:%s' % (rtype, name)] = [value, now + ttl]
+    db.set(DNS_CACHE_KEY, cache)
+    db.flush()
+
+
+def resolve_host_ip(hostname):
+    '''
+    Resolve the IPv4 address of hostname, returning literal addresses
+    as is and caching answers across hooks for their TTL.
+
+    :raises: DNSLookupError if hostname does not resolve
+    '''
+    if is_ip(hostname):
+        return hostname
+    hit, address = cache_get('A', hostname)
+    if hit:
+        if address is None:
+            raise DNSLookupError('%s did not resolve (cached)' % hostname)
+        return address
+    dns = _dns()
+    try:
+        answers = dns.resolver.query(hostname, 'A')
+    except Exception as e:
+        log('Unable to resolve %s: %s' % (hostname, e), level=DEBUG)
+        cache_set('A', hostname, None, NEGATIVE_TTL)
+        raise DNSLookupError('%s did not resolve: %s' % (hostname, e))
+    if not answers:
+        cache_set('A', hostname, None, NEGATIVE_TTL)
+        raise DNSLookupError('%s has no A records' % hostname)
+    address = answers[0].address
+    cache_set('A', hostname, address, _answer_ttl(answers))
+    return address
+
+
+def get_hostname(address, fqdn=True):
+    '''
+    Resolve the hostname of address, returning the input if it is already
+    a hostname and None if it does not resolve. Answers, including
+    failures, are cached across hooks.
+    '''
+    if not is_ip(address):
+        hostname = address
+    else:
+        hit, hostname = cache_get('PTR', address)
+        if not hit:
+            hostname, ttl = _reverse_lookup(address)
+            cache_set('PTR', address, hostname, ttl)
+        if hostname is None:
+            return None
+    if fqdn:
+        return hostname[:-1] if hostname.endswith('.') else hostname
+    return hostname.split('.')[0]
+
+
+def _reverse_lookup(address):
+    dns = _dns()
+    try:
+        answers = dns.resolver.query(dns.reversename.from_address(address),
+                                     'PTR')
+        if answers:
+            return str(answers[0]), _answer_ttl(answers)
+    except Exception as e:
+        log('Reverse lookup of %s failed: %s' % (address, e), level=DEBUG)
+    try:
+        return socket.gethostbyaddr(address)[0], DEFAULT_TTL
+    except Exception:
+        return None, NEGATIVE_TTL
@@ -10,7 +10,6 @@ from charmhelpers.core.hookenv import (
     relation_ids,
     Hooks,
     UnregisteredHookError,
-    status_set,
 )
 from charmhelpers.fetch import (
     apt_update,
@@ -19,7 +18,6 @@ from charmhelpers.fetch import (
     apt_purge,
 )
 from charmhelpers.core.host import (
-    restart_on_change,
     lsb_release,
 )
 from charmhelpers.contrib.hahelpers.cluster import(
@@ -34,7 +32,6 @@ from charmhelpers.contrib.openstack.utils import (
     configure_installation_source,
     openstack_upgrade_available,
     os_requires_version,
-    set_os_workload_status,
 )
 from charmhelpers.payload.execd import execd_preinstall
 from charmhelpers.core.sysctl import create as create_sysctl
@@ -64,35 +61,39 @@ from neutron_utils import (
     reassign_agent_resources,
     stop_neutron_ha_monitor_daemon,
     use_l3ha,
-    REQUIRED_INTERFACES,
-    check_optional_relations,
+    assess_status,
+    restart_on_change,
+    run_config_stages,
+    setup_aa_profiles,
+    set_workload_status,
+    LEGACY_HA_STATUS_FILE,
     NEUTRON_COMMON,
+    NEUTRON_METADATA_AGENT_CONF,
+    NOVA_CONF,
 )
 
-from neutron_contexts import (
-    NeutronDHCPAppArmorContext,
-    NeutronL3AppArmorContext,
-    NeutronLBAASAppArmorContext,
-    NeutronMetadataAppArmorContext,
-    NeutronMeteringAppArmorContext,
-    NovaAPIMetadataAppArmorContext,
-)
+from neutron_log import install_log_sink
 
 
+if __name__ == '__main__':
+    # Buffer juju-log output for the whole hook, including that of
+    # registering configs below.
+    install_log_sink()
+
 hooks = Hooks()
 CONFIGS = register_configs()
 
 
 @hooks.hook('install.real')
 def install():
-    status_set('maintenance', 'Executing pre-install')
+    set_workload_status('maintenance', 'Executing pre-install')
     execd_preinstall()
     src = config('openstack-origin')
     if (lsb_release()['DISTRIB_CODENAME'] == 'precise' and
             src == 'distro'):
         src = 'cloud:precise-icehouse'
     configure_installation_source(src)
-    status_set('maintenance', 'Installing apt packages')
+    set_workload_status('maintenance', 'Installing apt packages')
     apt_update(fatal=True)
     apt_install('python-six', fatal=True)  # Force upgrade
     if valid_plugin():
@@ -100,12 +101,12 @@ def install():
                     fatal=True)
         apt_install(filter_installed_packages(get_packages()),
                     fatal=True)
-        status_set('maintenance', 'Git install')
+        set_workload_status('maintenance', 'Git install')
         git_install(config('openstack-origin-git'))
     else:
         message = 'Please provide a valid plugin config'
         log(message, level=ERROR)
-        status_set('blocked', message)
+        set_workload_status('blocked', message)
         sys.exit(1)
 
     # Legacy HA for Icehouse
@@ -114,32 +115,41 @@ def install():
 
 @hooks.hook('config-changed')
 @restart_on_change(restart_map())
-def config_changed():
+def config_changed(force=False):
+    run_config_stages([
+        ('upgrade', upgrade_openstack),
+        ('nrpe', update_nrpe_config),
+        ('sysctl', update_sysctl),
+        ('relations', update_relations),
+        ('configs', write_configs),
+        ('apparmor', setup_aa_profiles),
+        ('ovs', configure_ovs),
+        ('n1kv', configure_n1kv),
+        ('legacy-ha', update_legacy_ha_files),
+    ], force=force)
+
+
+def upgrade_openstack():
     global CONFIGS
     if git_install_requested():
         if config_value_changed('openstack-origin-git'):
-            status_set('maintenance', 'Running Git install')
+            set_workload_status('maintenance', 'Running Git install')
             git_install(config('openstack-origin-git'))
             CONFIGS.write_all()
 
     elif not config('action-managed-upgrade'):
         if openstack_upgrade_available(NEUTRON_COMMON):
-            status_set('maintenance', 'Running openstack upgrade')
+            set_workload_status('maintenance', 'Running openstack upgrade')
             do_openstack_upgrade(CONFIGS)
 
-    NeutronDHCPAppArmorContext().setup_aa_profile()
-    NeutronL3AppArmorContext().setup_aa_profile()
-    NeutronLBAASAppArmorContext().setup_aa_profile()
-    NeutronMetadataAppArmorContext().setup_aa_profile()
-    NeutronMeteringAppArmorContext().setup_aa_profile()
-    NovaAPIMetadataAppArmorContext().setup_aa_profile()
-
-    update_nrpe_config()
 
+def update_sysctl():
     sysctl_dict = config('sysctl')
     if sysctl_dict:
         create_sysctl(sysctl_dict, '/etc/sysctl.d/50-quantum-gateway.conf')
 
+
+def update_relations():
     # Re-run joined hooks as config might have changed
     for r_id in relation_ids('amqp'):
         amqp_joined(relation_id=r_id)
@@ -147,30 +157,32 @@ def config_changed():
         amqp_nova_joined(relation_id=r_id)
     for rid in relation_ids('zeromq-configuration'):
         zeromq_configuration_relation_joined(rid)
+
+
+def write_configs():
     if valid_plugin():
         CONFIGS.write_all()
-        configure_ovs()
     else:
         message = 'Please provide a valid plugin config'
         log(message, level=ERROR)
-        status_set('blocked', message)
+        set_workload_status('blocked', message)
         sys.exit(1)
+
+
+def configure_n1kv():
     if config('plugin') == 'n1kv':
         if not git_install_requested():
             if config('enable-l3-agent'):
-                status_set('maintenance', 'Installing apt packages')
+                set_workload_status('maintenance', 'Installing apt packages')
                 apt_install(filter_installed_packages('neutron-l3-agent'))
             else:
                 apt_purge('neutron-l3-agent')
 
-    # Setup legacy ha configurations
-    update_legacy_ha_files()
-
 
 @hooks.hook('upgrade-charm')
 def upgrade_charm():
     install()
-    config_changed()
+    config_changed(force=True)
     update_legacy_ha_files(force=True)
 
 
@@ -236,6 +248,15 @@ def nm_changed():
         cache_env_data()
 
 
+@hooks.hook('memcache-relation-changed',
+            'memcache-relation-departed',
+            'memcache-relation-broken')
+@restart_on_change(restart_map())
+def memcache_changed():
+    CONFIGS.write(NEUTRON_METADATA_AGENT_CONF)
+    CONFIGS.write(NOVA_CONF)
+
+
 @hooks.hook("cluster-relation-departed")
 @restart_on_change(restart_map())
 def cluster_departed():
@@ -299,6 +320,15 @@ def update_nrpe_config():
         description='Network Namespace check {%s}' % current_unit,
         check_cmd='check_status_file.py -f /var/lib/nagios/netns-check.txt'
     )
+    if config('ha-legacy-mode'):
+        nrpe_setup.add_check(
+            shortname='neutron-ha-monitor',
+            description='Neutron HA monitor check {%s}' % current_unit,
+            check_cmd='check_neutron_ha_monitor.py -f %s' %
+                      LEGACY_HA_STATUS_FILE
+        )
+    else:
+        nrpe_setup.remove_check(shortname='neutron-ha-monitor')
     nrpe_setup.write()
 
 
@@ -341,5 +371,4 @@ if __name__ == '__main__':
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e))
-    set_os_workload_status(CONFIGS, REQUIRED_INTERFACES,
-                           charm_func=check_optional_relations)
+    assess_status(CONFIGS)
@@ -0,0 +1,108 @@
+import atexit
+import json
+import sys
+import time
+
+import six
+
+from charmhelpers.core import hookenv
+from charmhelpers.core.hookenv import (
+    DEBUG,
+    INFO,
+    WARNING,
+    ERROR,
+    CRITICAL,
+)
+
+LEVELS = {
+    DEBUG: 10,
+    INFO: 20,
+    WARNING: 30,
+    'WARN': 30,
+    ERROR: 40,
+    CRITICAL: 50,
+}
+
+# Flush buffered messages to juju-log once they exceed this many characters
+MAX_BUFFER_SIZE = 8192
+
+
+def log_level(level):
+    '''Return the numeric priority of a juju-log level, None being INFO'''
+    return LEVELS.get(str(level or INFO).upper(), LEVELS[INFO])
+
+
+class JujuLogSink(object):
+    '''Level filtered, buffered juju-log backend.
+
+    Messages below level are dropped and the rest are coalesced into as few
+    juju-log invocations as possible, flushing on WARNING or above, when the
+    buffer exceeds max_size and on exit. If log_file is set every message,
+    regardless of level, is also appended to it as a JSON record.'''
+
+    def __init__(self, level=INFO, max_size=MAX_BUFFER_SIZE, log_file=None):
+        self.level = log_level(level)
+        self.max_size = max_size
+        self.log_file = log_file
+        self.buffer = []
+        self.size = 0
+        self.buffer_level = None
+
+    def log(self, message, level=None):
+        if not isinstance(message, six.string_types):
+            message = repr(message)
+        if self.log_file:
+            self.write_record(message, level)
+        priority = log_level(level)
+        if priority < self.level:
+            return
+        if level:
+            message = '{}: {}'.format(str(level).upper(), message)
+        self.buffer.append(message)
+        self.size += len(message)
+        if self.buffer_level is None or priority > log_level(
+                self.buffer_level):
+            self.buffer_level = level or INFO
+        if priority >= LEVELS[WARNING] or self.size >= self.max_size:
+            self.flush()
+
+    def write_record(self, message, level):
+        record = {
+            'time': time.time(),
+            'hook': hookenv.hook_name(),
+            'level': str(level or INFO).upper(),
+            'message': message,
+        }
+        try:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except IOError:
+            self.log_file = None
+
+    def flush(self):
+        '''Send buffered messages to juju-log in a single invocation'''
+        if not self.buffer:
+            return
+        message = '\n'.join(self.buffer)
+        level = self.buffer_level
+        self.buffer = []
+        self.size = 0
+        self.buffer_level = None
+        _juju_log(message, level=level)
+
+
+_juju_log = hookenv.log
+
+
+def install_log_sink():
+    '''Route juju-log output of every loaded module through a JujuLogSink
+    configured from charm config, flushing it when the hook exits'''
+    sink = JujuLogSink(level=hookenv.config('juju-log-level') or INFO,
+                       log_file=hookenv.config('debug-log-file') or None)
+    for module in list(sys.modules.values()):
+        if getattr(module, 'log', None) is _juju_log:
+            module.log = sink.log
+        if getattr(module, 'juju_log', None) is _juju_log:
+            module.juju_log = sink.log
+    atexit.register(sink.flush)
+    return sink
@@ -1,6 +1,17 @@
+import ConfigParser
+import grp
+import hashlib
 import os
+import pwd
 import shutil
+import socket
+import stat
 import subprocess
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from shutil import copy2
 from charmhelpers.core.host import (
     adduser,
@@ -8,12 +19,15 @@ from charmhelpers.core.host import (
     add_user_to_group,
     lsb_release,
     mkdir,
+    path_hash,
     service_running,
+    service_start,
     service_stop,
     service_restart,
     write_file,
 )
 from charmhelpers.core.hookenv import (
+    cached,
     charm_dir,
     log,
     DEBUG,
@@ -24,17 +38,19 @@ from charmhelpers.core.hookenv import (
     unit_private_ip,
     is_relation_made,
     relation_ids,
-    status_get,
+    hook_name,
+    status_set,
 )
 from charmhelpers.core.templating import render
+from charmhelpers.core.unitdata import kv
 from charmhelpers.fetch import (
+    apt_cache,
     apt_upgrade,
     apt_update,
     apt_install,
 )
 from charmhelpers.contrib.network.ovs import (
     add_bridge,
-    add_bridge_port,
     full_restart
 )
 from charmhelpers.contrib.hahelpers.cluster import (
@@ -47,8 +63,6 @@ from charmhelpers.contrib.openstack.utils import (
     git_clone_and_install,
     git_src_dir,
     git_pip_venv_dir,
-    get_hostname,
-    set_os_workload_status,
 )
 
 from charmhelpers.contrib.openstack.neutron import (
@@ -66,10 +80,16 @@ from charmhelpers.contrib.openstack.context import (
 )
 import charmhelpers.contrib.openstack.templating as templating
 from charmhelpers.contrib.openstack.neutron import headers_package
+from neutron_discovery import AgentDiscovery
+from neutron_dns import get_hostname
 from neutron_contexts import (
     CORE_PLUGIN, OVS, NSX, N1KV, OVS_ODL,
     NeutronGatewayContext,
     L3AgentContext,
+    DHCPAgentContext,
+    MetadataAgentContext,
+    MessagingTuningContext,
+    OVSInterfaceContext,
     NeutronDHCPAppArmorContext,
     NeutronL3AppArmorContext,
     NeutronLBAASAppArmorContext,
@@ -82,6 +102,10 @@ from neutron_contexts import (
     NEUTRON_METADATA_AA_PROFILE,
     NEUTRON_METERING_AA_PROFILE,
     NOVA_API_METADATA_AA_PROFILE,
+    NATIVE,
+    OVSDB_MANAGER,
+    ovsdb_interface,
+    get_report_interval,
 )
 from charmhelpers.contrib.openstack.neutron import (
     parse_bridge_mappings,
@@ -184,7 +208,17 @@ LEGACY_FILES_MAP = {
         'path': '/usr/lib/ocf/resource.d/canonical',
         'permissions': 0o755
     },
+    'check_neutron_ha_monitor.py': {
+        'path': '/usr/local/lib/nagios/plugins/',
+        'permissions': 0o755
+    },
+    # Imported by neutron-ha-monitor.py from its own directory
+    'neutron_discovery.py': {
+        'path': '/usr/local/bin/',
+        'source': 'hooks',
+    },
 }
+LEGACY_HA_STATUS_FILE = '/var/lib/juju-neutron-ha/monitor-status.json'
 LEGACY_RES_MAP = ['res_monitor']
 L3HA_PACKAGES = ['keepalived', 'conntrack']
 
@@ -232,6 +266,120 @@ REQUIRED_INTERFACES = {
 }
 
 
+AA_PROFILES = [
+    NEUTRON_DHCP_AA_PROFILE,
+    NEUTRON_L3_AA_PROFILE,
+    NEUTRON_LBAAS_AA_PROFILE,
+    NEUTRON_METADATA_AA_PROFILE,
+    NEUTRON_METERING_AA_PROFILE,
+    NOVA_API_METADATA_AA_PROFILE,
+]
+AA_PROFILE_MODES = ['disable', 'enforce', 'complain']
+AA_PROFILE_DIR = '/etc/apparmor.d'
+AA_PROFILE_DIGEST_KEY = 'neutron-gateway.apparmor.{}'
+
+
+# Config options each config-changed stage depends on; a stage is skipped
+# unless one of its options has changed. Stages not listed always run,
+# including ovs: link state on the data and external ports does not
+# persist across a reboot, after which config-changed runs with no option
+# changed, and configure_links skips links that are already up.
+CONFIG_STAGE_DEPENDENCIES = {
+    'upgrade': ['openstack-origin', 'openstack-origin-git',
+                'action-managed-upgrade'],
+    'nrpe': ['nagios_context', 'nagios_servicegroups', 'plugin',
+             'enable-l3-agent', 'openstack-origin', 'ha-legacy-mode'],
+    'sysctl': ['sysctl'],
+    'relations': ['rabbit-user', 'rabbit-vhost', 'nova-rabbit-user',
+                  'nova-rabbit-vhost', 'plugin', 'enable-l3-agent',
+                  'openstack-origin'],
+    'n1kv': ['plugin', 'enable-l3-agent'],
+    'legacy-ha': ['ha-legacy-mode', 'ha-heartbeat-threshold',
+                  'ha-agent-hang-threshold', 'report-interval',
+                  'agent-down-time'],
+}
+
+
+def config_stage_changed(stage):
+    '''Return True if any config option stage depends on has changed'''
+    options = CONFIG_STAGE_DEPENDENCIES.get(stage)
+    if options is None:
+        return True
+    cfg = config()
+    return any(cfg.changed(option) for option in options)
+
+
+def aa_profile_digest(profile, mode):
+    '''Return a digest of the content and mode of an AppArmor profile, or
+    None if it has not been rendered'''
+    path = os.path.join(AA_PROFILE_DIR, profile)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return hashlib.sha256(mode + f.read()).hexdigest()
+
+
+def setup_aa_profiles():
+    '''Set the mode of all AppArmor profiles with a single aa-<mode> call,
+    skipping profiles whose content and mode are unchanged since they were
+    last set'''
+    mode = config('aa-profile-mode')
+    if mode not in AA_PROFILE_MODES:
+        log('Not enabling apparmor profiles', level=DEBUG)
+        return
+    db = kv()
+    profiles = []
+    for profile in AA_PROFILES:
+        digest = aa_profile_digest(profile, mode)
+        key = AA_PROFILE_DIGEST_KEY.format(profile)
+        if digest and digest != db.get(key):
+            profiles.append(profile)
+    if not profiles:
+        log('Apparmor profiles unchanged', level=DEBUG)
+        return
+
+    apt_install(['apparmor-utils'], fatal=True)
+    log('Setting up the apparmor profiles for {} in {} mode.'
+        ''.format(', '.join(profiles), mode))
+    try:
+        subprocess.check_call(['aa-{}'.format(mode)] + profiles)
+    except subprocess.CalledProcessError:
+        if mode != 'disable':
+            set_workload_status('blocked',
+                                'Apparmor profiles {} failed to be set to {}.'
+                                ''.format(', '.join(profiles), mode))
+            raise
+        # Profiles apparmor is not yet aware of can not be disabled with
+        # aa-disable so link them into the disable directory directly.
+        log('Manually disabling the apparmor profiles.')
+        for profile in profiles:
+            link = os.path.join(AA_PROFILE_DIR, 'disable', profile)
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(AA_PROFILE_DIR, profile), link)
+
+    # The profiles are rendered with the flags for mode, so aa-<mode> leaves
+    # them as they are and the next hook finds the same digest.
+    for profile in profiles:
+        db.set(AA_PROFILE_DIGEST_KEY.format(profile),
+               aa_profile_digest(profile, mode))
+    db.flush()
+
+
+def run_config_stages(stages, force=False):
+    '''Run the (name, function) config-changed stages whose config
+    dependencies have changed, or all of them if force is set, and log
+    which ran or were skipped and how long each took'''
+    report = []
+    for stage, func in stages:
+        if not force and not config_stage_changed(stage):
+            report.append('{} skipped'.format(stage))
+            continue
+        start = time.time()
+        func()
+        report.append('{} {:.2f}s'.format(stage, time.time() - start))
+    log('config-changed stages: {}'.format(', '.join(report)), level=INFO)
+
+
 def get_early_packages():
     '''Return a list of package for pre-install based on configured plugin'''
     if config('plugin') in [OVS]:
@@ -321,7 +469,8 @@ NOVA_CONFIG_FILES = {
                           NeutronGatewayContext(),
                           SyslogContext(),
                           context.ZeroMQContext(),
-                          context.NotificationDriverContext()],
+                          context.NotificationDriverContext(),
+                          MetadataAgentContext()],
         'services': ['nova-api-metadata']
     },
     NOVA_API_METADATA_AA_PROFILE_PATH: {
@@ -332,7 +481,8 @@ NOVA_CONFIG_FILES = {
 
 NEUTRON_SHARED_CONFIG_FILES = {
     NEUTRON_DHCP_AGENT_CONF: {
-        'hook_contexts': [NeutronGatewayContext()],
+        'hook_contexts': [NeutronGatewayContext(),
+                          DHCPAgentContext()],
         'services': ['neutron-dhcp-agent']
     },
     NEUTRON_DNSMASQ_CONF: {
@@ -341,7 +491,8 @@ NEUTRON_SHARED_CONFIG_FILES = {
     },
     NEUTRON_METADATA_AGENT_CONF: {
         'hook_contexts': [NetworkServiceContext(),
-                          NeutronGatewayContext()],
+                          NeutronGatewayContext(),
+                          MetadataAgentContext()],
         'services': ['neutron-metadata-agent']
     },
     NEUTRON_DHCP_AA_PROFILE_PATH: {
@@ -373,7 +524,8 @@ NEUTRON_OVS_CONFIG_FILES = {
                           NeutronGatewayContext(),
                           SyslogContext(),
                           context.ZeroMQContext(),
-                          context.NotificationDriverContext()],
+                          context.NotificationDriverContext(),
+                          MessagingTuningContext()],
         'services': ['neutron-l3-agent',
                      'neutron-dhcp-agent',
                      'neutron-metadata-agent',
@@ -409,15 +561,15 @@ NEUTRON_OVS_CONFIG_FILES = {
         'services': ['neutron-l3-agent', 'neutron-vpn-agent']
     },
     NEUTRON_ML2_PLUGIN_CONF: {
-        'hook_contexts': [NeutronGatewayContext()],
+        'hook_contexts': [NeutronGatewayContext(), OVSInterfaceContext()],
         'services': ['neutron-plugin-openvswitch-agent']
     },
     NEUTRON_ML2_PLUGIN_CONF: {
-        'hook_contexts': [NeutronGatewayContext()],
+        'hook_contexts': [NeutronGatewayContext(), OVSInterfaceContext()],
         'services': ['neutron-plugin-openvswitch-agent']
     },
     NEUTRON_OVS_AGENT_CONF: {
-        'hook_contexts': [NeutronGatewayContext()],
+        'hook_contexts': [NeutronGatewayContext(), OVSInterfaceContext()],
         'services': ['neutron-openvswitch-agent']
     },
     EXT_PORT_CONF: {
@@ -437,7 +589,8 @@ NEUTRON_OVS_ODL_CONFIG_FILES = {
                           NeutronGatewayContext(),
                           SyslogContext(),
                           context.ZeroMQContext(),
-                          context.NotificationDriverContext()],
+                          context.NotificationDriverContext(),
+                          MessagingTuningContext()],
         'services': ['neutron-l3-agent',
                      'neutron-dhcp-agent',
                      'neutron-metadata-agent',
@@ -486,7 +639,8 @@ NEUTRON_NSX_CONFIG_FILES = {
     NEUTRON_CONF: {
         'hook_contexts': [context.AMQPContext(ssl_dir=NEUTRON_CONF_DIR),
                           NeutronGatewayContext(),
-                          SyslogContext()],
+                          SyslogContext(),
+                          MessagingTuningContext()],
         'services': ['neutron-dhcp-agent', 'neutron-metadata-agent']
     },
 }
@@ -496,7 +650,8 @@ NEUTRON_N1KV_CONFIG_FILES = {
     NEUTRON_CONF: {
         'hook_contexts': [context.AMQPContext(ssl_dir=NEUTRON_CONF_DIR),
                           NeutronGatewayContext(),
-                          SyslogContext()],
+                          SyslogContext(),
+                          MessagingTuningContext()],
         'services': ['neutron-l3-agent',
                      'neutron-dhcp-agent',
                      'neutron-metadata-agent']
@@ -525,15 +680,18 @@ SERVICE_RENAMES = {
 }
 
 
-def remap_service(service_name):
+def remap_service(service_name, release=None):
     '''
     Remap service names based on openstack release to deal
     with changes to packaging
 
     :param service_name: name of service to remap
+    :param release: openstack release codename, defaults to the release
+                    of openstack-origin
     :returns: remapped service name or original value
     '''
-    source = get_os_codename_install_source(config('openstack-origin'))
+    source = release or get_os_codename_install_source(
+        config('openstack-origin'))
     for rename_source in SERVICE_RENAMES:
         if (source >= rename_source and
                 service_name in SERVICE_RENAMES[rename_source]):
@@ -541,12 +699,14 @@ def remap_service(service_name):
     return service_name
 
 
-def resolve_config_files(plugin, release):
+def resolve_config_files(plugin, release, amqp_nova=None):
     '''
     Resolve configuration files and contexts
 
     :param plugin: shortname of plugin e.g. ovs
     :param release: openstack release codename
+    :param amqp_nova: whether the amqp-nova relation has been made, looked
+                      up if not provided
     :returns: dict of configuration files, contexts
               and associated services
     '''
@@ -562,7 +722,9 @@ def resolve_config_files(plugin, release):
             if _config in config_files[plugin]:
                 config_files[plugin].pop(_config)
 
-    if is_relation_made('amqp-nova'):
+    if amqp_nova is None:
+        amqp_nova = is_relation_made('amqp-nova')
+    if amqp_nova:
         amqp_nova_ctxt = context.AMQPContext(
             ssl_dir=NOVA_CONF_DIR,
             rel_name='amqp-nova',
@@ -576,28 +738,126 @@ def resolve_config_files(plugin, release):
     return config_files
 
 
+# Agent RPC topics to purge from the zeromq matchmaker, keyed by service
+SERVICE_TOPICS = OrderedDict([
+    ('neutron-l3-agent', ['l3_agent']),
+    ('neutron-dhcp-agent', ['dhcp_agent']),
+    ('neutron-metering-agent', ['metering_agent']),
+    ('neutron-lbaas-agent', ['n-lbaas_agent']),
+    ('neutron-plugin-openvswitch-agent', [
+        'q-agent-notifier-port-update',
+        'q-agent-notifier-network-delete',
+        'q-agent-notifier-tunnel-update',
+        'q-agent-notifier-security_group-update',
+        'q-agent-notifier-dvr-update',
+    ]),
+])
+COMMON_TOPICS = ['q-agent-notifier-l2population-update']
+
+ConfigTopology = namedtuple('ConfigTopology', [
+    'config_files', 'file_services', 'service_files', 'services', 'topics'])
+
+
+def build_config_topology(plugin, release, amqp_nova):
+    '''
+    Build the index of configuration files, services and topics deployed
+    for a plugin and release
+
+    :param plugin: shortname of plugin e.g. ovs
+    :param release: openstack release codename
+    :param amqp_nova: whether the amqp-nova relation has been made
+    :returns: ConfigTopology
+    '''
+    config_files = resolve_config_files(plugin, release, amqp_nova)[plugin]
+    file_services = {}
+    service_files = {}
+    for f, ctxt in config_files.iteritems():
+        svcs = frozenset(remap_service(svc, release)
+                         for svc in ctxt['services'])
+        if svcs:
+            file_services[f] = svcs
+        for svc in svcs:
+            service_files.setdefault(svc, set()).add(f)
+    services = frozenset(service_files)
+    topics = []
+    for svc, svc_topics in SERVICE_TOPICS.iteritems():
+        if svc in services:
+            topics.extend(svc_topics)
+    topics.extend(COMMON_TOPICS)
+    return ConfigTopology(
+        config_files=config_files,
+        file_services=file_services,
+        service_files=dict((svc, frozenset(files))
+                           for svc, files in service_files.iteritems()),
+        services=services,
+        topics=tuple(topics))
+
+
+@cached
+def _config_topology(plugin, release, amqp_nova):
+    return build_config_topology(plugin, release, amqp_nova)
+
+
+def config_topology():
+    '''
+    Return the ConfigTopology for the current plugin, release and amqp-nova
+    relation state, built at most once per hook for each combination.
+    '''
+    release = get_os_codename_install_source(config('openstack-origin'))
+    return _config_topology(config('plugin'), release,
+                            is_relation_made('amqp-nova'))
+
+
+# Results of the context generators evaluated in this hook, keyed by the
+# type and settings of the generator
+HOOK_CONTEXTS = {}
+
+
+class HookContext(object):
+    '''
+    Wraps a context generator so that it is evaluated at most once per hook.
+
+    Generators of the same type and settings registered for several config
+    files share one result, and assess_status reuses the results from
+    rendering rather than evaluating the contexts again.
+    '''
+    def __init__(self, generator):
+        self.generator = generator
+        self.key = (type(generator).__name__,
+                    repr(sorted(vars(generator).items())))
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+    def __call__(self):
+        if self.key not in HOOK_CONTEXTS:
+            ctxt = self.generator()
+            HOOK_CONTEXTS[self.key] = (
+                ctxt, getattr(self.generator, 'missing_data', []))
+        ctxt, self.generator.missing_data = HOOK_CONTEXTS[self.key]
+        return dict(ctxt) if ctxt else ctxt
+
+
+def flush_hook_contexts():
+    '''Forget the contexts evaluated so far in this hook, for when what
+    they depend on, such as the installed release, has changed'''
+    HOOK_CONTEXTS.clear()
+
+
 def register_configs():
     ''' Register config files with their respective contexts. '''
     release = get_os_codename_install_source(config('openstack-origin'))
-    plugin = config('plugin')
-    config_files = resolve_config_files(plugin, release)
+    config_files = config_topology().config_files
     configs = templating.OSConfigRenderer(templates_dir=TEMPLATES,
                                           openstack_release=release)
-    for conf in config_files[plugin]:
-        configs.register(conf,
-                         config_files[plugin][conf]['hook_contexts'])
+    for conf in config_files:
+        configs.register(conf, [HookContext(ctxt) for ctxt in
+                                config_files[conf]['hook_contexts']])
     return configs
 
 
 def stop_services():
-    release = get_os_codename_install_source(config('openstack-origin'))
-    plugin = config('plugin')
-    config_files = resolve_config_files(plugin, release)
-    svcs = set()
-    for ctxt in config_files[config('plugin')].itervalues():
-        for svc in ctxt['services']:
-            svcs.add(remap_service(svc))
-    for svc in svcs:
+    for svc in config_topology().services:
         service_stop(svc)
 
 
@@ -609,17 +869,146 @@ def restart_map():
     :returns: dict: A dictionary mapping config file to lists of services
                     that should be restarted when file changes.
     '''
+    return dict((f, list(svcs))
+                for f, svcs in config_topology().file_services.iteritems())
+
+
+def service_files(service):
+    ''' Returns the config files which service is restarted for '''
+    return list(config_topology().service_files.get(service, []))
+
+
+RESTART = 'restart'
+NO_ACTION = 'none'
+RESPAWN_DNSMASQ = 'respawn-dnsmasq'
+
+# Actions other than a full restart which apply a change to a config file
+# for a service, as {path: {service: (minimum release, action)}}. Anything
+# not listed here gets a full restart.
+CONFIG_CHANGE_ACTIONS = {
+    # The DHCP agent only passes dnsmasq.conf to the dnsmasq processes it
+    # spawns and, from Kilo, respawns them if they exit; restarting the
+    # agent would resync every network.
+    NEUTRON_DNSMASQ_CONF: {
+        'neutron-dhcp-agent': ('kilo', RESPAWN_DNSMASQ),
+    },
+}
+# AppArmor profiles are (re)loaded by setup_aa_profiles, not by restarting
+# the confined service.
+CONFIG_CHANGE_ACTIONS.update({
+    path: {'*': (None, NO_ACTION)}
+    for path in [NEUTRON_DHCP_AA_PROFILE_PATH, NEUTRON_L3_AA_PROFILE_PATH,
+                 NEUTRON_LBAAS_AA_PROFILE_PATH,
+                 NEUTRON_METADATA_AA_PROFILE_PATH,
+                 NEUTRON_METERING_AA_PROFILE_PATH,
+                 NOVA_API_METADATA_AA_PROFILE_PATH]
+})
+
+SERVICE_ACTIONS_KEY = 'neutron-gateway.service-actions'
+
+
+def config_change_action(path, service, release):
+    '''Return the action needed to apply a change to path for service'''
+    actions = CONFIG_CHANGE_ACTIONS.get(path, {})
+    min_release, action = actions.get(service,
+                                      actions.get('*', (None, RESTART)))
+    if min_release and release < min_release:
+        return RESTART
+    return action
+
+
+def dnsmasq_respawn_enabled():
+    '''Return True if the DHCP agent config has it respawn dnsmasq
+    processes that exit'''
+    parser = ConfigParser.RawConfigParser()
+    parser.read(NEUTRON_DHCP_AGENT_CONF)
+    try:
+        return (parser.get('AGENT', 'check_child_processes_action') ==
+                'respawn' and
+                parser.getint('AGENT', 'check_child_processes_interval') > 0)
+    except (ConfigParser.Error, ValueError):
+        return False
+
+
+def respawn_dnsmasq():
+    '''Terminate the dnsmasq processes spawned by the DHCP agent so that it
+    respawns them with the current dnsmasq config, within its
+    check_child_processes_interval. If the agent would not respawn them it
+    is restarted instead, which replaces each dnsmasq as it resyncs.'''
+    if not dnsmasq_respawn_enabled():
+        log('DHCP agent does not respawn dnsmasq, restarting it to apply '
+            '{}'.format(NEUTRON_DNSMASQ_CONF), level=INFO)
+        service_restart('neutron-dhcp-agent')
+        return
+    subprocess.call(['pkill', '-f', '--',
+                     '--conf-file={}'.format(NEUTRON_DNSMASQ_CONF)])
+
+
+def apply_config_changes(restart_map, changed, stopstart=False):
+    '''Apply changes to the config files in changed to the services they
+    map to in restart_map, only doing a full restart where a change needs
+    one. Each decision is logged and counted in unitdata.'''
     release = get_os_codename_install_source(config('openstack-origin'))
-    plugin = config('plugin')
-    config_files = resolve_config_files(plugin, release)
-    _map = {}
-    for f, ctxt in config_files[plugin].iteritems():
-        svcs = set()
-        for svc in ctxt['services']:
-            svcs.add(remap_service(svc))
-        if svcs:
-            _map[f] = list(svcs)
-    return _map
+    actions = OrderedDict()
+    for path in changed:
+        for svc in restart_map[path]:
+            action = config_change_action(path, svc, release)
+            log('{} changed, {} needs {}'.format(path, svc, action),
+                level=DEBUG)
+            actions.setdefault(svc, set()).add(action)
+    # A restart applies every other change for the service
+    for svc in actions:
+        if RESTART in actions[svc]:
+            actions[svc] = set([RESTART])
+
+    restarts = [svc for svc in actions if RESTART in actions[svc]]
+    if not stopstart:
+        for svc in restarts:
+            service_restart(svc)
+    else:
+        for svc in restarts:
+            service_stop(svc)
+        for svc in restarts:
+            service_start(svc)
+    if any(RESPAWN_DNSMASQ in a for a in actions.values()):
+        respawn_dnsmasq()
+
+    log('Config change actions: {}'.format(', '.join(
+        '{} {}'.format(svc, '/'.join(sorted(a)))
+        for svc, a in actions.items())), level=INFO)
+    db = kv()
+    counts = db.get(SERVICE_ACTIONS_KEY, {})
+    for svc_actions in actions.values():
+        for action in svc_actions:
+            counts[action] = counts.get(action, 0) + 1
+    db.set(SERVICE_ACTIONS_KEY, counts)
+    db.flush()
+
+
+# Checksums of the config files when restart_services last restarted all
+# services in this hook
+RESTARTED_CHECKSUMS = {}
+
+
+def restart_on_change(restart_map, stopstart=False):
+    '''Like charmhelpers.core.host.restart_on_change, but applies changed
+    config files with apply_config_changes rather than always restarting
+    the services they map to. Changes already applied by restart_services
+    during f are not applied again.'''
+    def wrap(f):
+        def wrapped_f(*args, **kwargs):
+            checksums = {path: path_hash(path) for path in restart_map}
+            RESTARTED_CHECKSUMS.clear()
+            f(*args, **kwargs)
+            checksums.update((path, RESTARTED_CHECKSUMS[path])
+                             for path in restart_map
+                             if path in RESTARTED_CHECKSUMS)
+            changed = [path for path in restart_map
+                       if path_hash(path) != checksums[path]]
+            if changed:
+                apply_config_changes(restart_map, changed, stopstart)
+        return wrapped_f
+    return wrap
 
 
 INT_BRIDGE = "br-int"
@@ -630,12 +1019,12 @@ L3_AGENT = "L3 Agent"
 
 
 # TODO: make work with neutron
-def reassign_agent_resources():
-    ''' Use agent scheduler API to detect down agents and re-schedule '''
+def get_neutron_client():
+    ''' Return a neutron API client, or None if the network service
+    relation is not yet complete '''
     env = NetworkServiceContext()()
     if not env:
-        log('Unable to re-assign resources at this time')
-        return
+        return None
     try:
         from quantumclient.v2_0 import client
     except ImportError:
@@ -643,45 +1032,61 @@ def reassign_agent_resources():
         from neutronclient.v2_0 import client
 
     auth_url = '%(auth_protocol)s://%(keystone_host)s:%(auth_port)s/v2.0' % env
-    quantum = client.Client(username=env['service_username'],
-                            password=env['service_password'],
-                            tenant_name=env['service_tenant'],
-                            auth_url=auth_url,
-                            region_name=env['region'])
+    return client.Client(username=env['service_username'],
+                         password=env['service_password'],
+                         tenant_name=env['service_tenant'],
+                         auth_url=auth_url,
+                         region_name=env['region'])
 
+
+def get_partner_gateways():
+    ''' Short hostnames of this unit and its peer gateways '''
     partner_gateways = [unit_private_ip().split('.')[0]]
     for partner_gateway in relations_of_type(reltype='cluster'):
         gateway_hostname = get_hostname(partner_gateway['private-address'])
+        if not gateway_hostname:
+            log('Unable to resolve hostname of cluster peer %s' %
+                partner_gateway['private-address'])
+            continue
         partner_gateways.append(gateway_hostname.partition('.')[0])
+    return partner_gateways
+
+
+def reassign_agent_resources():
+    ''' Use agent scheduler API to detect down agents and re-schedule '''
+    quantum = get_neutron_client()
+    if not quantum:
+        log('Unable to re-assign resources at this time')
+        return
+
+    partner_gateways = get_partner_gateways()
+    discovery = AgentDiscovery(quantum)
 
-    agents = quantum.list_agents(agent_type=DHCP_AGENT)
     dhcp_agents = []
     l3_agents = []
     networks = {}
-    for agent in agents['agents']:
+    for agent in discovery.agents(agent_type=DHCP_AGENT):
         if not agent['alive']:
             log('DHCP Agent %s down' % agent['id'])
-            for network in \
-                    quantum.list_networks_on_dhcp_agent(
-                        agent['id'])['networks']:
+            for network in discovery.networks_on_dhcp_agent(agent['id']):
                 networks[network['id']] = agent['id']
         else:
             if agent['host'].partition('.')[0] in partner_gateways:
                 dhcp_agents.append(agent['id'])
 
-    agents = quantum.list_agents(agent_type=L3_AGENT)
     routers = {}
-    for agent in agents['agents']:
+    for agent in discovery.agents(agent_type=L3_AGENT):
         if not agent['alive']:
             log('L3 Agent %s down' % agent['id'])
-            for router in \
-                    quantum.list_routers_on_l3_agent(
-                        agent['id'])['routers']:
+            for router in discovery.routers_on_l3_agent(agent['id']):
                 routers[router['id']] = agent['id']
         else:
             if agent['host'].split('.')[0] in partner_gateways:
                 l3_agents.append(agent['id'])
 
+    for line in discovery.summary():
+        log('neutron API %s' % line, level=DEBUG)
+
     if len(dhcp_agents) == 0 or len(l3_agents) == 0:
         log('Unable to relocate resources, there are %s dhcp_agents and %s \
              l3_agents in this cluster' % (len(dhcp_agents), len(l3_agents)))
@@ -710,36 +1115,537 @@ def reassign_agent_resources():
         index += 1
 
 
+EVACUATION_KEY = 'neutron-gateway.evacuation'
+EVACUATION_POLL_INTERVAL = 2
+
+
+class EvacuationError(Exception):
+    ''' Raised when resources cannot be moved between gateways '''
+    pass
+
+
+def short_hostname(host):
+    return str(host).strip().partition('.')[0]
+
+
+def wait_for(check, timeout, interval=EVACUATION_POLL_INTERVAL):
+    ''' Poll check until it returns True or timeout seconds have passed '''
+    deadline = time.time() + timeout
+    while not check():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def router_active(neutron, router_id, exclude=None, agent_id=None,
+                  standby=False):
+    ''' Check whether router is active on a live agent other than exclude,
+    or on agent_id if given. With standby an HA router in standby on the
+    agent counts too. '''
+    states = (None, 'active', 'standby') if standby else (None, 'active')
+    for agent in neutron.list_l3_agent_hosting_routers(router_id)['agents']:
+        if agent['id'] == exclude or not agent['alive']:
+            continue
+        if agent_id and agent['id'] != agent_id:
+            continue
+        if agent.get('ha_state') in states:
+            return True
+    return False
+
+
+def network_hosted(neutron, network_id, agent_id):
+    ''' Check whether network is hosted by the live DHCP agent agent_id '''
+    agents = neutron.list_dhcp_agent_hosting_networks(network_id)['agents']
+    return any(a['id'] == agent_id and a['alive'] for a in agents)
+
+
+def move_router(neutron, router_id, source, target, timeout):
+    ''' Move router from the source to the target L3 agent and wait until
+    it is active elsewhere. target is None for HA routers already hosted
+    by other agents. Returns the seconds taken.
+
+    A non-HA router can only be hosted by one L3 agent, so it is removed
+    from source before being added to target and is unreachable until it
+    is active there. '''
+    start = time.time()
+    neutron.remove_router_from_l3_agent(l3_agent=source, router_id=router_id)
+    if target:
+        neutron.add_router_to_l3_agent(l3_agent=target,
+                                       body={'router_id': router_id})
+    if not wait_for(lambda: router_active(neutron, router_id, exclude=source,
+                                          agent_id=target), timeout):
+        raise EvacuationError('router %s not active after %ss' %
+                              (router_id, timeout))
+    return time.time() - start
+
+
+def move_network(neutron, network_id, source, target, timeout):
+    ''' Move network from the source to the target DHCP agent, removing it
+    from source only once target hosts it. Returns the seconds taken. '''
+    start = time.time()
+    if not network_hosted(neutron, network_id, target):
+        neutron.add_network_to_dhcp_agent(dhcp_agent=target,
+                                          body={'network_id': network_id})
+        if not wait_for(lambda: network_hosted(neutron, network_id, target),
+                        timeout):
+            raise EvacuationError('network %s not hosted after %ss' %
+                                  (network_id, timeout))
+    neutron.remove_network_from_dhcp_agent(dhcp_agent=source,
+                                           network_id=network_id)
+    return time.time() - start
+
+
+def run_moves(moves, concurrency):
+    ''' Run (kind, resource_id, func, args) moves with at most concurrency
+    in flight, returning (kind, resource_id, seconds, error) results.
+
+    func is called with the worker thread's own neutron client followed by
+    args, as neutron clients are not thread safe. '''
+    # Each worker thread keeps its own client
+    workers = threading.local()
+
+    def run(move):
+        kind, resource_id, func, args = move
+        try:
+            if getattr(workers, 'neutron', None) is None:
+                workers.neutron = get_neutron_client()
+            return kind, resource_id, func(workers.neutron, *args), None
+        except Exception as e:
+            log('Failed to move %s %s: %s' % (kind, resource_id, e),
+                level=ERROR)
+            return kind, resource_id, None, str(e)
+
+    if not moves:
+        return []
+    pool = ThreadPool(max(1, min(concurrency, len(moves))))
+    try:
+        return pool.map(run, moves)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def gateway_agents(discovery, agent_type, configurations=False):
+    ''' Return the agents of agent_type on this unit and the live, enabled
+    ones on its peer gateways, with their configurations if asked for '''
+    local_host = short_hostname(socket.gethostname())
+    partners = get_partner_gateways()
+    local = []
+    peers = []
+    for agent in discovery.agents(agent_type=agent_type,
+                                  configurations=configurations):
+        host = short_hostname(agent['host'])
+        if host == local_host:
+            local.append(agent)
+        elif (host in partners and agent['alive'] and
+              agent.get('admin_state_up', True)):
+            peers.append(agent)
+    return local, peers
+
+
+def live_gateway_agents(discovery, agent_type):
+    ''' Return the live, enabled agents of agent_type on this unit and its
+    peer gateways '''
+    local, peers = gateway_agents(discovery, agent_type)
+    return [agent for agent in local if agent['alive'] and
+            agent.get('admin_state_up', True)] + peers
+
+
+def set_agents_admin_state(neutron, agents, up):
+    for agent in agents:
+        neutron.update_agent(agent['id'], {'agent': {'admin_state_up': up}})
+
+
+def summarize_moves(results, start):
+    ''' Build action results from run_moves results '''
+    summary = {'routers': 0, 'networks': 0, 'failed': 0}
+    durations = []
+    failures = []
+    for kind, resource_id, seconds, error in results:
+        if error:
+            summary['failed'] += 1
+            failures.append('%s %s: %s' % (kind, resource_id, error))
+            continue
+        summary['%ss' % kind] += 1
+        durations.append(seconds)
+    summary['timings.total'] = round(time.time() - start, 2)
+    if durations:
+        summary['timings.max'] = round(max(durations), 2)
+        summary['timings.mean'] = round(sum(durations) / len(durations), 2)
+    if failures:
+        summary['failures'] = '\n'.join(failures)
+    return summary
+
+
+def evacuate_agents(concurrency=4, timeout=120):
+    '''
+    Move every router and DHCP network hosted by this unit's agents to its
+    peer gateways ahead of maintenance. The local agents are disabled first
+    so nothing is scheduled back until restore_agents() is run.
+
+    :param concurrency: maximum number of resources moved at once
+    :param timeout: seconds to wait for each resource to become active
+    :returns: dict of counts and timings for action results
+    '''
+    start = time.time()
+    neutron = get_neutron_client()
+    if not neutron:
+        raise EvacuationError('neutron API is not available')
+    discovery = AgentDiscovery(neutron)
+    # Peer configurations carry their router and network counts
+    local_l3, peer_l3 = gateway_agents(discovery, L3_AGENT,
+                                       configurations=True)
+    local_dhcp, peer_dhcp = gateway_agents(discovery, DHCP_AGENT,
+                                           configurations=True)
+
+    routers = {}
+    for agent in local_l3:
+        for router in discovery.routers_on_l3_agent(agent['id']):
+            routers[router['id']] = (agent['id'], router.get('ha'))
+    networks = {}
+    for agent in local_dhcp:
+        for network in discovery.networks_on_dhcp_agent(agent['id']):
+            networks[network['id']] = agent['id']
+    if routers and not peer_l3:
+        raise EvacuationError('no live L3 agents on peer gateways')
+    if networks and not peer_dhcp:
+        raise EvacuationError('no live DHCP agents on peer gateways')
+
+    set_agents_admin_state(neutron, local_l3 + local_dhcp, False)
+
+    # Spread resources over the least loaded peers
+    l3_load = dict((agent['id'], agent.get('configurations', {}).get(
+        'routers', 0)) for agent in peer_l3)
+    dhcp_load = dict((agent['id'], agent.get('configurations', {}).get(
+        'networks', 0)) for agent in peer_dhcp)
+    state = {'routers': {}, 'networks': {}}
+    moves = []
+    for router_id, (source, ha) in sorted(routers.items()):
+        target = None
+        if not ha:
+            target = min(l3_load, key=lambda a: (l3_load[a], a))
+            l3_load[target] += 1
+        state['routers'][router_id] = [source, target]
+        moves.append(('router', router_id, move_router,
+                      (router_id, source, target, timeout)))
+    for network_id, source in sorted(networks.items()):
+        target = min(dhcp_load, key=lambda a: (dhcp_load[a], a))
+        dhcp_load[target] += 1
+        state['networks'][network_id] = [source, target]
+        moves.append(('network', network_id, move_network,
+                      (network_id, source, target, timeout)))
+
+    # Merge with the resources of earlier evacuations not yet restored
+    db = kv()
+    evacuated = db.get(EVACUATION_KEY) or {}
+    for kind in state:
+        evacuated.setdefault(kind, {}).update(state[kind])
+    db.set(EVACUATION_KEY, evacuated)
+    db.flush()
+    return summarize_moves(run_moves(moves, concurrency), start)
+
+
+def restore_agents(concurrency=4, timeout=120):
+    '''
+    Re-enable this unit's agents and move back the routers and networks
+    moved off it by evacuate_agents().
+
+    :param concurrency: maximum number of resources moved at once
+    :param timeout: seconds to wait for each resource to become active
+    :returns: dict of counts and timings for action results
+    '''
+    start = time.time()
+    neutron = get_neutron_client()
+    if not neutron:
+        raise EvacuationError('neutron API is not available')
+    discovery = AgentDiscovery(neutron)
+    local_l3, _ = gateway_agents(discovery, L3_AGENT)
+    local_dhcp, _ = gateway_agents(discovery, DHCP_AGENT)
+    set_agents_admin_state(neutron, local_l3 + local_dhcp, True)
+
+    db = kv()
+    state = db.get(EVACUATION_KEY) or {}
+    moves = []
+    for router_id, (source, target) in sorted(
+            state.get('routers', {}).items()):
+        moves.append(('router', router_id, restore_router,
+                      (router_id, source, target, timeout)))
+    for network_id, (source, target) in sorted(
+            state.get('networks', {}).items()):
+        moves.append(('network', network_id, move_network,
+                      (network_id, target, source, timeout)))
+    results = run_moves(moves, concurrency)
+    # Keep the resources that failed to move back for the next restore
+    for kind, resource_id, _, error in results:
+        if not error:
+            del state['%ss' % kind][resource_id]
+    if any(state.values()):
+        db.set(EVACUATION_KEY, state)
+    else:
+        db.unset(EVACUATION_KEY)
+    db.flush()
+    return summarize_moves(results, start)
+
+
+def restore_router(neutron, router_id, agent_id, evacuated_to, timeout):
+    ''' Move router back to the agent_id L3 agent it was evacuated from.
+    evacuated_to is None for HA routers, which stay on their other agents. '''
+    start = time.time()
+    hosting = neutron.list_l3_agent_hosting_routers(router_id)['agents']
+    if agent_id not in [agent['id'] for agent in hosting]:
+        if evacuated_to:
+            for agent in hosting:
+                neutron.remove_router_from_l3_agent(l3_agent=agent['id'],
+                                                    router_id=router_id)
+        neutron.add_router_to_l3_agent(l3_agent=agent_id,
+                                       body={'router_id': router_id})
+    if not wait_for(lambda: router_active(neutron, router_id,
+                                          agent_id=agent_id,
+                                          standby=not evacuated_to),
+                    timeout):
+        raise EvacuationError('router %s not active after %ss' %
+                              (router_id, timeout))
+    return time.time() - start
+
+
+def plan_rebalance(placement, max_imbalance=1):
+    '''
+    Plan the fewest moves that bring every agent within max_imbalance
+    resources of each other, never moving a resource to an agent that
+    already hosts it.
+
+    :param placement: dict of agent id to ids of the resources it hosts
+    :param max_imbalance: largest acceptable difference in resource count
+    :returns: list of (resource, source, target) moves and a dict of agent
+              id to its resource count once they are done
+    '''
+    placement = dict((agent, set(resources))
+                     for agent, resources in placement.iteritems())
+    max_imbalance = max(1, max_imbalance)
+    moves = []
+    while placement:
+        agents = sorted(placement, key=lambda a: (len(placement[a]), a))
+        low, high = agents[0], agents[-1]
+        if len(placement[high]) - len(placement[low]) <= max_imbalance:
+            break
+        candidates = sorted(placement[high] - placement[low])
+        if not candidates:
+            break
+        placement[high].remove(candidates[0])
+        placement[low].add(candidates[0])
+        moves.append((candidates[0], high, low))
+    return moves, dict((agent, len(resources))
+                       for agent, resources in placement.iteritems())
+
+
+def rebalance_agents(dry_run=True, max_imbalance=1, concurrency=4,
+                     timeout=120):
+    '''
+    Spread routers and DHCP networks evenly over the live L3 and DHCP
+    agents of this unit and its peer gateways. HA routers are left alone
+    as they are already hosted by several agents; each other router moved
+    is down until it is active on its new agent (see move_router).
+
+    :param dry_run: only plan the moves
+    :param max_imbalance: largest acceptable difference in resource count
+    :param concurrency: maximum number of resources moved at once
+    :param timeout: seconds to wait for each resource to become active
+    :returns: dict of the plan, counts and timings for action results
+    '''
+    start = time.time()
+    neutron = get_neutron_client()
+    if not neutron:
+        raise EvacuationError('neutron API is not available')
+
+    discovery = AgentDiscovery(neutron)
+    routers = {}
+    for agent in live_gateway_agents(discovery, L3_AGENT):
+        routers[agent['id']] = [
+            router['id'] for router in
+            discovery.routers_on_l3_agent(agent['id'])
+            if not router.get('ha')]
+    networks = {}
+    for agent in live_gateway_agents(discovery, DHCP_AGENT):
+        networks[agent['id']] = [
+            network['id'] for network in
+            discovery.networks_on_dhcp_agent(agent['id'])]
+    router_moves, router_counts = plan_rebalance(routers, max_imbalance)
+    network_moves, network_counts = plan_rebalance(networks, max_imbalance)
+
+    plan = ['router %s: %s -> %s' % move for move in router_moves]
+    plan += ['network %s: %s -> %s' % move for move in network_moves]
+    counts = ['l3 %s: %d -> %d' % (agent, len(routers[agent]),
+                                   router_counts[agent])
+              for agent in sorted(routers)]
+    counts += ['dhcp %s: %d -> %d' % (agent, len(networks[agent]),
+                                      network_counts[agent])
+               for agent in sorted(networks)]
+    for line in plan + counts:
+        log('rebalance: %s' % line)
+    if dry_run:
+        return {'plan': '\n'.join(plan) or 'balanced',
+                'counts': '\n'.join(counts),
+                'moves': len(plan)}
+
+    moves = [('router', router_id, move_router,
+              (router_id, source, target, timeout))
+             for router_id, source, target in router_moves]
+    moves += [('network', network_id, move_network,
+               (network_id, source, target, timeout))
+              for network_id, source, target in network_moves]
+    results = summarize_moves(run_moves(moves, concurrency), start)
+    results['counts'] = '\n'.join(counts)
+    return results
+
+
 def services():
     ''' Returns a list of services associate with this charm '''
-    _services = []
-    for v in restart_map().values():
-        _services = _services + v
-    return list(set(_services))
+    return list(config_topology().services)
+
+
+UPGRADE_STAGING_DIR = '/var/lib/neutron-gateway/upgrade'
+POLICY_RC_D = '/usr/sbin/policy-rc.d'
+
+
+def timed_phase(timings, phase, func, *args, **kwargs):
+    '''Run func, recording how long it took in seconds against phase'''
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[phase] = round(time.time() - start, 2)
+
+
+def stage_configs(configs):
+    '''Render all registered configs into UPGRADE_STAGING_DIR, returning
+    the list of config files staged. The configs carry credentials so are
+    only readable by root until installed.'''
+    staged = []
+    for config_file in configs.templates:
+        path = UPGRADE_STAGING_DIR + config_file
+        mkdir(os.path.dirname(path), perms=0o700)
+        write_file(path, configs.render(config_file), perms=0o600)
+        staged.append(config_file)
+    return staged
+
+
+def install_staged_configs(staged):
+    '''Install configs rendered by stage_configs, keeping the owner, group
+    and mode of the files they replace'''
+    for config_file in staged:
+        path = UPGRADE_STAGING_DIR + config_file
+        with open(path, 'rb') as f:
+            content = f.read()
+        if os.path.exists(config_file):
+            st = os.stat(config_file)
+            owner = pwd.getpwuid(st.st_uid).pw_name
+            group = grp.getgrgid(st.st_gid).gr_name
+            perms = stat.S_IMODE(st.st_mode)
+        else:
+            if not os.path.isdir(os.path.dirname(config_file)):
+                mkdir(os.path.dirname(config_file), perms=0o755)
+            owner, group, perms = 'root', 'root', 0o644
+        write_file(config_file, content, owner=owner, group=group,
+                   perms=perms)
+        os.remove(path)
+        log('Wrote template %s.' % config_file, level=INFO)
+
+
+def download_upgrade_packages():
+    '''Fetch all packages needed for the upgrade into the apt cache'''
+    download_opts = ['--download-only']
+    apt_upgrade(options=download_opts, fatal=True, dist=True)
+    apt_install(get_early_packages(), options=download_opts, fatal=True)
+    apt_install(get_packages(), options=download_opts, fatal=True)
 
 
-def do_openstack_upgrade(configs):
+@contextmanager
+def service_starts_denied():
+    '''Deny service starts and restarts by dpkg maintainer scripts, unless
+    a policy-rc.d is already in place'''
+    policy_rc_d = not os.path.exists(POLICY_RC_D)
+    if policy_rc_d:
+        write_file(POLICY_RC_D, '#!/bin/sh\nexit 101\n', perms=0o755)
+    try:
+        yield
+    finally:
+        if policy_rc_d:
+            os.remove(POLICY_RC_D)
+
+
+def install_upgrade_packages(dpkg_opts):
+    '''Unpack and configure the upgraded packages'''
+    apt_upgrade(options=dpkg_opts, fatal=True, dist=True)
+    apt_install(get_early_packages(), fatal=True)
+    apt_install(get_packages(), fatal=True)
+
+
+def installed_version(package):
+    '''Return the installed version of package, or None'''
+    try:
+        pkg = apt_cache()[package]
+    except KeyError:
+        return None
+    if not pkg.current_ver:
+        return None
+    return pkg.current_ver.ver_str
+
+
+def restart_services(restart_ovs=False):
+    '''Restart all services managed by this charm, and Open vSwitch first
+    if restart_ovs is set, recording the config files they were restarted
+    with for restart_on_change'''
+    if restart_ovs:
+        service_restart('openvswitch-switch')
+    for svc in services():
+        service_restart(svc)
+    RESTARTED_CHECKSUMS.update((path, path_hash(path))
+                               for path in restart_map())
+
+
+def do_openstack_upgrade(configs, timings=None):
     """
     Perform an upgrade.  Takes care of upgrading packages, rewriting
     configs, database migrations and potentially any other post-upgrade
     actions.
+
+    Packages are downloaded while services are still running. They are
+    then unpacked with service restarts denied, and the new release's
+    configs, rendered once the packages they depend on are installed, are
+    staged and swapped in before each service is restarted once. Open
+    vSwitch, which carries all tenant traffic, is only restarted if it was
+    upgraded.
+
+    The time in seconds each phase took is recorded in timings, if given,
+    which is also returned.
     """
     new_src = config('openstack-origin')
     new_os_rel = get_os_codename_install_source(new_src)
     log('Performing OpenStack upgrade to %s.' % (new_os_rel))
+    if timings is None:
+        timings = OrderedDict()
 
     configure_installation_source(new_src)
     dpkg_opts = [
         '--option', 'Dpkg::Options::=--force-confnew',
         '--option', 'Dpkg::Options::=--force-confdef',
     ]
-    apt_update(fatal=True)
-    apt_upgrade(options=dpkg_opts,
-                fatal=True, dist=True)
-    apt_install(get_early_packages(), fatal=True)
-    apt_install(get_packages(), fatal=True)
-    configs.set_release(openstack_release=new_os_rel)
-    configs.write_all()
+    timed_phase(timings, 'update', apt_update, fatal=True)
+    timed_phase(timings, 'download', download_upgrade_packages)
+    ovs_version = installed_version('openvswitch-switch')
+    with service_starts_denied():
+        timed_phase(timings, 'install', install_upgrade_packages, dpkg_opts)
+        configs.set_release(openstack_release=new_os_rel)
+        flush_hook_contexts()
+        staged = timed_phase(timings, 'stage', stage_configs, configs)
+        timed_phase(timings, 'configs', install_staged_configs, staged)
+    timed_phase(timings, 'restart', restart_services,
+                installed_version('openvswitch-switch') != ovs_version)
+
+    log('OpenStack upgrade phase timings: {}'.format(
+        ', '.join('{} {}s'.format(p, t) for p, t in timings.items())))
+    return timings
 
 
 def configure_ovs():
@@ -748,9 +1654,10 @@ def configure_ovs():
             full_restart()
         add_bridge(INT_BRIDGE)
         add_bridge(EXT_BRIDGE)
+        ports = []
         ext_port_ctx = ExternalPortContext()()
         if ext_port_ctx and ext_port_ctx['ext_port']:
-            add_bridge_port(EXT_BRIDGE, ext_port_ctx['ext_port'])
+            ports.append((EXT_BRIDGE, ext_port_ctx['ext_port'], False))
 
         portmaps = DataPortContext()()
         bridgemaps = parse_bridge_mappings(config('bridge-mappings'))
@@ -761,11 +1668,95 @@ def configure_ovs():
 
             for port, _br in portmaps.iteritems():
                 if _br == br:
-                    add_bridge_port(br, port, promisc=True)
+                    ports.append((br, port, True))
+        if ports:
+            add_bridge_ports(ports)
+
+        if config('plugin') == OVS:
+            release = get_os_codename_install_source(
+                config('openstack-origin'))
+            if ovsdb_interface(release) == NATIVE:
+                add_ovsdb_manager(OVSDB_MANAGER)
+
+        # The job is restarted when its config changes; also run it if mtu
+        # has been lost from any data-port interface, e.g. by a bond being
+        # recreated.
+        mtu_ctxt = PhyNICMTUContext()()
+        if mtu_ctxt:
+            devs = mtu_ctxt['devs'].split('\\n')
+            mtu = int(mtu_ctxt['mtu'])
+            if any(link_mtu(dev) != mtu for dev in devs):
+                service_restart('os-charm-phy-nic-mtu')
+
+
+def add_ovsdb_manager(target):
+    '''Add target to the managers of the local ovsdb-server, keeping any
+    existing ones such as an SDN controller'''
+    managers = subprocess.check_output(['ovs-vsctl', 'get-manager']).split()
+    if target in managers:
+        return
+    log('Adding ovsdb manager %s' % target)
+    subprocess.check_call(['ovs-vsctl', '--', '--id=@manager', 'create',
+                           'Manager', 'target="%s"' % target, '--', 'add',
+                           'Open_vSwitch', '.', 'manager_options',
+                           '@manager'])
+
+
+SYS_CLASS_NET = '/sys/class/net'
+IFF_UP = 0x1
+IFF_PROMISC = 0x100
+
+
+def _read_link_attr(dev, attr):
+    try:
+        with open(os.path.join(SYS_CLASS_NET, dev, attr)) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def link_mtu(dev):
+    '''Return the mtu of a network device, or None if it does not exist'''
+    mtu = _read_link_attr(dev, 'mtu')
+    return int(mtu) if mtu else None
+
+
+def link_flags(dev):
+    '''Return the flags of a network device, or None if it does not exist'''
+    flags = _read_link_attr(dev, 'flags')
+    return int(flags, 16) if flags else None
 
-        # Ensure this runs so that mtu is applied to data-port interfaces if
-        # provided.
-        service_restart('os-charm-phy-nic-mtu')
+
+def configure_links(links):
+    '''Bring up (device, promisc) links and set their promiscuous mode with
+    a single ip -batch call, skipping links already in the desired state'''
+    commands = []
+    for dev, promisc in links:
+        flags = link_flags(dev)
+        if (flags is not None and flags & IFF_UP and
+                bool(flags & IFF_PROMISC) == promisc):
+            continue
+        commands.append('link set dev {} up promisc {}'
+                        ''.format(dev, 'on' if promisc else 'off'))
+    if not commands:
+        return
+    log('Configuring links: {}'.format('; '.join(commands)), level=DEBUG)
+    cmd = ['ip', '-batch', '-']
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    p.communicate('\n'.join(commands) + '\n')
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+def add_bridge_ports(ports):
+    '''Add (bridge, port, promisc) ports to openvswitch bridges with a single
+    ovs-vsctl transaction, then configure their links in one batch'''
+    cmd = ['ovs-vsctl']
+    for bridge, port, promisc in ports:
+        log('Adding port {} to bridge {}'.format(port, bridge))
+        cmd.extend(['--', '--may-exist', 'add-port', bridge, port])
+    subprocess.check_call(cmd)
+    configure_links([(port, promisc) for _, port, promisc in ports])
 
 
 def copy_file(src, dst, perms=None, force=False):
@@ -801,7 +1792,7 @@ def remove_file(path):
 
 def install_legacy_ha_files(force=False):
     for f, p in LEGACY_FILES_MAP.iteritems():
-        srcfile = os.path.join(LEGACY_HA_TEMPLATE_FILES, f)
+        srcfile = os.path.join(p.get('source', LEGACY_HA_TEMPLATE_FILES), f)
         copy_file(srcfile, p['path'], p.get('permissions', None), force=force)
 
 
@@ -813,16 +1804,40 @@ def remove_legacy_ha_files():
 def update_legacy_ha_files(force=False):
     if config('ha-legacy-mode'):
         install_legacy_ha_files(force=force)
+        cache_env_data()
     else:
         remove_legacy_ha_files()
 
 
+def heartbeat_threshold():
+    ''' Seconds without a fresh agent heartbeat before the HA monitor
+    suspects the agent has failed, by default two report intervals so
+    ordinary reporting jitter is not mistaken for a failure '''
+    threshold = config('ha-heartbeat-threshold')
+    if threshold is None:
+        threshold = 2 * get_report_interval()
+    return threshold
+
+
+def hang_threshold():
+    ''' Seconds a running local agent may be down without a new heartbeat
+    before the HA monitor restarts it, by default the longer of
+    agent_down_time and four report intervals '''
+    threshold = config('ha-agent-hang-threshold')
+    if threshold is None:
+        threshold = max(config('agent-down-time'), 4 * get_report_interval())
+    return threshold
+
+
 def cache_env_data():
     env = NetworkServiceContext()()
     if not env:
         log('Unable to get NetworkServiceContext at this time', level=ERROR)
         return
 
+    env['heartbeat_threshold'] = str(heartbeat_threshold())
+    env['hang_threshold'] = str(hang_threshold())
+
     no_envrc = False
     envrc_f = '/etc/legacy_ha_envrc'
     if os.path.isfile(envrc_f):
@@ -830,7 +1845,7 @@ def cache_env_data():
             data = f.read()
 
         data = data.strip().split('\n')
-        diff = False
+        diff = len(data) != len(env)
         for line in data:
             k = line.split('=')[0]
             v = line.split('=')[1]
@@ -866,24 +1881,8 @@ def cleanup_ovs_netns():
 
 
 def get_topics():
-    # metering_agent
-    topics = []
-    if 'neutron-l3-agent' in services():
-        topics.append('l3_agent')
-    if 'neutron-dhcp-agent' in services():
-        topics.append('dhcp_agent')
-    if 'neutron-metering-agent' in services():
-        topics.append('metering_agent')
-    if 'neutron-lbaas-agent' in services():
-        topics.append('n-lbaas_agent')
-    if 'neutron-plugin-openvswitch-agent' in services():
-        topics.append('q-agent-notifier-port-update')
-        topics.append('q-agent-notifier-network-delete')
-        topics.append('q-agent-notifier-tunnel-update')
-        topics.append('q-agent-notifier-security_group-update')
-        topics.append('q-agent-notifier-dvr-update')
-    topics.append('q-agent-notifier-l2population-update')
-    return topics
+    ''' Returns the agent RPC topics of the services of this charm '''
+    return list(config_topology().topics)
 
 
 def git_install(projects_yaml):
@@ -964,13 +1963,24 @@ def git_post_install(projects_yaml):
          'link': '/usr/bin/neutron-rootwrap'},
     ]
 
+    release = get_os_codename_install_source(config('openstack-origin'))
+    rootwrap_daemon = bool(config('rootwrap-daemon') and release >= 'kilo')
+    if rootwrap_daemon:
+        symlinks += [
+            {'src': os.path.join(git_pip_venv_dir(projects_yaml),
+                                 'bin/neutron-rootwrap-daemon'),
+             'link': '/usr/local/bin/neutron-rootwrap-daemon'},
+            {'src': '/usr/local/bin/neutron-rootwrap-daemon',
+             'link': '/usr/bin/neutron-rootwrap-daemon'},
+        ]
+
     for s in symlinks:
         if os.path.lexists(s['link']):
             os.remove(s['link'])
         os.symlink(s['src'], s['link'])
 
-    render('git/neutron_sudoers',
-           '/etc/sudoers.d/neutron_sudoers', {}, perms=0o440)
+    render('git/neutron_sudoers', '/etc/sudoers.d/neutron_sudoers',
+           {'rootwrap_daemon': rootwrap_daemon}, perms=0o440)
     render('git/cron.d/neutron-dhcp-agent-netns-cleanup',
            '/etc/cron.d/neutron-dhcp-agent-netns-cleanup', {}, perms=0o755)
     render('git/cron.d/neutron-l3-agent-netns-cleanup',
@@ -1243,19 +2253,93 @@ def git_post_install(projects_yaml):
            neutron_vpn_agent_context, perms=0o644)
 
 
-def check_optional_relations(configs):
-    required_interfaces = {}
+WORKLOAD_STATUS_KEY = 'neutron-gateway.workload-status'
+
+
+def set_workload_status(state, message):
+    '''Set workload status, recording it so that assess_status only calls
+    status-set when the status actually changes'''
+    status_set(state, message)
+    db = kv()
+    db.set(WORKLOAD_STATUS_KEY, [state, message])
+    db.flush()
+
+
+def required_interfaces():
+    '''Return the required interfaces, including those of any optional
+    relations that have been made'''
+    interfaces = REQUIRED_INTERFACES.copy()
+    if relation_ids('ha'):
+        interfaces['ha'] = ['cluster']
+    return interfaces
+
+
+def incomplete_relations(configs, interfaces):
+    '''Return lists of missing and incomplete generic interfaces.
+
+    Contexts are only evaluated once per hook (see HookContext), so those
+    of templates already rendered in this hook are reused, and relation
+    data is only looked up for the interfaces still incomplete.'''
+    wanted = set()
+    for ifaces in interfaces.values():
+        wanted.update(ifaces)
+    complete = set(configs.complete_contexts())
+    incomplete_data = configs.get_incomplete_context_data(
+        sorted(wanted - complete))
+    related = set(iface for iface, data in incomplete_data.items()
+                  if data.get('related'))
+
+    departing = ['{}-relation-{}'.format(i, h)
+                 for i in related for h in ('departed', 'broken')]
+    missing = []
+    incomplete = []
+    for svc_type, ifaces in sorted(interfaces.items()):
+        if complete.intersection(ifaces):
+            continue
+        if related.intersection(ifaces) and hook_name() not in departing:
+            incomplete.append(svc_type)
+        else:
+            missing.append(svc_type)
+    return missing, incomplete
+
+
+def get_workload_status(configs):
+    '''Return the (state, message) workload status of the unit'''
+    missing, incomplete = incomplete_relations(configs,
+                                               required_interfaces())
+    if missing:
+        state = 'blocked'
+        message = 'Missing relations: {}'.format(', '.join(missing))
+        if incomplete:
+            message += '; incomplete relations: {}'.format(
+                ', '.join(incomplete))
+    elif incomplete:
+        state = 'waiting'
+        message = 'Incomplete relations: {}'.format(', '.join(incomplete))
+    else:
+        state = 'active'
+        message = None
+
     if relation_ids('ha'):
-        required_interfaces['ha'] = ['cluster']
         try:
             get_hacluster_config()
         except:
-            return ('blocked',
-                    'hacluster missing configuration: '
-                    'vip, vip_iface, vip_cidr')
-
-    if required_interfaces:
-        set_os_workload_status(configs, required_interfaces)
-        return status_get()
-    else:
-        return 'unknown', 'No optional relations'
+            ha_message = ('hacluster missing configuration: '
+                          'vip, vip_iface, vip_cidr')
+            state = 'blocked'
+            message = ('{}, {}'.format(message, ha_message) if message
+                       else ha_message)
+
+    if state == 'active':
+        message = 'Unit is ready'
+    return state, message
+
+
+def assess_status(configs):
+    '''Assess the status of the unit, only calling status-set if it has
+    changed since it was last set'''
+    state, message = get_workload_status(configs)
+    if kv().get(WORKLOAD_STATUS_KEY) == [state, message]:
+        log('Workload status unchanged: {}'.format(state), level=DEBUG)
+        return
+    set_workload_status(state, message)
@@ -0,0 +1,76 @@
+from mock import patch
+
+with patch('charmhelpers.core.hookenv.config') as config:
+    config.return_value = 'neutron'
+    import neutron_utils as utils  # noqa
+
+from test_utils import (
+    CharmTestCase
+)
+
+import evacuate
+
+TO_PATCH = [
+    'action_fail',
+    'action_get',
+    'action_set',
+    'evacuate_agents',
+    'rebalance_agents',
+    'restore_agents',
+]
+
+
+class TestEvacuateActions(CharmTestCase):
+
+    def setUp(self):
+        super(TestEvacuateActions, self).setUp(evacuate, TO_PATCH)
+        self.action_get.side_effect = {'concurrency': 4, 'timeout': 120}.get
+
+    def test_evacuate(self):
+        results = {'routers': 2, 'networks': 1, 'failed': 0,
+                   'timings.total': 3.5}
+        self.evacuate_agents.return_value = results
+        evacuate.main(['actions/evacuate'])
+        self.evacuate_agents.assert_called_with(concurrency=4, timeout=120)
+        self.action_set.assert_called_with(results)
+        self.assertFalse(self.action_fail.called)
+
+    def test_restore(self):
+        self.restore_agents.return_value = {'routers': 0, 'networks': 0,
+                                            'failed': 0}
+        evacuate.main(['actions/restore'])
+        self.restore_agents.assert_called_with(concurrency=4, timeout=120)
+        self.assertFalse(self.evacuate_agents.called)
+
+    def test_evacuate_partial(self):
+        self.evacuate_agents.return_value = {'routers': 1, 'networks': 0,
+                                             'failed': 1}
+        evacuate.main(['actions/evacuate'])
+        self.assertTrue(self.action_set.called)
+        self.action_fail.assert_called_with(
+            'evacuate failed to move 1 resources')
+
+    def test_evacuate_error(self):
+        self.evacuate_agents.side_effect = evacuate.EvacuationError(
+            'no live L3 agents on peer gateways')
+        evacuate.main(['actions/evacuate'])
+        self.action_fail.assert_called_with(
+            'evacuate failed: no live L3 agents on peer gateways')
+        self.assertFalse(self.action_set.called)
+
+    def test_rebalance_dry_run(self):
+        self.action_get.side_effect = {'concurrency': 4, 'timeout': 120,
+                                       'dry-run': True,
+                                       'max-imbalance': 2}.get
+        results = {'plan': 'router r1: l3-a -> l3-b', 'counts': '',
+                   'moves': 1}
+        self.rebalance_agents.return_value = results
+        evacuate.main(['actions/rebalance'])
+        self.rebalance_agents.assert_called_with(
+            concurrency=4, timeout=120, dry_run=True, max_imbalance=2)
+        self.action_set.assert_called_with(results)
+        self.assertFalse(self.action_fail.called)
+
+    def test_unknown_action(self):
+        self.assertEquals(evacuate.main(['actions/foo']),
+                          'Action foo undefined')
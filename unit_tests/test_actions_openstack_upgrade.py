@@ -14,6 +14,7 @@ with patch('charmhelpers.core.hookenv.status_set'):
 TO_PATCH = [
     'do_openstack_upgrade',
     'config_changed',
+    'action_set',
 ]
 
 
@@ -36,7 +37,7 @@ class TestNeutronGWUpgradeActions(CharmTestCase):
         openstack_upgrade.openstack_upgrade()
 
         self.assertTrue(self.do_openstack_upgrade.called)
-        self.assertTrue(self.config_changed.called)
+        self.config_changed.assert_called_once_with(force=True)
 
     @patch('charmhelpers.contrib.openstack.utils.config')
     @patch('charmhelpers.contrib.openstack.utils.action_set')
@@ -52,3 +53,24 @@ class TestNeutronGWUpgradeActions(CharmTestCase):
 
         self.assertFalse(self.do_openstack_upgrade.called)
         self.assertFalse(self.config_changed.called)
+
+    @patch('charmhelpers.contrib.openstack.utils.config')
+    @patch('charmhelpers.contrib.openstack.utils.action_set')
+    @patch('charmhelpers.contrib.openstack.utils.git_install_requested')
+    @patch('charmhelpers.contrib.openstack.utils.openstack_upgrade_available')
+    def test_openstack_upgrade_timings(self, upgrade_avail, git_requested,
+                                       _action_set, config):
+        git_requested.return_value = False
+        upgrade_avail.return_value = True
+        config.return_value = True
+
+        def do_openstack_upgrade(configs, timings):
+            timings['download'] = 12.5
+            timings['install'] = 3.0
+        self.do_openstack_upgrade.side_effect = do_openstack_upgrade
+
+        openstack_upgrade.openstack_upgrade()
+
+        self.action_set.assert_called_with({'timings.download': 12.5,
+                                            'timings.install': 3.0})
+        self.assertTrue(self.config_changed.called)
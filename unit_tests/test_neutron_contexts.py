@@ -1,10 +1,9 @@
 from mock import (
-    Mock,
     MagicMock,
+    PropertyMock,
     patch
 )
 import neutron_contexts
-import sys
 from contextlib import contextmanager
 
 from test_utils import (
@@ -12,7 +11,6 @@ from test_utils import (
 )
 
 TO_PATCH = [
-    'apt_install',
     'config',
     'eligible_leader',
     'unit_get',
@@ -62,6 +60,8 @@ class TestL3AgentContext(CharmTestCase):
         self.eligible_leader.return_value = False
         self.assertEquals(neutron_contexts.L3AgentContext()(),
                           {'agent_mode': 'legacy',
+                           'send_arp_for_ha': 3,
+                           'periodic_fuzzy_delay': 5,
                            'handle_internal_only_router': False,
                            'plugin': 'ovs'})
 
@@ -74,6 +74,8 @@ class TestL3AgentContext(CharmTestCase):
         self.eligible_leader.return_value = True
         self.assertEquals(neutron_contexts.L3AgentContext()(),
                           {'agent_mode': 'legacy',
+                           'send_arp_for_ha': 3,
+                           'periodic_fuzzy_delay': 5,
                            'handle_internal_only_router': True,
                            'ext_net_id': 'netid',
                            'plugin': 'ovs'})
@@ -87,6 +89,8 @@ class TestL3AgentContext(CharmTestCase):
         self.eligible_leader.return_value = True
         self.assertEquals(neutron_contexts.L3AgentContext()(),
                           {'agent_mode': 'legacy',
+                           'send_arp_for_ha': 3,
+                           'periodic_fuzzy_delay': 5,
                            'handle_internal_only_router': True,
                            'ext_net_id': 'netid',
                            'plugin': 'ovs'})
@@ -98,6 +102,46 @@ class TestL3AgentContext(CharmTestCase):
         self.assertEquals(neutron_contexts.L3AgentContext()()['agent_mode'],
                           'dvr_snat')
 
+    @patch('neutron_contexts.NeutronAPIContext')
+    def test_l3ha(self, _NeutronAPIContext):
+        _NeutronAPIContext.return_value = \
+            DummyNeutronAPIContext(return_value={'enable_dvr': False,
+                                                 'enable_l3ha': True})
+        self.test_config.set('ha-vrrp-advert-int', 1)
+        self.test_config.set('send-arp-for-ha', 0)
+        self.test_config.set('periodic-fuzzy-delay', 30)
+        ctxt = neutron_contexts.L3AgentContext()()
+        self.assertEquals(ctxt['ha_vrrp_advert_int'], 1)
+        self.assertEquals(ctxt['send_arp_for_ha'], 0)
+        self.assertEquals(ctxt['periodic_fuzzy_delay'], 30)
+        self.assertFalse('ha_vrrp_auth_type' in ctxt)
+        self.assertFalse('ha_vrrp_auth_password' in ctxt)
+
+    @patch.object(neutron_contexts, 'log')
+    @patch('neutron_contexts.NeutronAPIContext')
+    def test_l3ha_auth(self, _NeutronAPIContext, _log):
+        _NeutronAPIContext.return_value = \
+            DummyNeutronAPIContext(return_value={'enable_dvr': False,
+                                                 'enable_l3ha': True})
+        self.test_config.set('ha-vrrp-auth-password', 'vrrpsecret')
+        ctxt = neutron_contexts.L3AgentContext()()
+        self.assertEquals(ctxt['ha_vrrp_auth_type'], 'PASS')
+        self.assertEquals(ctxt['ha_vrrp_auth_password'], 'vrrpsecret')
+        self.test_config.set('ha-vrrp-auth-type', 'MD5')
+        ctxt = neutron_contexts.L3AgentContext()()
+        self.assertEquals(ctxt['ha_vrrp_auth_type'], 'PASS')
+        self.assertTrue(_log.called)
+
+    @patch('neutron_contexts.NeutronAPIContext')
+    def test_no_l3ha(self, _NeutronAPIContext):
+        _NeutronAPIContext.return_value = \
+            DummyNeutronAPIContext(return_value={'enable_dvr': False,
+                                                 'enable_l3ha': False})
+        self.test_config.set('ha-vrrp-auth-password', 'vrrpsecret')
+        ctxt = neutron_contexts.L3AgentContext()()
+        self.assertFalse('ha_vrrp_advert_int' in ctxt)
+        self.assertFalse('ha_vrrp_auth_password' in ctxt)
+
 
 class TestNeutronGatewayContext(CharmTestCase):
 
@@ -146,6 +190,8 @@ class TestNeutronGatewayContext(CharmTestCase):
             'verbose': True,
             'l2_population': True,
             'overlay_network_type': 'gre',
+            'firewall_driver': 'iptables_hybrid',
+            'rootwrap_daemon': True,
             'bridge_mappings': 'physnet1:br-data',
             'network_providers': 'physnet3,physnet4',
             'vlan_ranges': 'physnet1:1000:2000,physnet2:2001:3000',
@@ -158,6 +204,188 @@ class TestNeutronGatewayContext(CharmTestCase):
         })
 
 
+class TestDHCPAgentContext(CharmTestCase):
+
+    def setUp(self):
+        super(TestDHCPAgentContext, self).setUp(neutron_contexts, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_defaults(self, _num_cpus):
+        _num_cpus.return_value = 2
+        self.assertEquals(neutron_contexts.DHCPAgentContext()(), {
+            'num_sync_threads': 4,
+            'dhcp_lease_duration': 86400,
+        })
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_n1kv(self, _num_cpus):
+        _num_cpus.return_value = 16
+        self.test_config.set('plugin', 'n1kv')
+        self.assertEquals(neutron_contexts.DHCPAgentContext()(), {
+            'num_sync_threads': 16,
+            'dhcp_lease_duration': 3600,
+        })
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_explicit(self, _num_cpus):
+        _num_cpus.return_value = 16
+        self.test_config.set('dhcp-num-sync-threads', 8)
+        self.test_config.set('dhcp-lease-duration', 172800)
+        self.test_config.set('dnsmasq-lease-max', 65536)
+        self.test_config.set('dnsmasq-dns-servers', '10.0.0.2 10.0.0.3')
+        self.assertEquals(neutron_contexts.DHCPAgentContext()(), {
+            'num_sync_threads': 8,
+            'dhcp_lease_duration': 172800,
+            'dnsmasq_lease_max': 65536,
+            'dnsmasq_dns_servers': '10.0.0.2,10.0.0.3',
+        })
+
+
+class TestMetadataAgentContext(CharmTestCase):
+
+    def setUp(self):
+        super(TestMetadataAgentContext, self).setUp(
+            neutron_contexts,
+            TO_PATCH + ['relation_ids', 'related_units', 'relation_get'])
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.return_value = []
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_defaults(self, _num_cpus):
+        _num_cpus.return_value = 4
+        self.assertEquals(neutron_contexts.MetadataAgentContext()(), {
+            'metadata_cache_ttl': 5,
+            'metadata_workers': 4,
+            'metadata_backlog': 4096,
+            'metadata_keep_alive': True,
+            'nova_metadata_insecure': False,
+        })
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_backlog_scales_with_workers(self, _num_cpus):
+        _num_cpus.return_value = 16
+        ctxt = neutron_contexts.MetadataAgentContext()()
+        self.assertEquals(ctxt['metadata_workers'], 16)
+        self.assertEquals(ctxt['metadata_backlog'], 8192)
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_memcache(self, _num_cpus):
+        _num_cpus.return_value = 4
+        rdata = {
+            'memcached/1': {'host': '10.0.0.11', 'port': '11211'},
+            'memcached/0': {'host': '10.0.0.10', 'port': '11211'},
+            'memcached/2': {},
+        }
+        self.relation_ids.return_value = ['memcache:1']
+        self.related_units.return_value = sorted(rdata.keys())
+        self.relation_get.side_effect = \
+            lambda key, rid, unit: rdata[unit].get(key)
+        ctxt = neutron_contexts.MetadataAgentContext()()
+        self.assertEquals(ctxt['memcached_servers'],
+                          '10.0.0.10:11211,10.0.0.11:11211')
+        self.relation_ids.assert_called_with('memcache')
+
+
+class TestMessagingTuningContext(CharmTestCase):
+
+    def setUp(self):
+        super(TestMessagingTuningContext, self).setUp(neutron_contexts,
+                                                      TO_PATCH)
+        self.config.side_effect = self.test_config.get
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_defaults(self, _num_cpus):
+        _num_cpus.return_value = 4
+        self.assertEquals(neutron_contexts.MessagingTuningContext()(), {
+            'rpc_response_timeout': 60,
+            'rpc_conn_pool_size': 30,
+            'rpc_thread_pool_size': 64,
+            'report_interval': 30,
+            'rabbit_heartbeat_timeout_threshold': 60,
+        })
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_sized_from_cpus(self, _num_cpus):
+        _num_cpus.return_value = 32
+        self.test_config.set('agent-down-time', 150)
+        ctxt = neutron_contexts.MessagingTuningContext()()
+        self.assertEquals(ctxt['rpc_conn_pool_size'], 128)
+        self.assertEquals(ctxt['rpc_thread_pool_size'], 256)
+        self.assertEquals(ctxt['report_interval'], 60)
+        self.assertEquals(ctxt['rabbit_heartbeat_timeout_threshold'], 120)
+
+    @patch.object(neutron_contexts.WorkerConfigContext, 'num_cpus',
+                  new_callable=PropertyMock)
+    def test_explicit(self, _num_cpus):
+        _num_cpus.return_value = 32
+        self.test_config.set('rpc-response-timeout', 180)
+        self.test_config.set('rpc-conn-pool-size', 10)
+        self.test_config.set('rpc-thread-pool-size', 20)
+        self.test_config.set('report-interval', 15)
+        self.test_config.set('rabbit-heartbeat-timeout-threshold', 0)
+        self.assertEquals(neutron_contexts.MessagingTuningContext()(), {
+            'rpc_response_timeout': 180,
+            'rpc_conn_pool_size': 10,
+            'rpc_thread_pool_size': 20,
+            'report_interval': 15,
+            'rabbit_heartbeat_timeout_threshold': 0,
+        })
+
+
+class TestOVSInterfaceContext(CharmTestCase):
+
+    def setUp(self):
+        super(TestOVSInterfaceContext, self).setUp(
+            neutron_contexts, TO_PATCH + ['get_os_codename_install_source',
+                                          'log'])
+        self.config.side_effect = self.test_config.get
+
+    def _ctxt(self, release):
+        self.get_os_codename_install_source.return_value = release
+        return neutron_contexts.OVSInterfaceContext()()
+
+    def test_defaults(self):
+        self.assertEquals(self._ctxt('kilo'), {})
+        self.assertEquals(self._ctxt('liberty'), {'ovsdb_interface': 'vsctl'})
+        self.assertEquals(self._ctxt('mitaka'), {
+            'ovsdb_interface': 'vsctl',
+            'of_interface': 'ovs-ofctl',
+        })
+
+    def test_native(self):
+        self.test_config.set('ovsdb-interface', 'native')
+        self.test_config.set('of-interface', 'native')
+        self.assertEquals(self._ctxt('kilo'), {})
+        self.assertEquals(self._ctxt('liberty'), {
+            'ovsdb_interface': 'native',
+            'ovsdb_connection': 'tcp:127.0.0.1:6640',
+        })
+        self.assertEquals(self._ctxt('mitaka'), {
+            'ovsdb_interface': 'native',
+            'ovsdb_connection': 'tcp:127.0.0.1:6640',
+            'of_interface': 'native',
+        })
+
+    def test_ovsdb_interface(self):
+        self.test_config.set('ovsdb-interface', 'native')
+        self.assertEquals(neutron_contexts.ovsdb_interface('kilo'), 'vsctl')
+        self.assertEquals(neutron_contexts.ovsdb_interface('liberty'),
+                          'native')
+        self.test_config.set('ovsdb-interface', 'bogus')
+        self.assertEquals(neutron_contexts.ovsdb_interface('liberty'),
+                          'vsctl')
+        self.assertTrue(self.log.called)
+
+
 class TestSharedSecret(CharmTestCase):
 
     def setUp(self):
@@ -194,19 +422,6 @@ class TestHostIP(CharmTestCase):
         super(TestHostIP, self).setUp(neutron_contexts,
                                       TO_PATCH)
         self.config.side_effect = self.test_config.get
-        # Save and inject
-        self.mods = {'dns': None, 'dns.resolver': None}
-        for mod in self.mods:
-            if mod not in sys.modules:
-                sys.modules[mod] = Mock()
-            else:
-                del self.mods[mod]
-
-    def tearDown(self):
-        super(TestHostIP, self).tearDown()
-        # Cleanup
-        for mod in self.mods.keys():
-            del sys.modules[mod]
 
     def test_get_host_ip_already_ip(self):
         self.assertEquals(neutron_contexts.get_host_ip('10.5.0.1'),
@@ -217,22 +432,12 @@ class TestHostIP(CharmTestCase):
         self.assertEquals(neutron_contexts.get_host_ip(),
                           '10.5.0.1')
 
-    @patch('dns.resolver.query')
-    def test_get_host_ip_hostname_unresolvable(self, _query):
-        class NXDOMAIN(Exception):
-            pass
-        _query.side_effect = NXDOMAIN()
-        self.assertRaises(NXDOMAIN, neutron_contexts.get_host_ip,
-                          'missing.example.com')
-
-    @patch('dns.resolver.query')
-    def test_get_host_ip_hostname_resolvable(self, _query):
-        data = MagicMock()
-        data.address = '10.5.0.1'
-        _query.return_value = [data]
+    @patch.object(neutron_contexts, 'resolve_host_ip')
+    def test_get_host_ip_hostname(self, _resolve):
+        _resolve.return_value = '10.5.0.1'
         self.assertEquals(neutron_contexts.get_host_ip('myhost.example.com'),
                           '10.5.0.1')
-        _query.assert_called_with('myhost.example.com', 'A')
+        _resolve.assert_called_with('myhost.example.com')
 
 
 class TestMisc(CharmTestCase):
@@ -246,3 +451,16 @@ class TestMisc(CharmTestCase):
         self.config.return_value = 'ovs'
         self.assertEquals(neutron_contexts.core_plugin(),
                           neutron_contexts.NEUTRON_ML2_PLUGIN)
+
+    def test_firewall_driver(self):
+        self.config.return_value = 'openvswitch'
+        self.assertEquals(neutron_contexts.firewall_driver(), 'openvswitch')
+        self.config.return_value = 'noop'
+        self.assertEquals(neutron_contexts.firewall_driver(), 'noop')
+
+    @patch.object(neutron_contexts, 'log')
+    def test_firewall_driver_invalid(self, _log):
+        self.config.return_value = 'ebtables'
+        self.assertEquals(neutron_contexts.firewall_driver(),
+                          'iptables_hybrid')
+        self.assertTrue(_log.called)
@@ -0,0 +1,92 @@
+from mock import MagicMock
+
+import neutron_discovery
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'time',
+]
+
+
+class TestAgentDiscovery(CharmTestCase):
+
+    def setUp(self):
+        super(TestAgentDiscovery, self).setUp(neutron_discovery, TO_PATCH)
+        self.time.time.return_value = 0
+        self.client = MagicMock()
+        self.discovery = neutron_discovery.AgentDiscovery(self.client,
+                                                          page_size=2)
+
+    def _agents(self, *ids, **kwargs):
+        agents = {'agents': [{'id': i, 'host': 'gw1', 'alive': i != 'dead'}
+                             for i in ids]}
+        if kwargs.get('next_page'):
+            agents['agents_links'] = [{'rel': 'next',
+                                       'href': 'http://neutron/agents'}]
+        return agents
+
+    def test_agents_fields_and_filters(self):
+        self.client.list_agents.return_value = self._agents('a1', 'dead')
+        agents = self.discovery.agents(agent_type='L3 agent', host='gw1',
+                                       alive=True)
+        self.assertEquals([a['id'] for a in agents], ['a1'])
+        self.client.list_agents.assert_called_once_with(
+            fields=neutron_discovery.AGENT_FIELDS, agent_type='L3 agent',
+            host='gw1', limit=2)
+
+    def test_agents_configurations(self):
+        self.client.list_agents.return_value = self._agents('a1')
+        self.discovery.agents(configurations=True)
+        self.client.list_agents.assert_called_once_with(
+            fields=neutron_discovery.AGENT_FIELDS + ['configurations'],
+            limit=2)
+
+    def test_agents_paginated(self):
+        self.client.list_agents.side_effect = [
+            self._agents('a1', 'a2', next_page=True), self._agents('a3')]
+        agents = self.discovery.agents()
+        self.assertEquals([a['id'] for a in agents], ['a1', 'a2', 'a3'])
+        self.client.list_agents.assert_called_with(
+            fields=neutron_discovery.AGENT_FIELDS, limit=2, marker='a2')
+
+    def test_agents_last_page(self):
+        # A full page without a next link is the last
+        self.client.list_agents.return_value = self._agents('a1', 'a2')
+        agents = self.discovery.agents()
+        self.assertEquals([a['id'] for a in agents], ['a1', 'a2'])
+        self.assertEquals(self.client.list_agents.call_count, 1)
+
+    def test_agents_pagination_unsupported(self):
+        # Servers without pagination ignore the limit and return everything
+        self.client.list_agents.return_value = self._agents(
+            'a1', 'a2', 'a3', next_page=True)
+        agents = self.discovery.agents()
+        self.assertEquals([a['id'] for a in agents], ['a1', 'a2', 'a3'])
+        self.assertEquals(self.client.list_agents.call_count, 1)
+
+    def test_agents_marker_ignored(self):
+        self.client.list_agents.return_value = self._agents(
+            'a1', 'a2', next_page=True)
+        agents = self.discovery.agents()
+        self.assertEquals([a['id'] for a in agents], ['a1', 'a2'])
+        self.assertEquals(self.client.list_agents.call_count, 2)
+
+    def test_resources_and_stats(self):
+        self.time.time.side_effect = [0, 0.5, 1, 1.25]
+        self.client.list_routers_on_l3_agent.return_value = {
+            'routers': [{'id': 'r1'}]}
+        self.client.list_networks_on_dhcp_agent.return_value = {
+            'networks': [{'id': 'n1'}]}
+        self.assertEquals(self.discovery.routers_on_l3_agent('a1'),
+                          [{'id': 'r1'}])
+        self.client.list_routers_on_l3_agent.assert_called_once_with(
+            'a1', fields=neutron_discovery.ROUTER_FIELDS)
+        self.assertEquals(self.discovery.networks_on_dhcp_agent('a2'),
+                          [{'id': 'n1'}])
+        self.assertEquals(self.discovery.stats['list_routers_on_l3_agent'],
+                          {'calls': 1, 'bytes': 27, 'seconds': 0.5})
+        self.assertEquals(self.discovery.summary(), [
+            'list_networks_on_dhcp_agent: 1 calls, 28 bytes, 0.25s',
+            'list_routers_on_l3_agent: 1 calls, 27 bytes, 0.50s',
+        ])
@@ -0,0 +1,140 @@
+import sys
+
+from mock import MagicMock, Mock, patch
+
+import neutron_dns
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'kv',
+    'log',
+    'time',
+]
+
+
+class NXDOMAIN(Exception):
+    pass
+
+
+class TestDNSCache(CharmTestCase):
+
+    def setUp(self):
+        super(TestDNSCache, self).setUp(neutron_dns, TO_PATCH)
+        self.db = {}
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.time.time.return_value = 1000
+        # Save and inject
+        self.mods = {'dns': None, 'dns.resolver': None,
+                     'dns.reversename': None}
+        for mod in self.mods.keys():
+            if mod not in sys.modules:
+                sys.modules[mod] = Mock()
+            else:
+                del self.mods[mod]
+
+    def tearDown(self):
+        super(TestDNSCache, self).tearDown()
+        # Cleanup
+        for mod in self.mods.keys():
+            del sys.modules[mod]
+
+    def _answers(self, ttl, **kwargs):
+        record = MagicMock(**kwargs)
+        answers = MagicMock()
+        answers.__len__.return_value = 1
+        answers.__getitem__.return_value = record
+        answers.rrset.ttl = ttl
+        return answers
+
+    @patch('dns.resolver.query')
+    def test_resolve_host_ip_literal(self, _query):
+        self.assertEquals(neutron_dns.resolve_host_ip('10.5.0.1'),
+                          '10.5.0.1')
+        self.assertFalse(_query.called)
+        self.assertFalse(self.kv.called)
+
+    @patch('dns.resolver.query')
+    def test_resolve_host_ip_cached(self, _query):
+        _query.return_value = self._answers(600, address='10.5.0.1')
+        self.assertEquals(neutron_dns.resolve_host_ip('myhost.example.com'),
+                          '10.5.0.1')
+        _query.assert_called_once_with('myhost.example.com', 'A')
+        self.assertEquals(
+            self.db[neutron_dns.DNS_CACHE_KEY],
+            {'A:myhost.example.com': ['10.5.0.1', 1600]})
+        self.kv.return_value.flush.assert_called_once_with()
+        self.time.time.return_value = 1599
+        self.assertEquals(neutron_dns.resolve_host_ip('myhost.example.com'),
+                          '10.5.0.1')
+        self.assertEquals(_query.call_count, 1)
+        self.time.time.return_value = 1600
+        neutron_dns.resolve_host_ip('myhost.example.com')
+        self.assertEquals(_query.call_count, 2)
+
+    @patch('dns.resolver.query')
+    def test_resolve_host_ip_ttl_bounds(self, _query):
+        _query.return_value = self._answers(86400, address='10.5.0.1')
+        neutron_dns.resolve_host_ip('myhost.example.com')
+        self.assertEquals(
+            self.db[neutron_dns.DNS_CACHE_KEY]['A:myhost.example.com'][1],
+            1000 + neutron_dns.MAX_TTL)
+
+    @patch('dns.resolver.query')
+    def test_resolve_host_ip_negative(self, _query):
+        _query.side_effect = NXDOMAIN()
+        self.assertRaises(neutron_dns.DNSLookupError,
+                          neutron_dns.resolve_host_ip, 'missing.example.com')
+        self.assertRaises(neutron_dns.DNSLookupError,
+                          neutron_dns.resolve_host_ip, 'missing.example.com')
+        self.assertEquals(_query.call_count, 1)
+        self.time.time.return_value = 1000 + neutron_dns.NEGATIVE_TTL
+        self.assertRaises(neutron_dns.DNSLookupError,
+                          neutron_dns.resolve_host_ip, 'missing.example.com')
+        self.assertEquals(_query.call_count, 2)
+
+    def test_cache_set_expires_entries(self):
+        self.db[neutron_dns.DNS_CACHE_KEY] = {
+            'A:old.example.com': ['10.5.0.2', 999],
+            'A:new.example.com': ['10.5.0.3', 1001],
+        }
+        neutron_dns.cache_set('PTR', '10.5.0.1', 'myhost.', 60)
+        self.assertEquals(self.db[neutron_dns.DNS_CACHE_KEY], {
+            'A:new.example.com': ['10.5.0.3', 1001],
+            'PTR:10.5.0.1': ['myhost.', 1060],
+        })
+
+    def test_get_hostname_not_ip(self):
+        self.assertEquals(neutron_dns.get_hostname('myhost.example.com'),
+                          'myhost.example.com')
+        self.assertEquals(
+            neutron_dns.get_hostname('myhost.example.com', fqdn=False),
+            'myhost')
+        self.assertFalse(self.kv.called)
+
+    @patch('dns.reversename.from_address')
+    @patch('dns.resolver.query')
+    def test_get_hostname_cached(self, _query, _from_address):
+        _from_address.return_value = '1.0.5.10.in-addr.arpa.'
+        answers = self._answers(120)
+        answers.__getitem__.return_value = 'myhost.example.com.'
+        _query.return_value = answers
+        self.assertEquals(neutron_dns.get_hostname('10.5.0.1'),
+                          'myhost.example.com')
+        _query.assert_called_once_with('1.0.5.10.in-addr.arpa.', 'PTR')
+        self.assertEquals(neutron_dns.get_hostname('10.5.0.1', fqdn=False),
+                          'myhost')
+        self.assertEquals(_query.call_count, 1)
+
+    @patch.object(neutron_dns.socket, 'gethostbyaddr')
+    @patch('dns.resolver.query')
+    def test_get_hostname_negative(self, _query, _gethostbyaddr):
+        _query.side_effect = NXDOMAIN()
+        _gethostbyaddr.side_effect = Exception()
+        self.assertEquals(neutron_dns.get_hostname('10.5.0.1'), None)
+        self.assertEquals(neutron_dns.get_hostname('10.5.0.1'), None)
+        self.assertEquals(_query.call_count, 1)
+        self.assertEquals(
+            self.db[neutron_dns.DNS_CACHE_KEY],
+            {'PTR:10.5.0.1': [None, 1000 + neutron_dns.NEGATIVE_TTL]})
@@ -0,0 +1,550 @@
+import imp
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from mock import MagicMock, patch
+
+from test_utils import CharmTestCase
+
+
+class NeutronException(Exception):
+    pass
+
+
+def load_monitor():
+    '''Load files/neutron-ha-monitor.py with neutron and oslo stubbed'''
+    stubs = dict((name, MagicMock()) for name in [
+        'oslo', 'oslo.config', 'neutron', 'neutron.agent',
+        'neutron.agent.linux', 'neutron.common', 'neutron.openstack',
+        'neutron.openstack.common'])
+    stubs['neutron.common'].exceptions.NeutronException = NeutronException
+    path = os.path.join(os.path.dirname(__file__), '..', 'files',
+                        'neutron-ha-monitor.py')
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    # Only the stubs are removed afterwards; real modules the monitor
+    # imports stay loaded for it to use
+    saved = dict((name, sys.modules[name]) for name in stubs
+                 if name in sys.modules)
+    sys.modules.update(stubs)
+    try:
+        return imp.load_source('neutron_ha_monitor', path)
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+        for name in stubs:
+            del sys.modules[name]
+        sys.modules.update(saved)
+
+
+monitor = load_monitor()
+
+TO_PATCH = [
+    'LOG',
+    'cfg',
+    'subprocess',
+    'time',
+]
+
+
+class MonitorTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(MonitorTestCase, self).setUp(monitor, TO_PATCH)
+        self.time.time.return_value = 1000
+        self.cfg.CONF.heartbeat_threshold = 60
+        self.cfg.CONF.failover_event_log = None
+        self.daemon = monitor.MonitorNeutronAgentsDaemon()
+        self.daemon.env = {'heartbeat_threshold': '60'}
+        self.daemon.get_env = lambda: self.daemon.env
+        self.daemon.hostname = 'gw1'
+
+    def agent(self, agent_id='a1', host='gw2', alive=True, heartbeat='t1',
+              agent_type='L3 agent'):
+        return {'id': agent_id, 'host': host, 'alive': alive,
+                'heartbeat_timestamp': heartbeat, 'agent_type': agent_type}
+
+
+class TestHeartbeats(MonitorTestCase):
+
+    def test_heartbeat_age(self):
+        self.assertEquals(self.daemon.heartbeat_age(self.agent()), 0)
+        self.time.time.return_value = 1045
+        self.assertEquals(self.daemon.heartbeat_age(self.agent()), 45)
+        # A new heartbeat restarts the clock
+        self.assertEquals(
+            self.daemon.heartbeat_age(self.agent(heartbeat='t2')), 0)
+
+    def test_heartbeat_threshold(self):
+        self.assertEquals(self.daemon.get_heartbeat_threshold(), 60.0)
+        self.daemon.env = {}
+        self.cfg.CONF.heartbeat_threshold = 90
+        self.assertEquals(self.daemon.get_heartbeat_threshold(), 90.0)
+
+    def test_agent_not_alive_is_down(self):
+        self.assertTrue(self.daemon.is_agent_down(self.agent(alive=False)))
+        self.assertEquals(self.daemon.detected['a1'],
+                          (1000, 'agent_down_time'))
+
+    def test_stale_heartbeat_suspected(self):
+        self.daemon.is_host_lost = MagicMock(return_value=False)
+        self.assertFalse(self.daemon.is_agent_down(self.agent()))
+        self.time.time.return_value = 1061
+        self.assertFalse(self.daemon.is_agent_down(self.agent()))
+        self.assertEquals(self.daemon.suspected, {'a1': 1061})
+        self.daemon.is_host_lost.assert_called_once_with('gw2')
+        self.assertEquals(self.daemon.detected, {})
+
+    def test_stale_heartbeat_host_lost(self):
+        self.daemon.is_host_lost = MagicMock(return_value=True)
+        self.daemon.is_agent_down(self.agent())
+        self.time.time.return_value = 1061
+        self.assertTrue(self.daemon.is_agent_down(self.agent()))
+        self.assertEquals(self.daemon.detected['a1'], (1061, 'heartbeat'))
+        # Recovery clears suspicion
+        self.assertFalse(self.daemon.is_agent_down(self.agent(heartbeat='t2')))
+        self.assertEquals(self.daemon.suspected, {})
+        self.assertEquals(self.daemon.detected, {})
+
+    def test_threshold_disabled(self):
+        self.daemon.env = {'heartbeat_threshold': '0'}
+        self.daemon.is_agent_down(self.agent())
+        self.time.time.return_value = 5000
+        self.assertFalse(self.daemon.is_agent_down(self.agent()))
+        self.assertEquals(self.daemon.suspected, {})
+
+
+class TestFailoverEvents(MonitorTestCase):
+
+    def test_record_failover_events(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.cfg.CONF.failover_event_log = os.path.join(tmpdir, 'events')
+        self.daemon.suspected = {'a1': 900}
+        self.daemon.detected = {'a1': (950, 'heartbeat')}
+        self.daemon.record_failover_events({'r1': 'a1', 'r2': 'a1',
+                                            'r3': 'a2'})
+        with open(self.cfg.CONF.failover_event_log) as f:
+            events = sorted((json.loads(line) for line in f),
+                            key=lambda e: e['agent'])
+        self.assertEquals(events[0], {
+            'agent': 'a1', 'reason': 'heartbeat', 'resources': 2,
+            'suspected_at': 900, 'detected_at': 950, 'rescheduled_at': 1000,
+            'latency': 50})
+        self.assertEquals(events[1]['reason'], 'unknown')
+        self.assertEquals(events[1]['latency'], 0)
+        self.assertEquals(self.daemon.failovers, 2)
+        self.assertEquals(len(self.daemon.failover_events), 2)
+
+    def test_failover_events_bounded(self):
+        for i in range(monitor.STATUS_EVENTS + 5):
+            self.daemon.record_failover_events({'r%d' % i: 'a%d' % i})
+        self.assertEquals(len(self.daemon.failover_events),
+                          monitor.STATUS_EVENTS)
+        self.assertEquals(self.daemon.failover_events[-1]['agent'],
+                          'a%d' % (monitor.STATUS_EVENTS + 4))
+
+
+class TestLocalAgents(MonitorTestCase):
+
+    def setUp(self):
+        super(TestLocalAgents, self).setUp()
+        self.daemon.env['hang_threshold'] = '300'
+        self.procs = {'1': 'ovsdb-server', '2': 'ovs-vswitchd',
+                      '3': 'neutron-dhcp-agent', '4': 'neutron-metadata-agent',
+                      '5': 'neutron-vpn-agent'}
+        self.daemon.process_names = lambda pid: set(
+            [self.procs[pid]] if pid in self.procs else [])
+        self.daemon.restart_service = MagicMock()
+        patcher = patch.object(monitor.os, 'listdir')
+        self.listdir = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.listdir.side_effect = lambda path: list(self.procs) + ['self']
+
+    def local(self, alive, heartbeat_at=0):
+        self.daemon.local_agents = [self.agent(
+            agent_id='d1', host='gw1', alive=alive, agent_type='DHCP agent')]
+        self.daemon.heartbeats = {'d1': ('t1', heartbeat_at)}
+
+    def test_hang_threshold(self):
+        self.assertEquals(self.daemon.get_hang_threshold(), 300.0)
+        self.daemon.env = {}
+        self.cfg.CONF.hang_threshold = 600
+        self.assertEquals(self.daemon.get_hang_threshold(), 600.0)
+
+    def test_all_running(self):
+        self.local(alive=True)
+        self.daemon.check_local_agents()
+        self.assertFalse(self.daemon.restart_service.called)
+        self.listdir.assert_called_once_with('/proc')
+        # Remembered pids avoid rescanning /proc
+        self.daemon.check_local_agents()
+        self.listdir.assert_called_once_with('/proc')
+
+    def test_missing_process_started(self):
+        del self.procs['3']
+        self.local(alive=True)
+        self.daemon.check_local_agents()
+        self.daemon.restart_service.assert_called_once_with(
+            'neutron-dhcp-agent', 'start')
+
+    def test_metadata_restart_restarts_vpn(self):
+        del self.procs['4']
+        self.daemon.check_local_agents()
+        self.assertEquals(self.daemon.restart_service.call_args_list, [
+            (('neutron-metadata-agent', 'start'),),
+            (('neutron-vpn-agent',),)])
+
+    def test_stale_heartbeat_alive_not_hung(self):
+        # neutron-server still reports the agent alive
+        self.local(alive=True)
+        self.time.time.return_value = 5000
+        self.daemon.check_local_agents()
+        self.assertFalse(self.daemon.restart_service.called)
+
+    def test_down_within_threshold_not_hung(self):
+        self.local(alive=False, heartbeat_at=900)
+        self.daemon.check_local_agents()
+        self.assertFalse(self.daemon.restart_service.called)
+
+    def test_hang_disabled(self):
+        self.daemon.env['hang_threshold'] = '0'
+        self.local(alive=False)
+        self.daemon.check_local_agents()
+        self.assertFalse(self.daemon.restart_service.called)
+
+    def test_hung_restart_backs_off(self):
+        self.local(alive=False)
+        self.daemon.check_local_agents()
+        self.daemon.restart_service.assert_called_once_with(
+            'neutron-dhcp-agent')
+        self.assertEquals(self.daemon.hang_restarts,
+                          {'neutron-dhcp-agent': (1, 1000)})
+        self.assertEquals(self.daemon.heartbeats, {})
+        # Still hung: the second restart waits hang_threshold, the third
+        # twice that
+        for now, restarts in [(1200, 1), (1300, 2), (1800, 2), (1900, 3)]:
+            self.time.time.return_value = now
+            self.local(alive=False)
+            self.daemon.check_local_agents()
+            self.assertEquals(self.daemon.restart_service.call_count,
+                              restarts)
+        self.assertEquals(self.daemon.hang_restarts,
+                          {'neutron-dhcp-agent': (3, 1900)})
+
+    def test_backoff_capped(self):
+        self.daemon.hang_restarts = {'neutron-dhcp-agent': (20, 0)}
+        self.time.time.return_value = monitor.HANG_RESTART_BACKOFF_MAX
+        self.assertTrue(self.daemon.may_restart_hung('neutron-dhcp-agent'))
+
+    def test_recovery_resets_backoff(self):
+        self.daemon.hang_restarts = {'neutron-dhcp-agent': (3, 900)}
+        self.local(alive=True)
+        self.daemon.check_local_agents()
+        self.assertEquals(self.daemon.hang_restarts, {})
+
+
+class TestStatus(MonitorTestCase):
+
+    def setUp(self):
+        super(TestStatus, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.cfg.CONF.status_file = os.path.join(tmpdir, 'status.json')
+        self.cfg.CONF.check_interval = 15
+
+    def test_write_status(self):
+        umask = os.umask(0)
+        try:
+            self.daemon.write_status(1000, 2.5, {'list_agents': 2})
+        finally:
+            os.umask(umask)
+        self.assertEquals(os.stat(self.cfg.CONF.status_file).st_mode & 0o777,
+                          0o644)
+        with open(self.cfg.CONF.status_file) as f:
+            lines = f.readlines()
+        # The OCF agent reads the status with a single shell read
+        self.assertEquals(len(lines), 1)
+        status = json.loads(lines[0])
+        self.assertEquals(status['last_cycle'], 1000)
+        self.assertEquals(status['cycle_api_calls'], {'list_agents': 2})
+        self.assertEquals(status['pid'], os.getpid())
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        self.assertTrue(isinstance(status['uptime'], int))
+        self.assertTrue(0 <= uptime - status['uptime'] < 60)
+
+    def test_reschedule_touches_status(self):
+        self.daemon.write_status(1000, 2.5, {})
+        with open(self.cfg.CONF.status_file) as f:
+            status = json.load(f)
+        status['uptime'] = 0
+        with open(self.cfg.CONF.status_file, 'w') as f:
+            f.write(json.dumps(status))
+        self.daemon.status['uptime'] = 0
+        self.daemon.is_lead_node = MagicMock(return_value=True)
+        quantum = MagicMock()
+        self.daemon.l3_agents_reschedule(['a2'], {'r1': 'a1'}, quantum)
+        quantum.add_router_to_l3_agent.assert_called_once_with(
+            l3_agent='a2', body={'router_id': 'r1'})
+        with open(self.cfg.CONF.status_file) as f:
+            status = json.load(f)
+        self.assertNotEquals(status['uptime'], 0)
+        self.assertEquals(status['last_cycle'], 1000)
+
+    def test_touch_status_before_first_cycle(self):
+        self.daemon.touch_status()
+        with open(self.cfg.CONF.status_file) as f:
+            status = json.load(f)
+        self.assertEquals(sorted(status), ['pid', 'uptime'])
+
+    def test_touch_status_failed(self):
+        self.cfg.CONF.status_file = '/nonexistent/status.json'
+        self.daemon.touch_status()
+        self.assertTrue(self.LOG.error.called)
+
+
+class TestInventory(MonitorTestCase):
+
+    def setUp(self):
+        super(TestInventory, self).setUp()
+        self.cfg.CONF.inventory_deadline = 5
+        self.pool = MagicMock()
+        self.daemon.get_pool = lambda: self.pool
+        self.results = {}
+        self.pool.apply_async.side_effect = self.apply_async
+
+    def apply_async(self, func, args):
+        result = MagicMock()
+        result.ready.return_value = True
+        result.get.return_value = ['hosted by %s' % args[1]]
+        self.results[args[1]] = result
+        return result
+
+    def submitted(self):
+        return [args[0][1][:2]
+                for args in self.pool.apply_async.call_args_list]
+
+    def test_down_and_local_agents_down_first(self):
+        inventory = self.daemon.collect_inventory([
+            (self.agent('a1', host='gw2'), False, 'l3'),
+            (self.agent('a2', host='gw1'), False, 'dhcp'),
+            (self.agent('a3', host='gw2'), True, 'l3'),
+            (self.agent('a4', host='gw3'), True, 'dhcp'),
+        ])
+        self.assertEquals(self.submitted(),
+                          [('l3', 'a3'), ('dhcp', 'a4'), ('dhcp', 'a2')])
+        self.assertEquals(inventory[('l3', 'a3')], ['hosted by a3'])
+        self.assertEquals(len(inventory), 3)
+        self.assertEquals(self.daemon.inflight, {})
+
+    def test_deadline_lookup_not_resubmitted(self):
+        agents = [(self.agent('a1'), True, 'l3'),
+                  (self.agent('a2'), True, 'l3')]
+        self.pool.apply_async.side_effect = None
+        hung = MagicMock()
+        hung.ready.return_value = False
+        hung.get.side_effect = monitor.TimeoutError
+        self.pool.apply_async.return_value = hung
+        inventory = self.daemon.collect_inventory(agents[:1])
+        self.assertEquals(inventory, {})
+        self.assertEquals(self.daemon.inflight, {('l3', 'a1'): hung})
+
+        self.pool.apply_async.reset_mock()
+        self.pool.apply_async.side_effect = self.apply_async
+        inventory = self.daemon.collect_inventory(agents)
+        # Still running, so waited on again rather than queued twice
+        self.assertEquals(self.submitted(), [('l3', 'a2')])
+        self.assertEquals(inventory.keys(), [('l3', 'a2')])
+        self.assertEquals(self.daemon.inflight, {('l3', 'a1'): hung})
+
+        # Once it has finished a late result is looked up again
+        hung.ready.return_value = True
+        self.pool.apply_async.reset_mock()
+        inventory = self.daemon.collect_inventory(agents)
+        self.assertEquals(self.submitted(), [('l3', 'a1'), ('l3', 'a2')])
+        self.assertEquals(inventory[('l3', 'a1')], ['hosted by a1'])
+        self.assertEquals(self.daemon.inflight, {})
+
+    def test_client_per_worker(self):
+        self.daemon.make_client = MagicMock(
+            side_effect=lambda env: MagicMock())
+        env = {'region': 'r1'}
+        self.daemon.list_hosted('l3', 'a1', env)
+        self.daemon.list_hosted('dhcp', 'a2', env)
+        self.assertEquals(self.daemon.make_client.call_count, 1)
+        worker = threading.Thread(target=self.daemon.list_hosted,
+                                  args=('l3', 'a3', env))
+        worker.start()
+        worker.join()
+        self.assertEquals(self.daemon.make_client.call_count, 2)
+        # A changed env gets a new client
+        self.daemon.list_hosted('l3', 'a1', {'region': 'r2'})
+        self.assertEquals(self.daemon.make_client.call_count, 3)
+
+
+CRM_MON_XML = '''<crm_mon version="1.1.10">
+  <nodes>
+    <node name="gw1.maas" id="1" online="true"/>
+    <node name="gw2.maas" id="2" online="false"/>
+    <node name="gw3" id="3" online="true"/>
+  </nodes>
+  <resources>
+    <clone id="cl_monitor">
+      <resource id="res_monitor" role="Started">
+        <node name="gw3" id="3"/>
+      </resource>
+      <resource id="res_monitor" role="Stopped"/>
+      <resource id="res_monitor" role="Started">
+        <node name="gw1" id="1"/>
+      </resource>
+    </clone>
+    <clone id="cl_other">
+      <resource id="res_other" role="Started">
+        <node name="gw1" id="1"/>
+      </resource>
+    </clone>
+  </resources>
+</crm_mon>'''
+
+
+class TestCluster(MonitorTestCase):
+
+    def setUp(self):
+        super(TestCluster, self).setUp()
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        self.subprocess.check_output.return_value = CRM_MON_XML
+
+    def test_query_cluster(self):
+        self.assertEquals(self.daemon.query_cluster(),
+                          {'lost': ['gw2'], 'monitor': ['gw3', 'gw1']})
+        self.subprocess.check_output.assert_called_once_with(
+            ['crm_mon', '-1', '--as-xml'])
+
+    def test_query_cluster_fallback(self):
+        self.subprocess.check_output.side_effect = \
+            subprocess.CalledProcessError(1, 'crm_mon')
+        self.daemon.list_lost_nodes = MagicMock(return_value=['gw2'])
+        self.daemon.list_monitor_res = MagicMock(return_value=[' gw1 '])
+        self.assertEquals(self.daemon.query_cluster(),
+                          {'lost': ['gw2'], 'monitor': ['gw1']})
+
+    def test_cluster_cached(self):
+        self.assertTrue(self.daemon.is_host_lost('gw2.maas'))
+        self.assertFalse(self.daemon.is_host_lost('gw1'))
+        self.assertFalse(self.daemon.is_lead_node())
+        self.assertEquals(self.subprocess.check_output.call_count, 1)
+
+    def test_lead_node(self):
+        self.daemon.hostname = 'gw3'
+        self.assertTrue(self.daemon.is_lead_node())
+
+    def test_lost_unknown(self):
+        self.daemon.cluster = {'lost': None, 'monitor': []}
+        self.assertFalse(self.daemon.is_host_lost('gw2'))
+        self.assertFalse(self.daemon.is_lead_node())
+
+
+def ovsdb_update(*rows):
+    return {'headings': ['row', 'action', 'name', 'type'],
+            'data': [list(row) for row in rows]}
+
+
+class TestTunnelWatcher(MonitorTestCase):
+
+    def setUp(self):
+        super(TestTunnelWatcher, self).setUp()
+        self.watcher = monitor.TunnelWatcher()
+
+    def test_counts(self):
+        self.assertEquals(self.watcher.counts(), None)
+        self.watcher.apply(ovsdb_update(
+            ['u1', 'initial', 'gre-0a000001', 'gre'],
+            ['u2', 'initial', 'br-tun', 'internal'],
+            ['u3', 'initial', 'vxlan-0a000002', 'vxlan']))
+        self.assertEquals(self.watcher.counts(), {'gre': 1, 'vxlan': 1})
+        self.assertEquals(self.watcher.appeared, {'gre': 1000, 'vxlan': 1000})
+
+    def test_insert_delete(self):
+        self.watcher.apply(ovsdb_update(['u1', 'initial', 'gre-1', 'gre']))
+        self.time.time.return_value = 1010
+        self.watcher.apply(ovsdb_update(['u2', 'insert', 'gre-2', 'gre']))
+        # Only the first port of a type marks it as appeared
+        self.assertEquals(self.watcher.appeared, {'gre': 1000})
+        self.watcher.apply(ovsdb_update(['u1', 'delete', 'gre-1', 'gre'],
+                                        ['u2', 'delete', 'gre-2', 'gre']))
+        self.assertEquals(self.watcher.counts(), {})
+        self.time.time.return_value = 1020
+        self.watcher.apply(ovsdb_update(['u3', 'insert', 'gre-3', 'gre']))
+        self.assertEquals(self.watcher.appeared, {'gre': 1020})
+
+    def test_modify(self):
+        self.watcher.apply(ovsdb_update(['u1', 'initial', 'p1', '']))
+        self.watcher.apply(ovsdb_update(['u1', 'old', 'p1', ''],
+                                        ['u1', 'new', 'p1', 'geneve']))
+        self.assertEquals(self.watcher.counts(), {'geneve': 1})
+
+    def test_start_failure(self):
+        self.subprocess.Popen.side_effect = OSError
+        self.assertFalse(self.watcher.start())
+        self.assertEquals(self.watcher.process, None)
+
+
+class TestOVSTunnel(MonitorTestCase):
+
+    def setUp(self):
+        super(TestOVSTunnel, self).setUp()
+        self.quantum = MagicMock()
+        self.conf = {'tunnel_types': ['gre'], 'l2_population': True,
+                     'devices': 3}
+        self.quantum.list_agents.return_value = {'agents': [
+            {'id': 'o1', 'host': 'gw1', 'alive': True,
+             'configurations': self.conf}]}
+        self.daemon.restart_service = MagicMock()
+        self.daemon.tunnels = MagicMock()
+        self.daemon.tunnels.start.return_value = True
+        self.daemon.tunnels.appeared = {}
+
+    def test_tunnels_present(self):
+        self.daemon.tunnels.counts.return_value = {'gre': 2}
+        self.daemon.check_ovs_tunnel(quantum=self.quantum)
+        self.assertFalse(self.daemon.restart_service.called)
+
+    def test_no_devices(self):
+        self.conf['devices'] = 0
+        self.daemon.tunnels.counts.return_value = {}
+        self.daemon.check_ovs_tunnel(quantum=self.quantum)
+        self.assertFalse(self.daemon.restart_service.called)
+
+    def test_restart_grace_and_latency(self):
+        self.daemon.tunnels.counts.return_value = {}
+        self.daemon.check_ovs_tunnel(quantum=self.quantum)
+        self.daemon.restart_service.assert_called_once_with(
+            'neutron-plugin-openvswitch-agent')
+        self.assertEquals(self.daemon.tunnel_restart, (1000, ['gre']))
+        # Not restarted again while the agent builds its tunnels
+        self.time.time.return_value = 1030
+        self.daemon.check_ovs_tunnel(quantum=self.quantum)
+        self.assertEquals(self.daemon.restart_service.call_count, 1)
+
+        self.time.time.return_value = 1040
+        self.daemon.tunnels.counts.return_value = {'gre': 1}
+        self.daemon.tunnels.appeared = {'gre': 1012}
+        self.daemon.check_ovs_tunnel(quantum=self.quantum)
+        self.assertEquals(self.daemon.tunnel_latency, 12)
+        self.assertEquals(self.daemon.tunnel_restart, None)
+
+    def test_counts_unknown(self):
+        self.daemon.tunnels.counts.return_value = None
+        self.daemon.check_ovs_tunnel(quantum=self.quantum)
+        self.assertFalse(self.daemon.restart_service.called)
+
+    def test_poll_fallback(self):
+        self.daemon.tunnels.start.return_value = False
+        self.subprocess.check_output.return_value = \
+            'gre-0a000001\nvxlan-0a000002\npatch-int\n'
+        self.assertEquals(self.daemon.tunnel_counts(), {'gre': 1, 'vxlan': 1})
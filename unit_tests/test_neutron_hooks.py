@@ -51,6 +51,7 @@ TO_PATCH = [
     'cleanup_ovs_netns',
     'stop_neutron_ha_monitor_daemon',
     'use_l3ha',
+    'set_workload_status',
 ]
 
 
@@ -69,6 +70,10 @@ class TestQuantumHooks(CharmTestCase):
         self.b64decode.side_effect = passthrough
         hookenv.config.side_effect = self.test_config.get
         hooks.hooks._config_save = False
+        patcher = patch.object(utils, 'config_stage_changed')
+        self.config_stage_changed = patcher.start()
+        self.config_stage_changed.return_value = True
+        self.addCleanup(patcher.stop)
 
     def _call_hook(self, hookname):
         hooks.hooks.execute([
@@ -229,6 +234,28 @@ class TestQuantumHooks(CharmTestCase):
         self.assertTrue(_zmq_joined.called)
         self.assertTrue(self.create_sysctl.called)
 
+    @patch.object(hooks, 'git_install_requested')
+    def test_config_changed_debug_only(self, git_requested):
+        git_requested.return_value = False
+        self.valid_plugin.return_value = True
+        self.config_stage_changed.side_effect = \
+            lambda stage: stage not in utils.CONFIG_STAGE_DEPENDENCIES
+        _amqp_joined = self.patch('amqp_joined')
+        self.relation_ids.return_value = ['relid']
+        self._call_hook('config-changed')
+        self.assertTrue(self.CONFIGS.write_all.called)
+        self.assertFalse(self.openstack_upgrade_available.called)
+        self.assertFalse(self.update_nrpe_config.called)
+        self.assertTrue(self.configure_ovs.called)
+        self.assertFalse(self.update_legacy_ha_files.called)
+        self.assertFalse(_amqp_joined.called)
+
+    @patch.object(hooks, 'config_changed')
+    def test_upgrade_charm_forces_config_stages(self, _config_changed):
+        self.patch('install')
+        self._call_hook('upgrade-charm')
+        _config_changed.assert_called_with(force=True)
+
     def test_upgrade_charm(self):
         _install = self.patch('install')
         _config_changed = self.patch('config_changed')
@@ -282,6 +309,13 @@ class TestQuantumHooks(CharmTestCase):
         self.assertTrue(self.CONFIGS.write_all.called)
         self.install_ca_cert.assert_called_with('cert')
 
+    def test_memcache_changed(self):
+        self._call_hook('memcache-relation-changed')
+        self.CONFIGS.write.assert_has_calls([
+            call('/etc/neutron/metadata_agent.ini'),
+            call('/etc/nova/nova.conf'),
+        ])
+
     def test_neutron_plugin_changed(self):
         self.use_l3ha.return_value = True
         self._call_hook('neutron-plugin-api-relation-changed')
@@ -315,3 +349,26 @@ class TestQuantumHooks(CharmTestCase):
         self.test_config.set('ha-legacy-mode', True)
         self._call_hook('quantum-network-service-relation-changed')
         self.assertTrue(self.cache_env_data.called)
+
+    @patch.object(hooks, 'services')
+    @patch.object(hooks, 'open', create=True)
+    @patch.object(hooks, 'nrpe')
+    def test_update_nrpe_config_legacy_ha(self, _nrpe, _open, _services):
+        self.test_config.set('ha-legacy-mode', True)
+        _nrpe.get_nagios_unit_name.return_value = 'neutron-gateway-0'
+        self._call_hook('nrpe-external-master-relation-changed')
+        _nrpe.NRPE.return_value.add_check.assert_called_with(
+            shortname='neutron-ha-monitor',
+            description='Neutron HA monitor check {neutron-gateway-0}',
+            check_cmd='check_neutron_ha_monitor.py -f '
+                      '/var/lib/juju-neutron-ha/monitor-status.json')
+        self.assertTrue(_nrpe.NRPE.return_value.write.called)
+
+    @patch.object(hooks, 'services')
+    @patch.object(hooks, 'open', create=True)
+    @patch.object(hooks, 'nrpe')
+    def test_update_nrpe_config(self, _nrpe, _open, _services):
+        self.test_config.set('ha-legacy-mode', False)
+        self._call_hook('nrpe-external-master-relation-changed')
+        _nrpe.NRPE.return_value.remove_check.assert_called_with(
+            shortname='neutron-ha-monitor')
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+import neutron_log
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    '_juju_log',
+]
+
+
+class TestJujuLogSink(CharmTestCase):
+
+    def setUp(self):
+        super(TestJujuLogSink, self).setUp(neutron_log, TO_PATCH)
+
+    def test_log_level(self):
+        self.assertEquals(neutron_log.log_level(None), 20)
+        self.assertEquals(neutron_log.log_level('warn'), 30)
+        self.assertEquals(neutron_log.log_level('unknown'), 20)
+
+    def test_filters_below_level(self):
+        sink = neutron_log.JujuLogSink(level='INFO')
+        sink.log('chatter', level='DEBUG')
+        sink.flush()
+        self.assertFalse(self._juju_log.called)
+
+    def test_coalesces(self):
+        sink = neutron_log.JujuLogSink(level='DEBUG')
+        sink.log('first')
+        sink.log('second', level='DEBUG')
+        self.assertFalse(self._juju_log.called)
+        sink.flush()
+        self._juju_log.assert_called_once_with('first\nDEBUG: second',
+                                               level='INFO')
+        sink.flush()
+        self.assertEquals(self._juju_log.call_count, 1)
+
+    def test_flushes_on_warning(self):
+        sink = neutron_log.JujuLogSink()
+        sink.log('registered', level='INFO')
+        sink.log('broken', level='ERROR')
+        self._juju_log.assert_called_once_with(
+            'INFO: registered\nERROR: broken', level='ERROR')
+
+    def test_flushes_on_size(self):
+        sink = neutron_log.JujuLogSink(max_size=10)
+        sink.log('12345')
+        self.assertFalse(self._juju_log.called)
+        sink.log('67890')
+        self._juju_log.assert_called_once_with('12345\n67890', level='INFO')
+
+    @patch.object(neutron_log.hookenv, 'hook_name')
+    def test_log_file(self, _hook_name):
+        _hook_name.return_value = 'config-changed'
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        log_file = os.path.join(tmpdir, 'charm.log')
+        sink = neutron_log.JujuLogSink(level='WARNING', log_file=log_file)
+        sink.log('chatter', level='DEBUG')
+        with open(log_file) as f:
+            record = json.loads(f.read())
+        self.assertEquals(record['hook'], 'config-changed')
+        self.assertEquals(record['level'], 'DEBUG')
+        self.assertEquals(record['message'], 'chatter')
+        self.assertFalse(self._juju_log.called)
+
+    @patch.object(neutron_log, 'atexit')
+    @patch.object(neutron_log.hookenv, 'config')
+    def test_install_log_sink(self, _config, _atexit):
+        _config.side_effect = {'juju-log-level': 'WARNING'}.get
+        with patch.object(neutron_log.hookenv, 'log', self._juju_log):
+            sink = neutron_log.install_log_sink()
+            self.assertEquals(neutron_log.hookenv.log, sink.log)
+        self.assertEquals(sink.level, 30)
+        self.assertEquals(sink.log_file, None)
+        _atexit.register.assert_called_once_with(sink.flush)
@@ -0,0 +1,283 @@
+import os
+
+from jinja2 import Environment
+
+import charmhelpers.contrib.openstack.templating as templating
+
+from test_utils import CharmTestCase
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+RELEASES = ['icehouse', 'juno', 'kilo', 'liberty', 'mitaka']
+
+TO_PATCH = [
+    'log',
+]
+
+
+def render(template, release, ctxt):
+    '''Render template from the charm templates dir as OSConfigRenderer
+    would for release, returning the rendered lines'''
+    loader = templating.get_loader(TEMPLATES, release)
+    tmpl = Environment(loader=loader).get_template(template)
+    return tmpl.render(ctxt).split('\n')
+
+
+def ovs_agent_template(release):
+    if release >= 'mitaka':
+        return 'openvswitch_agent.ini'
+    return 'ml2_conf.ini'
+
+
+class TestFirewallDriverTemplates(CharmTestCase):
+
+    HYBRID = ('firewall_driver = neutron.agent.linux.iptables_firewall.'
+              'OVSHybridIptablesFirewallDriver')
+    NATIVE = ('firewall_driver = neutron.agent.linux.openvswitch_firewall.'
+              'OVSFirewallDriver')
+    NOOP = 'firewall_driver = neutron.agent.firewall.NoopFirewallDriver'
+
+    def setUp(self):
+        super(TestFirewallDriverTemplates, self).setUp(templating, TO_PATCH)
+
+    def _render(self, release, driver):
+        return render(ovs_agent_template(release), release,
+                      {'firewall_driver': driver})
+
+    def test_iptables_hybrid(self):
+        for release in RELEASES:
+            lines = self._render(release, 'iptables_hybrid')
+            self.assertIn(self.HYBRID, lines, release)
+
+    def test_noop(self):
+        for release in RELEASES:
+            lines = self._render(release, 'noop')
+            self.assertIn(self.NOOP, lines, release)
+            self.assertNotIn(self.HYBRID, lines, release)
+
+    def test_openvswitch(self):
+        for release in RELEASES:
+            lines = self._render(release, 'openvswitch')
+            if release >= 'mitaka':
+                self.assertIn(self.NATIVE, lines, release)
+                self.assertNotIn(self.HYBRID, lines, release)
+            else:
+                self.assertIn(self.HYBRID, lines, release)
+                self.assertNotIn(self.NATIVE, lines, release)
+
+
+class TestOVSInterfaceTemplates(CharmTestCase):
+
+    CTXT = {
+        'ovsdb_interface': 'native',
+        'ovsdb_connection': 'tcp:127.0.0.1:6640',
+        'of_interface': 'native',
+    }
+
+    def setUp(self):
+        super(TestOVSInterfaceTemplates, self).setUp(templating, TO_PATCH)
+
+    def test_native(self):
+        for release in RELEASES:
+            lines = render(ovs_agent_template(release), release, self.CTXT)
+            ovs = lines.index('[ovs]')
+            agent = lines.index('[agent]')
+            for line in ['ovsdb_interface = native',
+                         'ovsdb_connection = tcp:127.0.0.1:6640',
+                         'of_interface = native']:
+                if release >= 'juno':
+                    self.assertIn(line, lines, release)
+                    self.assertTrue(ovs < lines.index(line) < agent, release)
+                else:
+                    self.assertNotIn(line, lines, release)
+
+    def test_unset(self):
+        for release in RELEASES:
+            rendered = '\n'.join(render(ovs_agent_template(release), release,
+                                        {}))
+            self.assertNotIn('ovsdb_', rendered, release)
+            self.assertNotIn('of_interface', rendered, release)
+
+
+class TestMessagingTuningTemplates(CharmTestCase):
+
+    CTXT = {
+        'rabbitmq_host': '10.0.0.1',
+        'rabbitmq_user': 'neutron',
+        'rabbitmq_password': 'secret',
+        'rabbitmq_virtual_host': 'openstack',
+        'rpc_response_timeout': 120,
+        'rpc_conn_pool_size': 40,
+        'rpc_thread_pool_size': 80,
+        'report_interval': 30,
+        'rabbit_heartbeat_timeout_threshold': 60,
+    }
+
+    def setUp(self):
+        super(TestMessagingTuningTemplates, self).setUp(templating, TO_PATCH)
+
+    def test_neutron_conf(self):
+        for release in RELEASES:
+            lines = render('neutron.conf', release, self.CTXT)
+            self.assertIn('rpc_response_timeout = 120', lines, release)
+            self.assertIn('rpc_conn_pool_size = 40', lines, release)
+            self.assertIn('report_interval = 30', lines, release)
+            if release >= 'liberty':
+                self.assertIn('executor_thread_pool_size = 80', lines)
+                self.assertIn('heartbeat_timeout_threshold = 60', lines)
+                rabbit = lines.index('[oslo_messaging_rabbit]')
+                self.assertTrue(
+                    lines.index('heartbeat_timeout_threshold = 60') > rabbit)
+            else:
+                self.assertIn('rpc_thread_pool_size = 80', lines, release)
+                self.assertNotIn('heartbeat_timeout_threshold = 60', lines,
+                                 release)
+
+    def test_neutron_conf_rootwrap_daemon(self):
+        daemon = ('root_helper_daemon = sudo /usr/bin/neutron-rootwrap-daemon '
+                  '/etc/neutron/rootwrap.conf')
+        for release in RELEASES:
+            lines = render('neutron.conf', release,
+                           dict(self.CTXT, rootwrap_daemon=True))
+            if release >= 'kilo':
+                self.assertIn(daemon, lines, release)
+                agent = lines.index('[agent]')
+                self.assertTrue(lines.index(daemon) > agent)
+            else:
+                self.assertNotIn(daemon, lines, release)
+            lines = render('neutron.conf', release, self.CTXT)
+            self.assertNotIn(daemon, lines, release)
+
+    def test_neutron_conf_no_rabbit(self):
+        ctxt = dict(self.CTXT)
+        del ctxt['rabbitmq_host']
+        for release in RELEASES:
+            lines = render('neutron.conf', release, ctxt)
+            self.assertNotIn('heartbeat_timeout_threshold = 60', lines,
+                             release)
+
+
+class TestDHCPAgentTemplates(CharmTestCase):
+
+    def setUp(self):
+        super(TestDHCPAgentTemplates, self).setUp(templating, TO_PATCH)
+
+    def test_dhcp_agent_ini(self):
+        ctxt = {
+            'num_sync_threads': 8,
+            'dhcp_lease_duration': 86400,
+            'dnsmasq_lease_max': 65536,
+            'dnsmasq_dns_servers': '10.0.0.2,10.0.0.3',
+        }
+        for release in RELEASES:
+            lines = render('dhcp_agent.ini', release, ctxt)
+            self.assertIn('num_sync_threads = 8', lines, release)
+            self.assertIn('dhcp_lease_duration = 86400', lines, release)
+            self.assertIn('dnsmasq_lease_max = 65536', lines, release)
+            self.assertIn('dnsmasq_dns_servers = 10.0.0.2,10.0.0.3', lines,
+                          release)
+
+    def test_dhcp_agent_ini_dnsmasq_config(self):
+        conf = 'dnsmasq_config_file = /etc/neutron/dnsmasq.conf'
+        for release in RELEASES:
+            lines = render('dhcp_agent.ini', release, {})
+            self.assertNotIn(conf, lines, release)
+            self.assertNotIn('dnsmasq_lease_max', '\n'.join(lines))
+            lines = render('dhcp_agent.ini', release,
+                           {'dnsmasq_flags': {'dhcp-match': 'set:ipxe,175'}})
+            self.assertIn(conf, lines, release)
+
+    def test_dnsmasq_conf(self):
+        ctxt = {
+            'instance_mtu': 1400,
+            'dnsmasq_flags': {'dhcp-match': 'set:ipxe,175'},
+        }
+        for release in RELEASES:
+            lines = render('dnsmasq.conf', release, ctxt)
+            self.assertIn('dhcp-option=26,1400', lines, release)
+            self.assertIn('dhcp-match = set:ipxe,175', lines, release)
+
+
+class TestL3AgentTemplates(CharmTestCase):
+
+    CTXT = {
+        'handle_internal_only_router': True,
+        'agent_mode': 'legacy',
+        'send_arp_for_ha': 3,
+        'periodic_fuzzy_delay': 5,
+        'ha_vrrp_advert_int': 1,
+        'ha_vrrp_auth_type': 'PASS',
+        'ha_vrrp_auth_password': 'vrrpsecret',
+    }
+
+    def setUp(self):
+        super(TestL3AgentTemplates, self).setUp(templating, TO_PATCH)
+
+    def test_l3_agent_ini(self):
+        for release in RELEASES:
+            lines = render('l3_agent.ini', release, self.CTXT)
+            self.assertIn('send_arp_for_ha = 3', lines, release)
+            self.assertIn('periodic_fuzzy_delay = 5', lines, release)
+            if release >= 'juno':
+                self.assertIn('ha_vrrp_advert_int = 1', lines, release)
+                self.assertIn('ha_vrrp_auth_type = PASS', lines, release)
+                self.assertIn('ha_vrrp_auth_password = vrrpsecret', lines,
+                              release)
+            else:
+                self.assertNotIn('ha_vrrp_advert_int = 1', lines, release)
+
+    def test_l3_agent_ini_no_l3ha(self):
+        ctxt = dict(self.CTXT)
+        for key in ['ha_vrrp_advert_int', 'ha_vrrp_auth_type',
+                    'ha_vrrp_auth_password']:
+            del ctxt[key]
+        for release in RELEASES:
+            rendered = '\n'.join(render('l3_agent.ini', release, ctxt))
+            self.assertNotIn('ha_vrrp', rendered, release)
+
+
+class TestMetadataTemplates(CharmTestCase):
+
+    CTXT = {
+        'metadata_cache_ttl': 10,
+        'metadata_workers': 8,
+        'metadata_backlog': 4096,
+        'metadata_keep_alive': True,
+        'nova_metadata_insecure': False,
+        'memcached_servers': '10.0.0.10:11211,10.0.0.11:11211',
+    }
+
+    def setUp(self):
+        super(TestMetadataTemplates, self).setUp(templating, TO_PATCH)
+
+    def test_metadata_agent_ini(self):
+        for release in RELEASES:
+            lines = render('metadata_agent.ini', release, self.CTXT)
+            self.assertIn('cache_url = memory://?default_ttl=10', lines,
+                          release)
+            self.assertIn('metadata_workers = 8', lines, release)
+            self.assertIn('metadata_backlog = 4096', lines, release)
+            self.assertIn('nova_metadata_insecure = False', lines, release)
+            if release >= 'kilo':
+                self.assertIn('wsgi_keep_alive = True', lines, release)
+            else:
+                self.assertNotIn('wsgi_keep_alive = True', lines, release)
+
+    def test_metadata_agent_ini_no_cache(self):
+        # Neutron defaults to a 5 second cache unless cache_url is empty
+        ctxt = dict(self.CTXT, metadata_cache_ttl=0)
+        for release in RELEASES:
+            lines = render('metadata_agent.ini', release, ctxt)
+            self.assertIn('cache_url =', lines, release)
+            self.assertNotIn('cache_url = memory://?default_ttl=0', lines,
+                             release)
+
+    def test_nova_conf_memcache(self):
+        servers = 'memcached_servers = 10.0.0.10:11211,10.0.0.11:11211'
+        for release in RELEASES:
+            lines = render('nova.conf', release, self.CTXT)
+            self.assertIn(servers, lines, release)
+            ctxt = dict(self.CTXT)
+            del ctxt['memcached_servers']
+            rendered = '\n'.join(render('nova.conf', release, ctxt))
+            self.assertNotIn('memcached_servers', rendered, release)
@@ -1,5 +1,11 @@
 from mock import MagicMock, call, patch, ANY
 import collections
+import jinja2
+import os
+import shutil
+import tempfile
+import threading
+import charmhelpers.contrib.openstack.context as context
 import charmhelpers.contrib.openstack.templating as templating
 
 templating.OSConfigRenderer = MagicMock()
@@ -28,7 +34,10 @@ TO_PATCH = [
     'configure_installation_source',
     'log',
     'add_bridge',
-    'add_bridge_port',
+    'add_bridge_ports',
+    'add_ovsdb_manager',
+    'ovsdb_interface',
+    'PhyNICMTUContext',
     'headers_package',
     'full_restart',
     'service_running',
@@ -72,6 +81,8 @@ class TestNeutronUtils(CharmTestCase):
         super(TestNeutronUtils, self).setUp(neutron_utils, TO_PATCH)
         self.headers_package.return_value = 'linux-headers-2.6.18'
         self._set_distrib_codename('trusty')
+        self.PhyNICMTUContext.return_value.return_value = {}
+        self.ovsdb_interface.return_value = 'vsctl'
 
     def tearDown(self):
         # Reset cached cache
@@ -199,7 +210,7 @@ class TestNeutronUtils(CharmTestCase):
             call('br-ex'),
             call('br-data')
         ])
-        self.add_bridge_port.assert_called_with('br-ex', 'eth0')
+        self.add_bridge_ports.assert_called_with([('br-ex', 'eth0', False)])
 
     @patch('charmhelpers.contrib.openstack.context.config')
     def test_configure_ovs_ovs_data_port(self, mock_config):
@@ -217,13 +228,12 @@ class TestNeutronUtils(CharmTestCase):
             call('br-ex'),
             call('br-data')
         ])
-        calls = [call('br-data', 'eth0', promisc=True)]
-        self.add_bridge_port.assert_has_calls(calls)
+        self.add_bridge_ports.assert_called_with([('br-data', 'eth0', True)])
 
         # Now test with bridge:port format and bogus bridge
         self.test_config.set('data-port', 'br-foo:eth0')
         self.add_bridge.reset_mock()
-        self.add_bridge_port.reset_mock()
+        self.add_bridge_ports.reset_mock()
         neutron_utils.configure_ovs()
         self.add_bridge.assert_has_calls([
             call('br-int'),
@@ -231,26 +241,63 @@ class TestNeutronUtils(CharmTestCase):
             call('br-data')
         ])
         # Not called since we have a bogus bridge in data-ports
-        self.assertFalse(self.add_bridge_port.called)
+        self.assertFalse(self.add_bridge_ports.called)
 
         # Now test with bridge:port format
         self.test_config.set('bridge-mappings', 'net1:br1')
         self.test_config.set('data-port', 'br1:eth0.100 br1:eth0.200')
         self.add_bridge.reset_mock()
-        self.add_bridge_port.reset_mock()
+        self.add_bridge_ports.reset_mock()
         neutron_utils.configure_ovs()
         self.add_bridge.assert_has_calls([
             call('br-int'),
             call('br-ex'),
             call('br1')
         ])
-        calls = [call('br1', 'eth0.100', promisc=True),
-                 call('br1', 'eth0.200', promisc=True)]
-        self.add_bridge_port.assert_has_calls(calls)
+        self.assertItemsEqual(self.add_bridge_ports.call_args[0][0],
+                              [('br1', 'eth0.100', True),
+                               ('br1', 'eth0.200', True)])
 
+    def test_configure_ovs_ovsdb_native(self):
+        self.config.side_effect = self.test_config.get
+        self.get_os_codename_install_source.return_value = 'liberty'
+        self.ExternalPortContext.return_value = \
+            DummyExternalPortContext(return_value=None)
+        neutron_utils.configure_ovs()
+        self.assertFalse(self.add_ovsdb_manager.called)
+        self.ovsdb_interface.return_value = 'native'
+        neutron_utils.configure_ovs()
+        self.ovsdb_interface.assert_called_with('liberty')
+        self.add_ovsdb_manager.assert_called_once_with('ptcp:6640:127.0.0.1')
+        self.add_ovsdb_manager.reset_mock()
+        self.test_config.set('plugin', 'ovs-odl')
+        neutron_utils.configure_ovs()
+        self.assertFalse(self.add_ovsdb_manager.called)
+
+    def test_configure_ovs_phy_nic_mtu(self):
+        self.config.return_value = 'ovs'
+        self.ExternalPortContext.return_value = \
+            DummyExternalPortContext(return_value=None)
+        self.PhyNICMTUContext.return_value.return_value = {
+            'devs': 'eth0\\neth0.100', 'mtu': '9000'}
+        mtus = {'eth0': 9000, 'eth0.100': 9000}
+        with patch.object(neutron_utils, 'link_mtu', mtus.get):
+            neutron_utils.configure_ovs()
+            self.assertFalse(self.service_restart.called)
+            mtus['eth0.100'] = 1500
+            neutron_utils.configure_ovs()
+        self.service_restart.assert_called_once_with('os-charm-phy-nic-mtu')
+
+    @patch.object(neutron_utils, 'restart_services')
+    @patch.object(neutron_utils, 'installed_version')
+    @patch('os.remove')
+    @patch('os.path.exists')
+    @patch.object(neutron_utils, 'write_file')
     @patch.object(neutron_utils, 'git_install_requested')
-    def test_do_openstack_upgrade(self, git_requested):
+    def test_do_openstack_upgrade(self, git_requested, write_file, exists,
+                                  remove, installed_version, restart):
         git_requested.return_value = False
+        exists.return_value = False
         self.config.side_effect = self.test_config.get
         self.is_relation_made.return_value = False
         self.test_config.set('openstack-origin', 'cloud:precise-havana')
@@ -270,6 +317,193 @@ class TestNeutronUtils(CharmTestCase):
         self.configure_installation_source.assert_called_with(
             'cloud:precise-havana'
         )
+        write_file.assert_called_with('/usr/sbin/policy-rc.d',
+                                      '#!/bin/sh\nexit 101\n', perms=0o755)
+        remove.assert_called_with('/usr/sbin/policy-rc.d')
+        installed_version.assert_called_with('openvswitch-switch')
+        restart.assert_called_once_with(False)
+
+    @patch.object(neutron_utils, 'flush_hook_contexts')
+    @patch.object(neutron_utils, 'service_starts_denied')
+    @patch.object(neutron_utils, 'installed_version')
+    @patch.object(neutron_utils, 'restart_services')
+    @patch.object(neutron_utils, 'install_staged_configs')
+    @patch.object(neutron_utils, 'stage_configs')
+    @patch.object(neutron_utils, 'install_upgrade_packages')
+    @patch.object(neutron_utils, 'download_upgrade_packages')
+    def test_do_openstack_upgrade_phases(self, download, install, stage,
+                                         install_staged, restart,
+                                         installed_version, denied, flush):
+        self.config.side_effect = self.test_config.get
+        self.get_os_codename_install_source.return_value = 'kilo'
+        installed_version.side_effect = ['2.0.2', '2.3.1']
+        manager = MagicMock()
+        manager.attach_mock(download, 'download')
+        manager.attach_mock(denied, 'denied')
+        manager.attach_mock(install, 'install')
+        manager.attach_mock(flush, 'flush')
+        manager.attach_mock(stage, 'stage')
+        manager.attach_mock(install_staged, 'install_staged')
+        manager.attach_mock(restart, 'restart')
+        configs = MagicMock()
+        stage.return_value = ['/etc/neutron/neutron.conf']
+        timings = neutron_utils.do_openstack_upgrade(configs)
+        # Configs are rendered for the release installed, and services
+        # are restarted once starts are allowed again
+        self.assertEquals(manager.mock_calls, [
+            call.download(),
+            call.denied(),
+            call.denied().__enter__(),
+            call.install(ANY),
+            call.flush(),
+            call.stage(configs),
+            call.install_staged(['/etc/neutron/neutron.conf']),
+            call.denied().__exit__(None, None, None),
+            call.restart(True),
+        ])
+        configs.set_release.assert_called_with(openstack_release='kilo')
+        self.assertEquals(timings.keys(), ['update', 'download', 'install',
+                                           'stage', 'configs', 'restart'])
+
+    @patch.object(neutron_utils, 'download_upgrade_packages')
+    def test_do_openstack_upgrade_failed_phase(self, download):
+        self.config.side_effect = self.test_config.get
+        download.side_effect = Exception
+        timings = {}
+        self.assertRaises(Exception, neutron_utils.do_openstack_upgrade,
+                          MagicMock(), timings=timings)
+        self.assertEquals(sorted(timings.keys()), ['download', 'update'])
+
+    def test_download_upgrade_packages(self):
+        self.config.side_effect = self.test_config.get
+        neutron_utils.download_upgrade_packages()
+        self.apt_upgrade.assert_called_with(options=['--download-only'],
+                                            fatal=True, dist=True)
+        self.apt_install.assert_called_with(ANY,
+                                            options=['--download-only'],
+                                            fatal=True)
+
+    def test_install_upgrade_packages(self):
+        self.config.side_effect = self.test_config.get
+        neutron_utils.install_upgrade_packages(['--option', 'x'])
+        self.apt_upgrade.assert_called_with(options=['--option', 'x'],
+                                            fatal=True, dist=True)
+        self.assertTrue(self.apt_install.called)
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    @patch.object(neutron_utils, 'write_file')
+    def test_service_starts_denied_existing_policy(self, write_file, exists,
+                                                   remove):
+        exists.return_value = True
+        with neutron_utils.service_starts_denied():
+            pass
+        self.assertFalse(write_file.called)
+        self.assertFalse(remove.called)
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    @patch.object(neutron_utils, 'write_file')
+    def test_service_starts_denied_failure(self, write_file, exists, remove):
+        exists.return_value = False
+        with self.assertRaises(ValueError):
+            with neutron_utils.service_starts_denied():
+                raise ValueError
+        remove.assert_called_with('/usr/sbin/policy-rc.d')
+
+    @patch.object(neutron_utils, 'apt_cache')
+    def test_installed_version(self, apt_cache):
+        ovs = MagicMock()
+        ovs.current_ver.ver_str = '2.5.0-0ubuntu1'
+        missing = MagicMock(current_ver=None)
+        apt_cache.return_value = {'openvswitch-switch': ovs,
+                                  'openvswitch-common': missing}
+        self.assertEquals(
+            neutron_utils.installed_version('openvswitch-switch'),
+            '2.5.0-0ubuntu1')
+        self.assertEquals(
+            neutron_utils.installed_version('openvswitch-common'), None)
+        self.assertEquals(neutron_utils.installed_version('unknown'), None)
+
+    @patch.object(neutron_utils, 'write_file')
+    def test_stage_configs(self, write_file):
+        configs = MagicMock()
+        configs.templates = {'/etc/neutron/neutron.conf': None}
+        configs.render.return_value = 'rendered'
+        staged = neutron_utils.stage_configs(configs)
+        self.assertEquals(staged, ['/etc/neutron/neutron.conf'])
+        write_file.assert_called_with(
+            '/var/lib/neutron-gateway/upgrade/etc/neutron/neutron.conf',
+            'rendered', perms=0o600)
+        self.mkdir.assert_called_with(
+            '/var/lib/neutron-gateway/upgrade/etc/neutron', perms=0o700)
+
+    @patch('os.remove')
+    @patch('os.stat')
+    @patch('os.path.exists')
+    @patch('grp.getgrgid')
+    @patch('pwd.getpwuid')
+    @patch.object(neutron_utils, 'write_file')
+    def test_install_staged_configs(self, write_file, getpwuid, getgrgid,
+                                    exists, _stat, remove):
+        exists.return_value = True
+        _stat.return_value = MagicMock(st_uid=0, st_gid=108,
+                                       st_mode=0o100640)
+        getpwuid.return_value.pw_name = 'root'
+        getgrgid.return_value.gr_name = 'neutron'
+        staging = '/var/lib/neutron-gateway/upgrade/etc/neutron/neutron.conf'
+        with patch('__builtin__.open') as _open:
+            _open.return_value.__enter__.return_value.read.return_value = \
+                'rendered'
+            neutron_utils.install_staged_configs(['/etc/neutron/neutron.conf'])
+        _open.assert_called_with(staging, 'rb')
+        write_file.assert_called_with('/etc/neutron/neutron.conf', 'rendered',
+                                      owner='root', group='neutron',
+                                      perms=0o640)
+        getgrgid.assert_called_with(108)
+        remove.assert_called_with(staging)
+
+    @patch('os.remove')
+    @patch('os.path.isdir')
+    @patch('os.path.exists')
+    @patch.object(neutron_utils, 'write_file')
+    def test_install_staged_configs_new_file(self, write_file, exists,
+                                             isdir, remove):
+        exists.return_value = False
+        isdir.return_value = False
+        with patch('__builtin__.open') as _open:
+            _open.return_value.__enter__.return_value.read.return_value = \
+                'rendered'
+            neutron_utils.install_staged_configs(['/etc/neutron/new.conf'])
+        self.mkdir.assert_called_with('/etc/neutron', perms=0o755)
+        write_file.assert_called_with('/etc/neutron/new.conf', 'rendered',
+                                      owner='root', group='root',
+                                      perms=0o644)
+
+    @patch.dict(neutron_utils.RESTARTED_CHECKSUMS, clear=True)
+    @patch.object(neutron_utils, 'path_hash')
+    @patch.object(neutron_utils, 'restart_map')
+    @patch.object(neutron_utils, 'services')
+    def test_restart_services(self, services, restart_map, path_hash):
+        services.return_value = ['neutron-dhcp-agent']
+        restart_map.return_value = {
+            '/etc/neutron/dhcp_agent.ini': ['neutron-dhcp-agent']}
+        path_hash.return_value = 'a'
+        neutron_utils.restart_services()
+        self.service_restart.assert_called_once_with('neutron-dhcp-agent')
+        self.assertEquals(neutron_utils.RESTARTED_CHECKSUMS,
+                          {'/etc/neutron/dhcp_agent.ini': 'a'})
+
+    @patch.dict(neutron_utils.RESTARTED_CHECKSUMS, clear=True)
+    @patch.object(neutron_utils, 'path_hash')
+    @patch.object(neutron_utils, 'restart_map')
+    @patch.object(neutron_utils, 'services')
+    def test_restart_services_ovs(self, services, restart_map, path_hash):
+        services.return_value = ['neutron-dhcp-agent']
+        restart_map.return_value = {}
+        neutron_utils.restart_services(restart_ovs=True)
+        self.assertEquals(self.service_restart.call_args_list, [
+            call('openvswitch-switch'), call('neutron-dhcp-agent')])
 
     def test_register_configs_ovs(self):
         self.config.return_value = 'ovs'
@@ -443,6 +677,59 @@ class TestNeutronUtils(CharmTestCase):
             any_order=True,
         )
 
+    @patch.object(neutron_utils, 'resolve_config_files')
+    def test_config_topology_cached(self, _resolve):
+        self.config.side_effect = self.test_config.get
+        self.get_os_codename_install_source.return_value = 'icehouse'
+        self.is_relation_made.return_value = False
+        _resolve.return_value = {'ovs': {
+            neutron_utils.NEUTRON_CONF: {
+                'hook_contexts': [],
+                'services': ['neutron-l3-agent',
+                             'neutron-plugin-openvswitch-agent']},
+            neutron_utils.NEUTRON_L3_AGENT_CONF: {
+                'hook_contexts': [],
+                'services': ['neutron-l3-agent']},
+            neutron_utils.EXT_PORT_CONF: {
+                'hook_contexts': [],
+                'services': []},
+        }}
+        neutron_utils.restart_map()
+        neutron_utils.services()
+        neutron_utils.get_topics()
+        neutron_utils.register_configs()
+        _resolve.assert_called_once_with('ovs', 'icehouse', False)
+        self.assertItemsEqual(neutron_utils.services(),
+                              ['neutron-l3-agent',
+                               'neutron-plugin-openvswitch-agent'])
+        self.assertItemsEqual(
+            neutron_utils.service_files('neutron-l3-agent'),
+            [neutron_utils.NEUTRON_CONF, neutron_utils.NEUTRON_L3_AGENT_CONF])
+        self.assertEquals(neutron_utils.service_files('ext-port'), [])
+        self.assertNotIn(neutron_utils.EXT_PORT_CONF,
+                         neutron_utils.restart_map())
+        self.is_relation_made.return_value = True
+        neutron_utils.services()
+        _resolve.assert_called_with('ovs', 'icehouse', True)
+        self.assertEquals(_resolve.call_count, 2)
+
+    def test_get_topics(self):
+        self.config.side_effect = self.test_config.get
+        self.is_relation_made.return_value = False
+        self.get_os_codename_install_source.return_value = 'icehouse'
+        self.assertEquals(neutron_utils.get_topics(), [
+            'l3_agent', 'dhcp_agent', 'metering_agent', 'n-lbaas_agent',
+            'q-agent-notifier-port-update',
+            'q-agent-notifier-network-delete',
+            'q-agent-notifier-tunnel-update',
+            'q-agent-notifier-security_group-update',
+            'q-agent-notifier-dvr-update',
+            'q-agent-notifier-l2population-update'])
+        self.test_config.set('plugin', 'nsx')
+        self.assertEquals(neutron_utils.get_topics(), [
+            'dhcp_agent', 'n-lbaas_agent',
+            'q-agent-notifier-l2population-update'])
+
     def test_register_configs_pre_install(self):
         self.config.return_value = 'ovs'
         self.is_relation_made.return_value = False
@@ -471,6 +758,35 @@ class TestNeutronUtils(CharmTestCase):
         self.assertTrue(self.mkdir.called)
         self.assertTrue(self.copy2.called)
 
+    @patch.object(neutron_utils, 'get_report_interval')
+    def test_heartbeat_threshold(self, _get_report_interval):
+        self.config.side_effect = self.test_config.get
+        _get_report_interval.return_value = 30
+        self.assertEquals(neutron_utils.heartbeat_threshold(), 60)
+        self.test_config.set('ha-heartbeat-threshold', 45)
+        self.assertEquals(neutron_utils.heartbeat_threshold(), 45)
+        self.test_config.set('ha-heartbeat-threshold', 0)
+        self.assertEquals(neutron_utils.heartbeat_threshold(), 0)
+
+    @patch.object(neutron_utils, 'get_report_interval')
+    def test_hang_threshold(self, _get_report_interval):
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('agent-down-time', 75)
+        _get_report_interval.return_value = 30
+        self.assertEquals(neutron_utils.hang_threshold(), 120)
+        _get_report_interval.return_value = 10
+        self.assertEquals(neutron_utils.hang_threshold(), 75)
+        self.test_config.set('ha-agent-hang-threshold', 0)
+        self.assertEquals(neutron_utils.hang_threshold(), 0)
+
+    @patch.object(neutron_utils, 'copy_file')
+    def test_install_legacy_ha_files(self, _copy_file):
+        neutron_utils.install_legacy_ha_files()
+        _copy_file.assert_any_call('files/neutron-ha-monitor.py',
+                                   '/usr/local/bin/', 0o755, force=False)
+        _copy_file.assert_any_call('hooks/neutron_discovery.py',
+                                   '/usr/local/bin/', None, force=False)
+
     @patch('neutron_utils.os.remove')
     @patch('neutron_utils.os.path.isfile')
     def test_remove_file_exists(self, _isfile, _remove):
@@ -830,6 +1146,8 @@ class TestNeutronAgentReallocation(CharmTestCase):
                               exists, join, render, git_src_dir, remove):
         projects_yaml = openstack_origin_git
         join.return_value = 'joined-string'
+        self.config.side_effect = self.test_config.get
+        self.get_os_codename_install_source.return_value = 'kilo'
         neutron_utils.git_post_install(projects_yaml)
         expected = [
             call('joined-string', '/etc/neutron'),
@@ -840,6 +1158,9 @@ class TestNeutronAgentReallocation(CharmTestCase):
         expected = [
             call('/usr/local/bin/neutron-rootwrap',
                  '/usr/bin/neutron-rootwrap'),
+            call('joined-string', '/usr/local/bin/neutron-rootwrap-daemon'),
+            call('/usr/local/bin/neutron-rootwrap-daemon',
+                 '/usr/bin/neutron-rootwrap-daemon'),
         ]
         symlink.assert_has_calls(expected)
         service_name = 'quantum-gateway'
@@ -1043,7 +1364,7 @@ class TestNeutronAgentReallocation(CharmTestCase):
         expected = [
             call('git/neutron_sudoers',
                  '/etc/sudoers.d/neutron_sudoers',
-                 {}, perms=0o440),
+                 {'rootwrap_daemon': True}, perms=0o440),
             call('git/cron.d/neutron-dhcp-agent-netns-cleanup',
                  '/etc/cron.d/neutron-dhcp-agent-netns-cleanup',
                  {}, perms=0o755),
@@ -1123,3 +1444,875 @@ class TestNeutronAgentReallocation(CharmTestCase):
                  neutron_vpn_agent_context, perms=0o644),
         ]
         self.assertEquals(render.call_args_list, expected)
+
+    @patch('os.remove')
+    @patch.object(neutron_utils, 'git_src_dir')
+    @patch.object(neutron_utils, 'render')
+    @patch('os.path.join')
+    @patch('os.path.exists')
+    @patch('os.symlink')
+    @patch('shutil.rmtree')
+    @patch('shutil.copyfile')
+    @patch('shutil.copytree')
+    def test_git_post_install_juno(self, copytree, copyfile, rmtree, symlink,
+                                   exists, join, render, git_src_dir, remove):
+        join.return_value = 'joined-string'
+        self.config.side_effect = self.test_config.get
+        self.get_os_codename_install_source.return_value = 'juno'
+        neutron_utils.git_post_install(openstack_origin_git)
+        self.assertNotIn(call('/usr/local/bin/neutron-rootwrap-daemon',
+                              '/usr/bin/neutron-rootwrap-daemon'),
+                         symlink.call_args_list)
+        render.assert_any_call('git/neutron_sudoers',
+                               '/etc/sudoers.d/neutron_sudoers',
+                               {'rootwrap_daemon': False}, perms=0o440)
+
+
+class TestAssessStatus(CharmTestCase):
+
+    def setUp(self):
+        super(TestAssessStatus, self).setUp(
+            neutron_utils,
+            ['relation_ids', 'hook_name', 'kv', 'status_set',
+             'get_hacluster_config', 'log'])
+        self.relation_ids.return_value = []
+        self.hook_name.return_value = 'config-changed'
+        self.db = {neutron_utils.WORKLOAD_STATUS_KEY: ['maintenance',
+                                                       'Installing']}
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+
+    def _configs(self, complete, incomplete_data=None):
+        configs = MagicMock()
+        configs.complete_contexts.return_value = complete
+        configs.get_incomplete_context_data.return_value = \
+            incomplete_data or {}
+        return configs
+
+    def test_active(self):
+        configs = self._configs(['amqp', 'neutron-plugin-api'])
+        neutron_utils.assess_status(configs)
+        self.status_set.assert_called_once_with('active', 'Unit is ready')
+        configs.get_incomplete_context_data.assert_called_once_with(
+            ['zeromq-configuration'])
+
+    def test_missing_and_incomplete(self):
+        configs = self._configs([], {'amqp': {'related': True},
+                                     'neutron-plugin-api': {'related': False}})
+        self.assertEquals(neutron_utils.get_workload_status(configs),
+                          ('blocked',
+                           'Missing relations: neutron-plugin-api; '
+                           'incomplete relations: messaging'))
+        configs.get_incomplete_context_data.assert_called_once_with(
+            ['amqp', 'neutron-plugin-api', 'zeromq-configuration'])
+
+    def test_departing(self):
+        self.hook_name.return_value = 'amqp-relation-broken'
+        configs = self._configs(['neutron-plugin-api'],
+                                {'amqp': {'related': True}})
+        self.assertEquals(neutron_utils.get_workload_status(configs),
+                          ('blocked', 'Missing relations: messaging'))
+
+    def test_waiting(self):
+        configs = self._configs(['neutron-plugin-api'],
+                                {'amqp': {'related': True,
+                                          'missing_data': ['rabbitmq_host']}})
+        self.assertEquals(neutron_utils.get_workload_status(configs),
+                          ('waiting', 'Incomplete relations: messaging'))
+
+    def test_hacluster_missing_config(self):
+        self.relation_ids.side_effect = \
+            lambda r: ['ha:1'] if r == 'ha' else []
+        self.get_hacluster_config.side_effect = Exception
+        configs = self._configs([])
+        self.assertEquals(neutron_utils.get_workload_status(configs),
+                          ('blocked',
+                           'Missing relations: ha, messaging, '
+                           'neutron-plugin-api, hacluster missing '
+                           'configuration: vip, vip_iface, vip_cidr'))
+
+    def test_unchanged(self):
+        self.db[neutron_utils.WORKLOAD_STATUS_KEY] = ['active',
+                                                      'Unit is ready']
+        neutron_utils.assess_status(
+            self._configs(['amqp', 'neutron-plugin-api']))
+        self.assertFalse(self.status_set.called)
+
+    def test_set_workload_status(self):
+        neutron_utils.set_workload_status('maintenance', 'Upgrading')
+        self.status_set.assert_called_once_with('maintenance', 'Upgrading')
+        self.assertEquals(self.db[neutron_utils.WORKLOAD_STATUS_KEY],
+                          ['maintenance', 'Upgrading'])
+        self.assertTrue(self.kv.return_value.flush.called)
+        neutron_utils.assess_status(
+            self._configs(['amqp', 'neutron-plugin-api']))
+        self.status_set.assert_called_with('active', 'Unit is ready')
+        self.assertEquals(self.db[neutron_utils.WORKLOAD_STATUS_KEY],
+                          ['active', 'Unit is ready'])
+
+
+class FakeContext(context.OSContextGenerator):
+    interfaces = ['amqp']
+
+    def __init__(self, ctxt, setting=None):
+        self.ctxt = ctxt
+        self.setting = setting
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if not self.ctxt:
+            self.missing_data = ['rabbitmq_host']
+        return self.ctxt
+
+
+class TestHookContext(CharmTestCase):
+
+    def setUp(self):
+        super(TestHookContext, self).setUp(neutron_utils, [])
+        neutron_utils.flush_hook_contexts()
+        self.addCleanup(neutron_utils.flush_hook_contexts)
+
+    def test_evaluated_once(self):
+        first = FakeContext({'rabbitmq_host': 'rabbit'})
+        second = FakeContext({'rabbitmq_host': 'rabbit'})
+        other = FakeContext({'rabbitmq_host': 'rabbit'}, setting='nova')
+        templates = [
+            templating.OSConfigTemplate(
+                'neutron.conf', [neutron_utils.HookContext(first)]),
+            templating.OSConfigTemplate(
+                'nova.conf', [neutron_utils.HookContext(second),
+                              neutron_utils.HookContext(other)]),
+        ]
+        self.assertEquals(templates[0].context(), {'rabbitmq_host': 'rabbit'})
+        for template in templates:
+            self.assertEquals(template.complete_contexts(), ['amqp'])
+        self.assertEquals((first.calls, second.calls, other.calls),
+                          (1, 0, 1))
+
+    def test_missing_data(self):
+        first = FakeContext({})
+        second = FakeContext({})
+        self.assertEquals(neutron_utils.HookContext(first)(), {})
+        wrapped = neutron_utils.HookContext(second)
+        self.assertEquals(wrapped(), {})
+        self.assertEquals(wrapped.missing_data, ['rabbitmq_host'])
+        self.assertEquals(wrapped.interfaces, ['amqp'])
+        self.assertEquals(second.calls, 0)
+
+    def test_flush(self):
+        generator = FakeContext({'rabbitmq_host': 'rabbit'})
+        wrapped = neutron_utils.HookContext(generator)
+        wrapped()
+        neutron_utils.flush_hook_contexts()
+        wrapped()
+        self.assertEquals(generator.calls, 2)
+
+
+class TestConfigStages(CharmTestCase):
+
+    def setUp(self):
+        super(TestConfigStages, self).setUp(neutron_utils, ['config', 'log'])
+        self.changed = []
+        self.config.return_value.changed.side_effect = \
+            lambda option: option in self.changed
+
+    def test_config_stage_changed(self):
+        self.assertTrue(neutron_utils.config_stage_changed('configs'))
+        self.assertFalse(neutron_utils.config_stage_changed('sysctl'))
+        self.changed = ['sysctl']
+        self.assertTrue(neutron_utils.config_stage_changed('sysctl'))
+        self.assertFalse(neutron_utils.config_stage_changed('upgrade'))
+
+    def test_ovs_always_runs(self):
+        # Link state is lost on reboot, after which nothing has changed
+        self.assertTrue(neutron_utils.config_stage_changed('ovs'))
+
+    def test_run_config_stages(self):
+        self.changed = ['debug']
+        configs = MagicMock()
+        sysctl = MagicMock()
+        neutron_utils.run_config_stages([('configs', configs),
+                                         ('sysctl', sysctl)])
+        self.assertTrue(configs.called)
+        self.assertFalse(sysctl.called)
+        message = self.log.call_args[0][0]
+        self.assertTrue(message.startswith('config-changed stages: configs '))
+        self.assertTrue(message.endswith('sysctl skipped'))
+
+    def test_run_config_stages_force(self):
+        sysctl = MagicMock()
+        neutron_utils.run_config_stages([('sysctl', sysctl)], force=True)
+        self.assertTrue(sysctl.called)
+
+
+class TestAppArmorProfiles(CharmTestCase):
+
+    def setUp(self):
+        super(TestAppArmorProfiles, self).setUp(
+            neutron_utils,
+            ['config', 'log', 'kv', 'apt_install', 'aa_profile_digest',
+             'set_workload_status'])
+        self.config.side_effect = self.test_config.get
+        self.test_config.config['aa-profile-mode'] = 'complain'
+        self.db = {}
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.aa_profile_digest.side_effect = \
+            lambda profile, mode: '{}:{}'.format(profile, mode)
+
+    @patch('subprocess.check_call')
+    def test_no_mode(self, check_call):
+        self.test_config.config['aa-profile-mode'] = None
+        neutron_utils.setup_aa_profiles()
+        self.assertFalse(self.apt_install.called)
+        self.assertFalse(check_call.called)
+
+    @patch('subprocess.check_call')
+    def test_batched(self, check_call):
+        neutron_utils.setup_aa_profiles()
+        self.apt_install.assert_called_once_with(['apparmor-utils'],
+                                                 fatal=True)
+        check_call.assert_called_once_with(
+            ['aa-complain'] + neutron_utils.AA_PROFILES)
+        key = neutron_utils.AA_PROFILE_DIGEST_KEY.format(
+            neutron_utils.NEUTRON_DHCP_AA_PROFILE)
+        self.assertEquals(self.db[key], 'usr.bin.neutron-dhcp-agent:complain')
+
+    @patch('subprocess.check_call')
+    def test_unchanged(self, check_call):
+        for profile in neutron_utils.AA_PROFILES:
+            key = neutron_utils.AA_PROFILE_DIGEST_KEY.format(profile)
+            self.db[key] = '{}:complain'.format(profile)
+        self.db[neutron_utils.AA_PROFILE_DIGEST_KEY.format(
+            neutron_utils.NEUTRON_L3_AA_PROFILE)] = 'stale'
+        neutron_utils.setup_aa_profiles()
+        check_call.assert_called_once_with(
+            ['aa-complain', neutron_utils.NEUTRON_L3_AA_PROFILE])
+        for profile in neutron_utils.AA_PROFILES:
+            key = neutron_utils.AA_PROFILE_DIGEST_KEY.format(profile)
+            self.db[key] = '{}:complain'.format(profile)
+        check_call.reset_mock()
+        neutron_utils.setup_aa_profiles()
+        self.assertFalse(check_call.called)
+
+    @patch('subprocess.check_call')
+    def test_failure(self, check_call):
+        check_call.side_effect = \
+            neutron_utils.subprocess.CalledProcessError(1, 'aa-complain')
+        self.assertRaises(neutron_utils.subprocess.CalledProcessError,
+                          neutron_utils.setup_aa_profiles)
+        self.assertTrue(self.set_workload_status.called)
+        self.assertEquals(self.db, {})
+
+    @patch('os.symlink')
+    @patch('os.path.lexists')
+    @patch('subprocess.check_call')
+    def test_manual_disable(self, check_call, lexists, symlink):
+        self.test_config.config['aa-profile-mode'] = 'disable'
+        check_call.side_effect = \
+            neutron_utils.subprocess.CalledProcessError(1, 'aa-disable')
+        lexists.return_value = False
+        neutron_utils.setup_aa_profiles()
+        symlink.assert_any_call(
+            '/etc/apparmor.d/usr.bin.neutron-dhcp-agent',
+            '/etc/apparmor.d/disable/usr.bin.neutron-dhcp-agent')
+        self.assertEquals(symlink.call_count, len(neutron_utils.AA_PROFILES))
+        self.assertFalse(self.set_workload_status.called)
+
+
+class TestAppArmorProfileDigest(CharmTestCase):
+
+    def setUp(self):
+        super(TestAppArmorProfileDigest, self).setUp(neutron_utils, [])
+
+    @patch('os.path.exists')
+    def test_missing(self, exists):
+        exists.return_value = False
+        self.assertEquals(
+            neutron_utils.aa_profile_digest('usr.bin.foo', 'enforce'), None)
+
+    @patch('os.path.exists')
+    def test_digest(self, exists):
+        exists.return_value = True
+        with patch('__builtin__.open') as _open:
+            _open.return_value.__enter__.return_value.read.return_value = \
+                'profile'
+            enforce = neutron_utils.aa_profile_digest('usr.bin.foo',
+                                                      'enforce')
+            complain = neutron_utils.aa_profile_digest('usr.bin.foo',
+                                                       'complain')
+        self.assertNotEquals(enforce, complain)
+        _open.assert_called_with('/etc/apparmor.d/usr.bin.foo')
+
+    def render_profile(self, **ctxt):
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(
+            os.path.join(os.path.dirname(__file__), '..', 'templates')))
+        return env.get_template(
+            neutron_utils.NEUTRON_L3_AA_PROFILE).render(**ctxt)
+
+    def test_render_complain_unset(self):
+        self.assertIn('flags=(complain)', self.render_profile())
+
+    def test_render_complain_disable(self):
+        self.assertIn('flags=(complain)',
+                      self.render_profile(aa_profile_mode='disable'))
+
+    def test_render_complain(self):
+        self.assertIn('flags=(complain)',
+                      self.render_profile(aa_profile_mode='complain'))
+
+    def test_render_enforce(self):
+        self.assertNotIn('flags=(complain)',
+                         self.render_profile(aa_profile_mode='enforce'))
+
+    def test_enforce_applied_once(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(
+            os.path.join(os.path.dirname(__file__), '..', 'templates')))
+
+        def write_profiles():
+            for profile in neutron_utils.AA_PROFILES:
+                with open(os.path.join(tmpdir, profile), 'w') as f:
+                    f.write(env.get_template(profile).render(
+                        aa_profile_mode='enforce'))
+
+        def aa_enforce(cmd):
+            # Drop the complain flag as aa-enforce does
+            for profile in cmd[1:]:
+                path = os.path.join(tmpdir, profile)
+                with open(path) as f:
+                    content = f.read()
+                with open(path, 'w') as f:
+                    f.write(content.replace('flags=(complain) ', ''))
+
+        db = {}
+        self.test_config.config['aa-profile-mode'] = 'enforce'
+        with patch.multiple(neutron_utils, AA_PROFILE_DIR=tmpdir,
+                            config=self.test_config.get, kv=MagicMock(),
+                            apt_install=MagicMock(), log=MagicMock()), \
+                patch('subprocess.check_call') as check_call:
+            neutron_utils.kv.return_value.get.side_effect = db.get
+            neutron_utils.kv.return_value.set.side_effect = db.__setitem__
+            check_call.side_effect = aa_enforce
+            # Configs are rewritten by each config-changed hook
+            for _ in range(2):
+                write_profiles()
+                neutron_utils.setup_aa_profiles()
+            neutron_utils.apt_install.assert_called_once_with(
+                ['apparmor-utils'], fatal=True)
+        check_call.assert_called_once_with(
+            ['aa-enforce'] + neutron_utils.AA_PROFILES)
+
+
+class TestConfigChangeActions(CharmTestCase):
+
+    RESTART_MAP = {
+        '/etc/neutron/dnsmasq.conf': ['neutron-dhcp-agent'],
+        '/etc/neutron/dhcp_agent.ini': ['neutron-dhcp-agent'],
+        '/etc/neutron/l3_agent.ini': ['neutron-l3-agent'],
+        '/etc/apparmor.d/usr.bin.neutron-l3-agent': ['neutron-l3-agent'],
+    }
+
+    def setUp(self):
+        super(TestConfigChangeActions, self).setUp(
+            neutron_utils,
+            ['config', 'log', 'kv', 'get_os_codename_install_source',
+             'service_restart', 'service_stop', 'service_start',
+             'respawn_dnsmasq', 'path_hash'])
+        self.config.side_effect = self.test_config.get
+        self.get_os_codename_install_source.return_value = 'kilo'
+        self.db = {}
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+
+    def test_config_change_action(self):
+        action = neutron_utils.config_change_action
+        dnsmasq = '/etc/neutron/dnsmasq.conf'
+        self.assertEquals(action(dnsmasq, 'neutron-dhcp-agent', 'kilo'),
+                          'respawn-dnsmasq')
+        self.assertEquals(action(dnsmasq, 'neutron-dhcp-agent', 'juno'),
+                          'restart')
+        self.assertEquals(
+            action('/etc/apparmor.d/usr.bin.neutron-l3-agent',
+                   'neutron-l3-agent', 'icehouse'), 'none')
+        self.assertEquals(action('/etc/neutron/neutron.conf',
+                                 'neutron-l3-agent', 'mitaka'), 'restart')
+
+    def test_respawn_dnsmasq(self):
+        neutron_utils.apply_config_changes(
+            self.RESTART_MAP, ['/etc/neutron/dnsmasq.conf',
+                               '/etc/apparmor.d/usr.bin.neutron-l3-agent'])
+        self.assertFalse(self.service_restart.called)
+        self.assertTrue(self.respawn_dnsmasq.called)
+        self.assertEquals(self.db[neutron_utils.SERVICE_ACTIONS_KEY],
+                          {'respawn-dnsmasq': 1, 'none': 1})
+
+    def test_restart_supersedes(self):
+        self.db[neutron_utils.SERVICE_ACTIONS_KEY] = {'restart': 2}
+        neutron_utils.apply_config_changes(
+            self.RESTART_MAP, ['/etc/neutron/dnsmasq.conf',
+                               '/etc/neutron/dhcp_agent.ini',
+                               '/etc/neutron/l3_agent.ini'])
+        self.service_restart.assert_has_calls([
+            call('neutron-dhcp-agent'),
+            call('neutron-l3-agent'),
+        ], any_order=True)
+        self.assertFalse(self.respawn_dnsmasq.called)
+        self.assertEquals(self.db[neutron_utils.SERVICE_ACTIONS_KEY],
+                          {'restart': 4})
+
+    def test_stopstart(self):
+        neutron_utils.apply_config_changes(
+            self.RESTART_MAP, ['/etc/neutron/l3_agent.ini'], stopstart=True)
+        self.service_stop.assert_called_with('neutron-l3-agent')
+        self.service_start.assert_called_with('neutron-l3-agent')
+        self.assertFalse(self.service_restart.called)
+
+    def test_restart_on_change(self):
+        hashes = {'/etc/neutron/l3_agent.ini': ['a', 'b']}
+        self.path_hash.side_effect = \
+            lambda path: hashes[path].pop(0) if path in hashes else 'x'
+
+        @neutron_utils.restart_on_change(
+            {'/etc/neutron/l3_agent.ini': ['neutron-l3-agent'],
+             '/etc/neutron/dhcp_agent.ini': ['neutron-dhcp-agent']})
+        def write_configs():
+            pass
+
+        write_configs()
+        self.service_restart.assert_called_once_with('neutron-l3-agent')
+
+    @patch.dict(neutron_utils.RESTARTED_CHECKSUMS, clear=True)
+    def test_restart_on_change_after_restart(self):
+        current = {'/etc/neutron/l3_agent.ini': 'a',
+                   '/etc/neutron/dhcp_agent.ini': 'a'}
+        self.path_hash.side_effect = current.get
+
+        @neutron_utils.restart_on_change(
+            {'/etc/neutron/l3_agent.ini': ['neutron-l3-agent'],
+             '/etc/neutron/dhcp_agent.ini': ['neutron-dhcp-agent']})
+        def upgrade(write_after):
+            current.update({'/etc/neutron/l3_agent.ini': 'b',
+                            '/etc/neutron/dhcp_agent.ini': 'b'})
+            # As restart_services records after restarting everything
+            neutron_utils.RESTARTED_CHECKSUMS.update(current)
+            if write_after:
+                current['/etc/neutron/l3_agent.ini'] = 'c'
+
+        upgrade(False)
+        self.assertFalse(self.service_restart.called)
+        upgrade(True)
+        self.service_restart.assert_called_once_with('neutron-l3-agent')
+
+
+class TestRespawnDnsmasq(CharmTestCase):
+
+    def setUp(self):
+        super(TestRespawnDnsmasq, self).setUp(
+            neutron_utils, ['log', 'service_restart'])
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.ini = os.path.join(tmpdir, 'dhcp_agent.ini')
+        patcher = patch.object(neutron_utils, 'NEUTRON_DHCP_AGENT_CONF',
+                               self.ini)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_ini(self, content):
+        with open(self.ini, 'w') as f:
+            f.write(content)
+
+    def test_respawn_enabled(self):
+        self.write_ini('[AGENT]\ncheck_child_processes_action = respawn\n'
+                       'check_child_processes_interval = 10\n')
+        self.assertTrue(neutron_utils.dnsmasq_respawn_enabled())
+        with patch('subprocess.call') as _call:
+            neutron_utils.respawn_dnsmasq()
+        _call.assert_called_once_with(
+            ['pkill', '-f', '--', '--conf-file=/etc/neutron/dnsmasq.conf'])
+        self.assertFalse(self.service_restart.called)
+
+    def test_respawn_disabled(self):
+        for content in ['[DEFAULT]\n',
+                        '[AGENT]\ncheck_child_processes_action = exit\n'
+                        'check_child_processes_interval = 10\n',
+                        '[AGENT]\ncheck_child_processes_action = respawn\n'
+                        'check_child_processes_interval = 0\n']:
+            self.write_ini(content)
+            self.assertFalse(neutron_utils.dnsmasq_respawn_enabled())
+        with patch('subprocess.call') as _call:
+            neutron_utils.respawn_dnsmasq()
+        self.assertFalse(_call.called)
+        self.service_restart.assert_called_once_with('neutron-dhcp-agent')
+
+
+class TestLinkConfig(CharmTestCase):
+
+    def setUp(self):
+        super(TestLinkConfig, self).setUp(neutron_utils, ['log', 'link_flags'])
+        self.flags = {}
+        self.link_flags.side_effect = self.flags.get
+
+    @patch('subprocess.Popen')
+    def test_configure_links(self, _popen):
+        _popen.return_value.returncode = 0
+        self.flags.update({
+            'eth1': 0x1103,
+            'eth2': 0x1003,
+            'eth3': 0x1002,
+        })
+        neutron_utils.configure_links([('eth1', True), ('eth2', True),
+                                       ('eth3', False), ('eth4', False)])
+        _popen.assert_called_once_with(['ip', '-batch', '-'],
+                                       stdin=neutron_utils.subprocess.PIPE)
+        _popen.return_value.communicate.assert_called_once_with(
+            'link set dev eth2 up promisc on\n'
+            'link set dev eth3 up promisc off\n'
+            'link set dev eth4 up promisc off\n')
+
+    @patch('subprocess.Popen')
+    def test_configure_links_unchanged(self, _popen):
+        self.flags.update({'eth1': 0x1103, 'eth2': 0x1003})
+        neutron_utils.configure_links([('eth1', True), ('eth2', False)])
+        self.assertFalse(_popen.called)
+
+    @patch('subprocess.Popen')
+    def test_configure_links_failed(self, _popen):
+        _popen.return_value.returncode = 1
+        self.assertRaises(neutron_utils.subprocess.CalledProcessError,
+                          neutron_utils.configure_links, [('eth1', True)])
+
+    @patch.object(neutron_utils, 'configure_links')
+    @patch('subprocess.check_call')
+    def test_add_bridge_ports(self, check_call, configure_links):
+        neutron_utils.add_bridge_ports([('br-ex', 'eth0', False),
+                                        ('br-data', 'eth1', True)])
+        check_call.assert_called_once_with([
+            'ovs-vsctl',
+            '--', '--may-exist', 'add-port', 'br-ex', 'eth0',
+            '--', '--may-exist', 'add-port', 'br-data', 'eth1'])
+        configure_links.assert_called_once_with([('eth0', False),
+                                                 ('eth1', True)])
+
+
+class TestLinkAttributes(CharmTestCase):
+
+    def setUp(self):
+        super(TestLinkAttributes, self).setUp(neutron_utils, [])
+
+    def test_link_attrs(self):
+        with patch('__builtin__.open') as _open:
+            _open.return_value.__enter__.return_value.read.return_value = \
+                '0x1003\n'
+            self.assertEquals(neutron_utils.link_flags('eth0'), 0x1003)
+            _open.assert_called_with('/sys/class/net/eth0/flags')
+            _open.return_value.__enter__.return_value.read.return_value = \
+                '1500\n'
+            self.assertEquals(neutron_utils.link_mtu('eth0'), 1500)
+            _open.side_effect = IOError
+            self.assertEquals(neutron_utils.link_mtu('eth9'), None)
+
+
+class TestOVSDBManager(CharmTestCase):
+
+    def setUp(self):
+        super(TestOVSDBManager, self).setUp(neutron_utils, ['log'])
+
+    @patch('subprocess.check_call')
+    @patch('subprocess.check_output')
+    def test_add_ovsdb_manager(self, _check_output, _check_call):
+        _check_output.return_value = 'tcp:10.0.0.1:6640\n'
+        neutron_utils.add_ovsdb_manager('ptcp:6640:127.0.0.1')
+        _check_output.assert_called_with(['ovs-vsctl', 'get-manager'])
+        _check_call.assert_called_with(
+            ['ovs-vsctl', '--', '--id=@manager', 'create', 'Manager',
+             'target="ptcp:6640:127.0.0.1"', '--', 'add', 'Open_vSwitch',
+             '.', 'manager_options', '@manager'])
+
+    @patch('subprocess.check_call')
+    @patch('subprocess.check_output')
+    def test_add_ovsdb_manager_exists(self, _check_output, _check_call):
+        _check_output.return_value = 'tcp:10.0.0.1:6640\nptcp:6640:127.0.0.1\n'
+        neutron_utils.add_ovsdb_manager('ptcp:6640:127.0.0.1')
+        self.assertFalse(_check_call.called)
+
+
+class TestEvacuation(CharmTestCase):
+
+    LOCAL_L3 = {'id': 'l3-local', 'host': 'gw1.maas', 'alive': True}
+    LOCAL_DHCP = {'id': 'dhcp-local', 'host': 'gw1', 'alive': True}
+
+    def setUp(self):
+        super(TestEvacuation, self).setUp(
+            neutron_utils, ['get_neutron_client', 'get_partner_gateways',
+                            'kv', 'log', 'socket', 'wait_for'])
+        self.socket.gethostname.return_value = 'gw1'
+        self.get_partner_gateways.return_value = ['gw1', 'gw2', 'gw3']
+        self.wait_for.return_value = True
+        self.db = {}
+        self.kv.return_value.get.side_effect = self.db.get
+        self.kv.return_value.set.side_effect = self.db.__setitem__
+        self.neutron = MagicMock()
+        # Create the client methods up front, as MagicMock children first
+        # touched concurrently by the move threads can lose calls
+        for method in ('add_router_to_l3_agent', 'remove_router_from_l3_agent',
+                       'add_network_to_dhcp_agent',
+                       'remove_network_from_dhcp_agent',
+                       'list_l3_agent_hosting_routers',
+                       'list_dhcp_agent_hosting_networks'):
+            getattr(self.neutron, method)
+        self.get_neutron_client.return_value = self.neutron
+        self.agents = {
+            neutron_utils.L3_AGENT: [
+                self.LOCAL_L3,
+                {'id': 'l3-gw2', 'host': 'gw2', 'alive': True,
+                 'configurations': {'routers': 5}},
+                {'id': 'l3-gw3', 'host': 'gw3', 'alive': True,
+                 'configurations': {'routers': 1}},
+                {'id': 'l3-dead', 'host': 'gw4', 'alive': False},
+            ],
+            neutron_utils.DHCP_AGENT: [
+                self.LOCAL_DHCP,
+                {'id': 'dhcp-gw2', 'host': 'gw2', 'alive': True,
+                 'configurations': {'networks': 1}},
+                {'id': 'dhcp-gw3', 'host': 'gw3', 'alive': True,
+                 'admin_state_up': False},
+            ],
+        }
+        self.neutron.list_agents.side_effect = \
+            lambda agent_type, **kwargs: {'agents': self.agents[agent_type]}
+        self.neutron.list_routers_on_l3_agent.return_value = {
+            'routers': [{'id': 'r1', 'ha': False}, {'id': 'r2', 'ha': True}]}
+        self.neutron.list_networks_on_dhcp_agent.return_value = {
+            'networks': [{'id': 'n1'}]}
+        self.neutron.list_dhcp_agent_hosting_networks.return_value = {
+            'agents': []}
+
+    def test_evacuate(self):
+        results = neutron_utils.evacuate_agents(concurrency=2, timeout=30)
+        self.neutron.update_agent.assert_has_calls([
+            call('l3-local', {'agent': {'admin_state_up': False}}),
+            call('dhcp-local', {'agent': {'admin_state_up': False}}),
+        ])
+        self.neutron.remove_router_from_l3_agent.assert_has_calls([
+            call(l3_agent='l3-local', router_id='r1'),
+            call(l3_agent='l3-local', router_id='r2'),
+        ], any_order=True)
+        # HA routers fail over to the agents already hosting them
+        self.neutron.add_router_to_l3_agent.assert_called_once_with(
+            l3_agent='l3-gw3', body={'router_id': 'r1'})
+        self.neutron.add_network_to_dhcp_agent.assert_called_once_with(
+            dhcp_agent='dhcp-gw2', body={'network_id': 'n1'})
+        self.neutron.remove_network_from_dhcp_agent.assert_called_once_with(
+            dhcp_agent='dhcp-local', network_id='n1')
+        self.assertEquals(self.db[neutron_utils.EVACUATION_KEY], {
+            'routers': {'r1': ['l3-local', 'l3-gw3'],
+                        'r2': ['l3-local', None]},
+            'networks': {'n1': ['dhcp-local', 'dhcp-gw2']},
+        })
+        self.assertEquals(results['routers'], 2)
+        self.assertEquals(results['networks'], 1)
+        self.assertEquals(results['failed'], 0)
+        self.assertIn('timings.total', results)
+        self.assertIn('timings.max', results)
+
+    def test_evacuate_merges_state(self):
+        # Left over from an earlier evacuation that was not restored
+        self.db[neutron_utils.EVACUATION_KEY] = {
+            'routers': {'r0': ['l3-local', 'l3-gw2']}}
+        self.neutron.list_routers_on_l3_agent.return_value = {
+            'routers': [{'id': 'r1', 'ha': False}]}
+        self.neutron.list_networks_on_dhcp_agent.return_value = {
+            'networks': []}
+        neutron_utils.evacuate_agents()
+        self.assertEquals(self.db[neutron_utils.EVACUATION_KEY], {
+            'routers': {'r0': ['l3-local', 'l3-gw2'],
+                        'r1': ['l3-local', 'l3-gw3']},
+            'networks': {},
+        })
+
+    def test_evacuate_timeout(self):
+        self.wait_for.return_value = False
+        results = neutron_utils.evacuate_agents()
+        self.assertEquals(results['failed'], 3)
+        self.assertIn('router r1 not active after 120s',
+                      results['failures'])
+        self.assertFalse(self.neutron.remove_network_from_dhcp_agent.called)
+
+    def test_evacuate_no_peers(self):
+        self.get_partner_gateways.return_value = ['gw1']
+        self.assertRaises(neutron_utils.EvacuationError,
+                          neutron_utils.evacuate_agents)
+        self.assertFalse(self.neutron.update_agent.called)
+
+    def test_evacuate_no_client(self):
+        self.get_neutron_client.return_value = None
+        self.assertRaises(neutron_utils.EvacuationError,
+                          neutron_utils.evacuate_agents)
+
+    def test_restore(self):
+        self.db[neutron_utils.EVACUATION_KEY] = {
+            'routers': {'r1': ['l3-local', 'l3-gw3'],
+                        'r2': ['l3-local', None]},
+            'networks': {'n1': ['dhcp-local', 'dhcp-gw2']},
+        }
+        self.neutron.list_l3_agent_hosting_routers.side_effect = [
+            {'agents': [{'id': 'l3-gw3'}]},
+            {'agents': [{'id': 'l3-gw2'}]},
+        ]
+        results = neutron_utils.restore_agents(concurrency=1)
+        self.neutron.update_agent.assert_has_calls([
+            call('l3-local', {'agent': {'admin_state_up': True}}),
+            call('dhcp-local', {'agent': {'admin_state_up': True}}),
+        ])
+        self.neutron.remove_router_from_l3_agent.assert_called_once_with(
+            l3_agent='l3-gw3', router_id='r1')
+        self.neutron.add_router_to_l3_agent.assert_has_calls([
+            call(l3_agent='l3-local', body={'router_id': 'r1'}),
+            call(l3_agent='l3-local', body={'router_id': 'r2'}),
+        ])
+        self.neutron.add_network_to_dhcp_agent.assert_called_once_with(
+            dhcp_agent='dhcp-local', body={'network_id': 'n1'})
+        self.neutron.remove_network_from_dhcp_agent.assert_called_once_with(
+            dhcp_agent='dhcp-gw2', network_id='n1')
+        self.kv.return_value.unset.assert_called_once_with(
+            neutron_utils.EVACUATION_KEY)
+        self.assertEquals(results['routers'], 2)
+        self.assertEquals(results['networks'], 1)
+
+    def test_restore_keeps_failed(self):
+        self.db[neutron_utils.EVACUATION_KEY] = {
+            'routers': {'r1': ['l3-local', 'l3-gw3']},
+            'networks': {'n1': ['dhcp-local', 'dhcp-gw2']},
+        }
+        self.neutron.list_l3_agent_hosting_routers.return_value = {
+            'agents': [{'id': 'l3-gw3'}]}
+        self.neutron.add_router_to_l3_agent.side_effect = Exception('boom')
+        results = neutron_utils.restore_agents(concurrency=1)
+        self.assertEquals(results['failed'], 1)
+        self.assertEquals(results['networks'], 1)
+        self.assertFalse(self.kv.return_value.unset.called)
+        self.assertEquals(self.db[neutron_utils.EVACUATION_KEY], {
+            'routers': {'r1': ['l3-local', 'l3-gw3']},
+            'networks': {},
+        })
+
+    def test_router_active(self):
+        self.neutron.list_l3_agent_hosting_routers.return_value = {
+            'agents': [
+                {'id': 'l3-local', 'alive': True, 'ha_state': 'active'},
+                {'id': 'l3-gw2', 'alive': True, 'ha_state': 'standby'},
+                {'id': 'l3-gw3', 'alive': False, 'ha_state': 'active'},
+            ]}
+        self.assertTrue(neutron_utils.router_active(self.neutron, 'r1'))
+        self.assertFalse(neutron_utils.router_active(self.neutron, 'r1',
+                                                     exclude='l3-local'))
+        self.assertTrue(neutron_utils.router_active(
+            self.neutron, 'r1', agent_id='l3-gw2', standby=True))
+
+    def _placement(self, routers, networks):
+        self.neutron.list_routers_on_l3_agent.side_effect = \
+            lambda agent_id, **kwargs: {'routers': routers[agent_id]}
+        self.neutron.list_networks_on_dhcp_agent.side_effect = \
+            lambda agent_id, **kwargs: {'networks': networks[agent_id]}
+
+    def test_rebalance_dry_run(self):
+        self._placement(
+            {'l3-local': [{'id': 'r1'}, {'id': 'r2'}, {'id': 'r3'},
+                          {'id': 'r4', 'ha': True}],
+             'l3-gw2': [{'id': 'r4', 'ha': True}],
+             'l3-gw3': []},
+            {'dhcp-local': [{'id': 'n1'}], 'dhcp-gw2': []})
+        results = neutron_utils.rebalance_agents()
+        self.assertEquals(results['moves'], 2)
+        self.assertEquals(results['plan'],
+                          'router r1: l3-local -> l3-gw2\n'
+                          'router r2: l3-local -> l3-gw3')
+        self.assertEquals(results['counts'],
+                          'l3 l3-gw2: 0 -> 1\n'
+                          'l3 l3-gw3: 0 -> 1\n'
+                          'l3 l3-local: 3 -> 1\n'
+                          'dhcp dhcp-gw2: 0 -> 0\n'
+                          'dhcp dhcp-local: 1 -> 1')
+        self.assertFalse(self.neutron.add_router_to_l3_agent.called)
+
+    def test_rebalance(self):
+        self._placement(
+            {'l3-local': [], 'l3-gw2': [], 'l3-gw3': []},
+            {'dhcp-local': [{'id': 'n1'}, {'id': 'n2'}, {'id': 'n3'}],
+             'dhcp-gw2': []})
+        results = neutron_utils.rebalance_agents(dry_run=False,
+                                                 max_imbalance=1,
+                                                 concurrency=1)
+        self.neutron.add_network_to_dhcp_agent.assert_called_once_with(
+            dhcp_agent='dhcp-gw2', body={'network_id': 'n1'})
+        self.neutron.remove_network_from_dhcp_agent.assert_called_once_with(
+            dhcp_agent='dhcp-local', network_id='n1')
+        self.assertEquals(results['networks'], 1)
+        self.assertEquals(results['failed'], 0)
+
+    def test_plan_rebalance(self):
+        moves, counts = neutron_utils.plan_rebalance(
+            {'a': ['r1', 'r2', 'r3', 'r4', 'r5'], 'b': ['r6'], 'c': []}, 1)
+        self.assertEquals(moves, [('r1', 'a', 'c'), ('r2', 'a', 'b'),
+                                  ('r3', 'a', 'c')])
+        self.assertEquals(counts, {'a': 2, 'b': 2, 'c': 2})
+        moves, counts = neutron_utils.plan_rebalance(
+            {'a': ['r1', 'r2', 'r3'], 'b': []}, 3)
+        self.assertEquals(moves, [])
+
+    def test_plan_rebalance_hosted(self):
+        # Networks already hosted on the idlest agent cannot move there
+        moves, counts = neutron_utils.plan_rebalance(
+            {'a': ['n1', 'n2', 'n3'], 'b': ['n1', 'n2']}, 0)
+        self.assertEquals(moves, [])
+        self.assertEquals(counts, {'a': 3, 'b': 2})
+
+    def test_run_moves_client_per_worker(self):
+        self.get_neutron_client.side_effect = lambda: object()
+        used = []
+        lock = threading.Lock()
+        barrier = threading.Event()
+
+        def move(neutron, resource_id):
+            with lock:
+                used.append((threading.current_thread().ident, neutron))
+                if len(used) == 2:
+                    barrier.set()
+            # Keep both workers busy so each takes a move
+            barrier.wait(5)
+            return 0
+
+        results = neutron_utils.run_moves(
+            [('router', 'r%d' % i, move, ('r%d' % i,)) for i in range(6)], 2)
+        self.assertEquals([r[3] for r in results], [None] * 6)
+        clients = {}
+        for thread, neutron in used:
+            self.assertIs(clients.setdefault(thread, neutron), neutron)
+        self.assertEquals(len(clients), 2)
+        self.assertEquals(len(set(map(id, clients.values()))), 2)
+        self.assertEquals(self.get_neutron_client.call_count, 2)
+
+
+class TestWaitFor(CharmTestCase):
+
+    def setUp(self):
+        super(TestWaitFor, self).setUp(neutron_utils, ['time'])
+
+    def test_wait_for(self):
+        self.time.time.side_effect = [0, 5, 11]
+        check = MagicMock()
+        check.return_value = False
+        self.assertFalse(neutron_utils.wait_for(check, 10))
+        self.assertEquals(check.call_count, 2)
+        self.assertEquals(self.time.sleep.call_count, 1)
+
+    def test_wait_for_ready(self):
+        self.time.time.return_value = 0
+        check = MagicMock()
+        check.side_effect = [False, True]
+        self.assertTrue(neutron_utils.wait_for(check, 10))
+        self.time.sleep.assert_called_once_with(
+            neutron_utils.EVACUATION_POLL_INTERVAL)